@@ -1,10 +1,11 @@
 import copy
+import functools
 import json
 import os
 import logging
 import uuid
-import httpx
 import asyncio
+from typing import Optional
 from quart import (
     Blueprint,
     Quart,
@@ -16,29 +17,64 @@ from quart import (
     current_app,
 )
 
-from openai import AsyncAzureOpenAI
-from azure.identity.aio import (
-    DefaultAzureCredential,
-    get_bearer_token_provider
-)
+from azure.identity.aio import DefaultAzureCredential
+from backend.admission import AdmissionController, AdmissionRejected
 from backend.auth.auth_utils import get_authenticated_user_details
+from backend.security.graph_groups import GraphClient, GroupFilterResolver
 from backend.security.ms_defender_utils import get_msdefender_user_json
 from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.bulk_delete import DeleteJobs
+from backend.history.budget import HistoryBudgeter, TokenCounter
+from backend.history.summarizer import (
+    AzureOpenAISummarizer,
+    RollingSummarizer,
+    apply_conversation_summary,
+)
+from backend.history.replies import ReplySaver, tool_message_id
+from backend.history.titles import ConversationTitler, provisional_title
+from backend.openai_client import AzureOpenAIClientManager
+from backend.promptflow import PromptflowClient
+from backend.rate_limit import FileQuotaState, QuotaLimiter, RateLimitExceeded
+from backend.router import BackendRouter, OpenAIBackend
+from backend.singleflight import SingleFlight
+from backend.timing import SERVER_TIMING_HEADER, PhaseTimer
+from backend.cache.response_cache import (
+    ResponseCache,
+    entry_from_completion,
+    load_cache_backend,
+    make_cache_key,
+    record_stream,
+    replay_completion,
+    replay_stream,
+)
+from backend.cache.semantic_cache import (
+    AzureOpenAIEmbedder,
+    SemanticCache,
+    get_standalone_question,
+    make_partition_key,
+)
 from backend.settings import (
     app_settings,
     MINIMUM_SUPPORTED_AZURE_OPENAI_PREVIEW_API_VERSION
 )
 from backend.utils import (
+    COMPACT_STREAM_FORMAT,
+    STREAM_FORMAT_HEADER,
+    ClosingStream,
+    close_stream,
+    coalesce_stream_responses,
+    format_as_compact_ndjson,
     format_as_ndjson,
     format_stream_response,
     format_non_streaming_response,
-    convert_to_pf_format,
     format_pf_non_streaming_response,
+    format_pf_stream_response,
 )
 
 bp = Blueprint("routes", __name__, static_folder="static", template_folder="static")
 
 cosmos_db_ready = asyncio.Event()
+openai_client_lock = asyncio.Lock()
 
 
 def create_app():
@@ -50,11 +86,65 @@ def create_app():
     async def init():
         try:
             app.cosmos_conversation_client = await init_cosmosdb_client()
+            app.rolling_summarizer = init_rolling_summarizer(app.cosmos_conversation_client)
+            app.conversation_titler = init_conversation_titler(app.cosmos_conversation_client)
+            app.reply_saver = init_reply_saver(app.cosmos_conversation_client)
+            app.delete_jobs = init_delete_jobs(app.cosmos_conversation_client)
             cosmos_db_ready.set()
         except Exception as e:
             logging.exception("Failed to initialize CosmosDB client")
             app.cosmos_conversation_client = None
             raise e
+
+        app.admission_controller = init_admission_controller()
+        app.rate_limiter = init_rate_limiter()
+        app.history_budgeter = init_history_budgeter()
+        app.group_filter_resolver = init_group_filter_resolver()
+        app.promptflow_client = init_promptflow_client()
+        app.response_cache = init_response_cache()
+        app.single_flight = (
+            SingleFlight() if app_settings.base_settings.coalesce_chat_requests else None
+        )
+
+        try:
+            app.openai_client_manager = await init_openai_client_manager()
+        except Exception:
+            logging.exception("Failed to initialize Azure OpenAI client")
+            app.openai_client_manager = None
+
+        try:
+            app.backend_router = await init_backend_router()
+        except Exception:
+            logging.exception("Failed to initialize Azure OpenAI backends")
+            app.backend_router = None
+
+        try:
+            app.semantic_cache = init_semantic_cache(app.openai_client_manager)
+        except Exception:
+            logging.exception("Failed to initialize semantic cache")
+            app.semantic_cache = None
+
+    @app.after_serving
+    async def shutdown():
+        if getattr(app, "rolling_summarizer", None):
+            await app.rolling_summarizer.close()
+        if getattr(app, "conversation_titler", None):
+            await app.conversation_titler.close()
+        if getattr(app, "reply_saver", None):
+            await app.reply_saver.close()
+        if getattr(app, "delete_jobs", None):
+            await app.delete_jobs.close()
+        if getattr(app, "cosmos_conversation_client", None):
+            # Flushes queued chat history writes
+            await app.cosmos_conversation_client.close()
+        if getattr(app, "openai_client_manager", None):
+            await app.openai_client_manager.close()
+        if getattr(app, "backend_router", None):
+            await app.backend_router.close()
+        if getattr(app, "group_filter_resolver", None):
+            await app.group_filter_resolver.close()
+        if getattr(app, "promptflow_client", None):
+            await app.promptflow_client.close()
     
     return app
 
@@ -85,6 +175,10 @@ if DEBUG.lower() == "true":
 
 USER_AGENT = "GitHubSampleWebApp/AsyncAzureOpenAI/1.0.0"
 
+HISTORY_LIST_PAGE_SIZE = 25
+MAX_HISTORY_LIST_PAGE_SIZE = 100
+CONTINUATION_TOKEN_HEADER = "X-Continuation-Token"
+
 
 # Frontend Settings via Environment Variables
 frontend_settings = {
@@ -103,6 +197,10 @@ frontend_settings = {
         "show_chat_history_button": app_settings.ui.show_chat_history_button,
     },
     "sanitize_answer": app_settings.base_settings.sanitize_answer,
+    "replies_saved_by_server": bool(
+        app_settings.chat_history and
+        app_settings.chat_history.save_replies
+    ),
     "oyd_enabled": app_settings.base_settings.datasource_type,
 }
 
@@ -112,9 +210,7 @@ MS_DEFENDER_ENABLED = os.environ.get("MS_DEFENDER_ENABLED", "true").lower() == "
 
 
 # Initialize Azure OpenAI Client
-async def init_openai_client():
-    azure_openai_client = None
-    
+async def init_openai_client_manager():
     try:
         # API version check
         if (
@@ -142,14 +238,10 @@ async def init_openai_client():
 
         # Authentication
         aoai_api_key = app_settings.azure_openai.key
-        ad_token_provider = None
+        credential = None
         if not aoai_api_key:
             logging.debug("No AZURE_OPENAI_KEY found, using Azure Entra ID auth")
-            async with DefaultAzureCredential() as credential:
-                ad_token_provider = get_bearer_token_provider(
-                    credential,
-                    "https://cognitiveservices.azure.com/.default"
-                )
+            credential = DefaultAzureCredential()
 
         # Deployment
         deployment = app_settings.azure_openai.model
@@ -159,21 +251,236 @@ async def init_openai_client():
         # Default Headers
         default_headers = {"x-ms-useragent": USER_AGENT}
 
-        azure_openai_client = AsyncAzureOpenAI(
+        client_manager = AzureOpenAIClientManager(
+            endpoint=endpoint,
             api_version=app_settings.azure_openai.preview_api_version,
             api_key=aoai_api_key,
-            azure_ad_token_provider=ad_token_provider,
+            credential=credential,
             default_headers=default_headers,
-            azure_endpoint=endpoint,
+            max_connections=app_settings.azure_openai.max_connections,
+            max_keepalive_connections=app_settings.azure_openai.max_keepalive_connections,
+            http2=app_settings.azure_openai.http2,
         )
+        await client_manager.start()
 
-        return azure_openai_client
+        return client_manager
     except Exception as e:
         logging.exception("Exception in Azure OpenAI initialization", e)
-        azure_openai_client = None
         raise e
 
 
+async def init_backend_router():
+    if not app_settings.azure_openai.backends:
+        return None
+
+    backends = []
+    for backend_settings in app_settings.azure_openai.backends:
+        client_manager = AzureOpenAIClientManager(
+            endpoint=backend_settings.endpoint,
+            api_version=app_settings.azure_openai.preview_api_version,
+            api_key=backend_settings.key,
+            credential=None if backend_settings.key else DefaultAzureCredential(),
+            default_headers={"x-ms-useragent": USER_AGENT},
+            max_connections=app_settings.azure_openai.max_connections,
+            max_keepalive_connections=app_settings.azure_openai.max_keepalive_connections,
+            http2=app_settings.azure_openai.http2,
+            # The router retries on another backend instead
+            max_retries=0,
+        )
+        await client_manager.start()
+        backends.append(
+            OpenAIBackend(
+                client_manager,
+                deployment=backend_settings.deployment or app_settings.azure_openai.model,
+                weight=backend_settings.weight
+            )
+        )
+
+    return BackendRouter(
+        backends,
+        eject_seconds=app_settings.azure_openai.backend_eject_seconds,
+        hedge=app_settings.azure_openai.hedge_requests and app_settings.azure_openai.stream,
+        hedge_budget=app_settings.azure_openai.hedge_budget,
+        hedge_percentile=app_settings.azure_openai.hedge_percentile,
+        hedge_min_samples=app_settings.azure_openai.hedge_min_samples
+    )
+
+
+async def get_openai_client():
+    # The manager is normally created in before_serving; retry here if that failed
+    if not getattr(current_app, "openai_client_manager", None):
+        async with openai_client_lock:
+            if not getattr(current_app, "openai_client_manager", None):
+                current_app.openai_client_manager = await init_openai_client_manager()
+
+    return current_app.openai_client_manager.client
+
+
+def init_admission_controller():
+    if not app_settings.admission.enabled:
+        return None
+
+    return AdmissionController(
+        max_in_flight=app_settings.admission.max_in_flight,
+        max_per_user=app_settings.admission.max_per_user,
+        max_queue=app_settings.admission.max_queue,
+        queue_timeout=app_settings.admission.queue_timeout_seconds
+    )
+
+
+def init_rate_limiter():
+    if (
+        not app_settings.rate_limit.tokens_per_minute and
+        not app_settings.rate_limit.requests_per_minute
+    ):
+        return None
+
+    state = None
+    if app_settings.rate_limit.state_file:
+        if FileQuotaState.supported():
+            state = FileQuotaState(app_settings.rate_limit.state_file)
+        else:
+            logging.warning("RATE_LIMIT_STATE_FILE needs a POSIX system; each worker paces itself against the full quota")
+
+    return QuotaLimiter(
+        tokens_per_minute=app_settings.rate_limit.tokens_per_minute,
+        requests_per_minute=app_settings.rate_limit.requests_per_minute,
+        burst_seconds=app_settings.rate_limit.burst_seconds,
+        max_wait=app_settings.rate_limit.max_wait_seconds,
+        counter=TokenCounter(app_settings.azure_openai.tokenizer_encoding),
+        state=state
+    )
+
+
+async def reserve_quota(messages, max_tokens):
+    rate_limiter = getattr(current_app, "rate_limiter", None)
+    if not rate_limiter:
+        return None
+
+    return await rate_limiter.acquire(rate_limiter.estimate_tokens(messages), max_tokens)
+
+
+def init_history_budgeter():
+    if not app_settings.azure_openai.max_prompt_tokens:
+        return None
+
+    return HistoryBudgeter(
+        TokenCounter(app_settings.azure_openai.tokenizer_encoding),
+        max_prompt_tokens=app_settings.azure_openai.max_prompt_tokens
+    )
+
+
+def init_rolling_summarizer(cosmos_conversation_client):
+    if not app_settings.history_summary.enabled or not cosmos_conversation_client:
+        return None
+
+    return RollingSummarizer(
+        AzureOpenAISummarizer(
+            get_openai_client,
+            model=app_settings.azure_openai.model,
+            max_tokens=app_settings.history_summary.max_tokens,
+            reserve_quota=reserve_quota
+        ),
+        cosmos_conversation_client,
+        threshold_turns=app_settings.history_summary.threshold_turns,
+        keep_recent_turns=app_settings.history_summary.keep_recent_turns
+    )
+
+
+def init_conversation_titler(cosmos_conversation_client):
+    if not cosmos_conversation_client:
+        return None
+
+    return ConversationTitler(generate_title, cosmos_conversation_client)
+
+
+def init_reply_saver(cosmos_conversation_client):
+    if not cosmos_conversation_client or not app_settings.chat_history.save_replies:
+        return None
+
+    return ReplySaver(cosmos_conversation_client)
+
+
+def init_delete_jobs(cosmos_conversation_client):
+    if not cosmos_conversation_client:
+        return None
+
+    return DeleteJobs(
+        cosmos_conversation_client.container_client,
+        cosmos_conversation_client.bulk_deleter
+    )
+
+
+def init_response_cache():
+    if not app_settings.response_cache.enabled:
+        return None
+
+    return ResponseCache(
+        backend=load_cache_backend(
+            app_settings.response_cache.backend,
+            app_settings.response_cache.max_entries
+        ),
+        ttl=app_settings.response_cache.ttl_seconds
+    )
+
+
+def init_semantic_cache(openai_client_manager):
+    if not app_settings.semantic_cache.enabled or not openai_client_manager:
+        return None
+
+    embedder = AzureOpenAIEmbedder(
+        openai_client_manager,
+        embedding_name=app_settings.azure_openai.embedding_name,
+        embedding_endpoint=app_settings.azure_openai.embedding_endpoint,
+        embedding_key=app_settings.azure_openai.embedding_key,
+    )
+    return SemanticCache(
+        embed=embedder,
+        similarity_threshold=app_settings.semantic_cache.similarity_threshold,
+        max_entries=app_settings.semantic_cache.max_entries,
+        max_partitions=app_settings.semantic_cache.max_partitions,
+        ttl=app_settings.semantic_cache.ttl_seconds
+    )
+
+
+def init_group_filter_resolver():
+    permitted_groups_column = getattr(app_settings.datasource, "permitted_groups_column", None)
+    if not permitted_groups_column:
+        return None
+
+    return GroupFilterResolver(
+        GraphClient(
+            endpoint=app_settings.graph.endpoint,
+            max_connections=app_settings.graph.max_connections,
+            timeout=app_settings.graph.timeout_seconds
+        ),
+        permitted_groups_column,
+        ttl=app_settings.graph.group_cache_ttl_seconds,
+        max_entries=app_settings.graph.group_cache_max_entries,
+        use_claims=app_settings.datasource.permitted_groups_from_claims
+    )
+
+
+async def get_datasource_parameters(request_headers):
+    group_filter_resolver = getattr(current_app, "group_filter_resolver", None)
+    if not group_filter_resolver:
+        return None
+
+    # Most users' groups are already in their sign-in claims
+    claims_filter = group_filter_resolver.get_filter_from_claims(request_headers)
+    if claims_filter:
+        return {"filter": claims_filter}
+
+    user_token = request_headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
+    logging.debug(f"USER TOKEN is {'present' if user_token else 'not present'}")
+    if not user_token:
+        raise ValueError(
+            "Document-level access control is enabled, but user access token could not be fetched."
+        )
+
+    return {"filter": await group_filter_resolver.get_filter(user_token)}
+
+
 async def init_cosmosdb_client():
     cosmos_conversation_client = None
     if app_settings.chat_history:
@@ -195,6 +502,15 @@ async def init_cosmosdb_client():
                 database_name=app_settings.chat_history.database,
                 container_name=app_settings.chat_history.conversations_container,
                 enable_message_feedback=app_settings.chat_history.enable_feedback,
+                write_behind_options=(
+                    {
+                        "max_batch_size": app_settings.chat_history.write_behind_max_batch_size,
+                        "flush_interval": app_settings.chat_history.write_behind_flush_interval_ms / 1000,
+                        "max_queue": app_settings.chat_history.write_behind_max_queue,
+                    }
+                    if app_settings.chat_history.write_behind_enabled else None
+                ),
+                delete_concurrency=app_settings.chat_history.delete_concurrency,
             )
         except Exception as e:
             logging.exception("Exception in CosmosDB initialization", e)
@@ -206,7 +522,7 @@ async def init_cosmosdb_client():
     return cosmos_conversation_client
 
 
-def prepare_model_args(request_body, request_headers):
+def prepare_model_args(request_body, request_headers, datasource_parameters=None):
     request_messages = request_body.get("messages", [])
     messages = []
     if not app_settings.datasource:
@@ -217,6 +533,17 @@ def prepare_model_args(request_body, request_headers):
             }
         ]
 
+    # Earlier turns already folded into the stored conversation summary
+    request_messages = apply_conversation_summary(
+        request_messages, request_body.get("history_summary")
+    )
+
+    history_budgeter = getattr(current_app, "history_budgeter", None)
+    if history_budgeter:
+        # Budget the system message together with the history it precedes
+        budgeted_messages, _ = history_budgeter.trim(messages + request_messages)
+        messages, request_messages = [], budgeted_messages
+
     for message in request_messages:
         if message:
             if message["role"] == "assistant" and "context" in message:
@@ -258,7 +585,7 @@ def prepare_model_args(request_body, request_headers):
         model_args["extra_body"] = {
             "data_sources": [
                 app_settings.datasource.construct_payload_configuration(
-                    request=request
+                    request_parameters=datasource_parameters
                 )
             ]
         }
@@ -302,35 +629,25 @@ def prepare_model_args(request_body, request_headers):
     return model_args
 
 
+def init_promptflow_client():
+    if not app_settings.base_settings.use_promptflow:
+        return None
+
+    # Adding timeout for scenarios where response takes longer to come back
+    logging.debug(f"Setting timeout to {app_settings.promptflow.response_timeout}")
+    return PromptflowClient(
+        app_settings.promptflow.endpoint,
+        app_settings.promptflow.api_key,
+        request_field_name=app_settings.promptflow.request_field_name,
+        response_field_name=app_settings.promptflow.response_field_name,
+        timeout=float(app_settings.promptflow.response_timeout),
+        max_connections=app_settings.promptflow.max_connections
+    )
+
+
 async def promptflow_request(request):
     try:
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {app_settings.promptflow.api_key}",
-        }
-        # Adding timeout for scenarios where response takes longer to come back
-        logging.debug(f"Setting timeout to {app_settings.promptflow.response_timeout}")
-        async with httpx.AsyncClient(
-            timeout=float(app_settings.promptflow.response_timeout)
-        ) as client:
-            pf_formatted_obj = convert_to_pf_format(
-                request,
-                app_settings.promptflow.request_field_name,
-                app_settings.promptflow.response_field_name
-            )
-            # NOTE: This only support question and chat_history parameters
-            # If you need to add more parameters, you need to modify the request body
-            response = await client.post(
-                app_settings.promptflow.endpoint,
-                json={
-                    app_settings.promptflow.request_field_name: pf_formatted_obj[-1]["inputs"][app_settings.promptflow.request_field_name],
-                    "chat_history": pf_formatted_obj[:-1],
-                },
-                headers=headers,
-            )
-        resp = response.json()
-        resp["id"] = request["messages"][-1]["id"]
-        return resp
+        return await current_app.promptflow_client.complete(request)
     except Exception as e:
         logging.error(f"An error occurred while making promptflow_request: {e}")
 
@@ -343,16 +660,92 @@ async def send_chat_request(request_body, request_headers):
             filtered_messages.append(message)
             
     request_body['messages'] = filtered_messages
-    model_args = prepare_model_args(request_body, request_headers)
+    datasource_parameters = await get_datasource_parameters(request_headers)
+    model_args = prepare_model_args(request_body, request_headers, datasource_parameters)
+
+    cache_writers = []
+    cached_entry = None
+
+    response_cache = getattr(current_app, "response_cache", None)
+    if response_cache:
+        cache_key = make_cache_key(model_args)
+        cached_entry = await response_cache.get(cache_key)
+        cache_writers.append(functools.partial(response_cache.set, cache_key))
+
+    semantic_cache = getattr(current_app, "semantic_cache", None)
+    question = get_standalone_question(model_args["messages"])
+    if semantic_cache and question and not cached_entry:
+        partition_key = make_partition_key(model_args)
+        try:
+            cached_entry, question_vector = await semantic_cache.lookup(partition_key, question)
+        except Exception:
+            logging.exception("Semantic cache lookup failed")
+        else:
+            async def write_semantic_cache(entry):
+                semantic_cache.add(partition_key, question_vector, entry)
+            cache_writers.append(write_semantic_cache)
+
+    if cached_entry:
+        logging.debug("Serving chat completion from the response cache")
+        if model_args["stream"]:
+            return replay_stream(cached_entry), None
+        return replay_completion(cached_entry), None
+
+    async def call_upstream():
+        reservation = await reserve_quota(model_args["messages"], model_args["max_tokens"])
+        try:
+            backend_router = getattr(current_app, "backend_router", None)
+            if backend_router:
+                response, headers, _ = await backend_router.create_chat_completion(
+                    model_args,
+                    tokens=reservation.tokens if reservation else model_args["max_tokens"]
+                )
+            else:
+                azure_openai_client = await get_openai_client()
+                raw_response = await azure_openai_client.chat.completions.with_raw_response.create(**model_args)
+                response = raw_response.parse()
+                headers = raw_response.headers
+            apim_request_id = headers.get("apim-request-id") 
+            upstream = response
+        except Exception as e:
+            logging.exception("Exception in send_chat_request")
+            if reservation:
+                reservation.cancel(e)
+            raise e
 
-    try:
-        azure_openai_client = await init_openai_client()
-        raw_response = await azure_openai_client.chat.completions.with_raw_response.create(**model_args)
-        response = raw_response.parse()
-        apim_request_id = raw_response.headers.get("apim-request-id") 
-    except Exception as e:
-        logging.exception("Exception in send_chat_request")
-        raise e
+        if reservation:
+            if model_args["stream"]:
+                response = reservation.track_stream(
+                    response, current_app.rate_limiter.counter.count
+                )
+                upstream = response
+            else:
+                reservation.settle(response.usage.total_tokens if response.usage else reservation.tokens)
+
+        if cache_writers:
+            async def write_caches(entry):
+                for cache_writer in cache_writers:
+                    await cache_writer(entry)
+
+            if model_args["stream"]:
+                response = record_stream(response, write_caches)
+            else:
+                entry = entry_from_completion(response)
+                if entry:
+                    await write_caches(entry)
+
+        if model_args["stream"] and response is not upstream:
+            response = ClosingStream(response, upstream)
+        return response, apim_request_id
+
+    single_flight = getattr(current_app, "single_flight", None)
+    if single_flight:
+        # Identical concurrent requests share one upstream completion
+        response, apim_request_id = await single_flight.do(
+            make_cache_key(model_args), call_upstream, stream=model_args["stream"]
+        )
+    else:
+        response, apim_request_id = await call_upstream()
 
     return response, apim_request_id
 
@@ -374,34 +767,138 @@ async def complete_chat_request(request_body, request_headers):
 
 
 async def stream_chat_request(request_body, request_headers):
-    response, apim_request_id = await send_chat_request(request_body, request_headers)
     history_metadata = request_body.get("history_metadata", {})
-    
-    async def generate():
-        async for completionChunk in response:
-            yield format_stream_response(completionChunk, history_metadata, apim_request_id)
+    if app_settings.base_settings.use_promptflow:
+        async def generate():
+            async for pfChunk in current_app.promptflow_client.stream(request_body):
+                yield format_pf_stream_response(
+                    pfChunk,
+                    history_metadata,
+                    app_settings.promptflow.response_field_name,
+                    app_settings.promptflow.citations_field_name
+                )
+    else:
+        response, apim_request_id = await send_chat_request(request_body, request_headers)
+
+        async def generate():
+            async for completionChunk in response:
+                yield format_stream_response(completionChunk, history_metadata, apim_request_id)
+
+    stream = coalesce_stream_responses(
+        generate(),
+        max_tokens=app_settings.stream.flush_max_tokens,
+        max_interval_ms=app_settings.stream.flush_interval_ms
+    )
+    if not app_settings.base_settings.use_promptflow:
+        stream = ClosingStream(stream, response)
+    return stream
+
 
-    return generate()
+async def wait_for_history(history_task, timer: PhaseTimer):
+    # Returns the title task of a new conversation
+    if history_task.done():
+        return history_task.result()
+    return await timer.measure("history_wait", asyncio.shield(history_task))
 
 
-async def conversation_internal(request_body, request_headers):
+def close_when_request_ends(*streams):
+    # Quart closes the response body when the client disconnects, but a body
+    # generator that never started does not close what it reads from
+    def close(_task):
+        for stream in streams:
+            asyncio.ensure_future(close_stream(stream))
+
+    asyncio.current_task().add_done_callback(close)
+
+
+async def conversation_internal(request_body, request_headers, persist_history=None, timer=None):
+    timer = timer or PhaseTimer()
+    admission = None
+    admission_controller = getattr(current_app, "admission_controller", None)
+    if admission_controller:
+        authenticated_user = get_authenticated_user_details(request_headers=request_headers)
+        try:
+            admission = await admission_controller.acquire(authenticated_user["user_principal_id"])
+        except AdmissionRejected as ex:
+            logging.warning(f"Rejected chat request: {ex}")
+            return jsonify({"error": str(ex)}), ex.status_code, {"Retry-After": str(ex.retry_after)}
+
+    history_task = None
+    if persist_history:
+        # Only write history for admitted requests, so a rejected request
+        # leaves no conversation behind and starts no title generation
+        history_task = asyncio.ensure_future(timer.measure("history", persist_history()))
+        # Mark a failure as retrieved; it is reported where the task is awaited
+        history_task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
     try:
-        if app_settings.azure_openai.stream and not app_settings.base_settings.use_promptflow:
-            result = await stream_chat_request(request_body, request_headers)
-            response = await make_response(format_as_ndjson(result))
+        if app_settings.azure_openai.stream and (
+            not app_settings.base_settings.use_promptflow or app_settings.promptflow.stream
+        ):
+            result = await timer.measure(
+                "upstream", stream_chat_request(request_body, request_headers)
+            )
+            upstream = result
+            if history_task:
+                try:
+                    title_task = await wait_for_history(history_task, timer)
+                except BaseException:
+                    await result.aclose()
+                    raise
+                reply_saver = getattr(current_app, "reply_saver", None)
+                if reply_saver:
+                    result = reply_saver.collect(
+                        result,
+                        get_authenticated_user_details(request_headers=request_headers)["user_principal_id"],
+                        request_body["history_metadata"]["conversation_id"]
+                    )
+                if title_task:
+                    result = current_app.conversation_titler.hold_last_frame(result, title_task)
+            if admission:
+                # Hold the slot until the answer has been streamed
+                result = admission.hold(result)
+                admission = None
+            close_when_request_ends(result, upstream)
+            if request_headers.get(STREAM_FORMAT_HEADER, "").lower() == COMPACT_STREAM_FORMAT:
+                response = await make_response(format_as_compact_ndjson(result))
+                response.headers[STREAM_FORMAT_HEADER] = COMPACT_STREAM_FORMAT
+            else:
+                response = await make_response(format_as_ndjson(result))
             response.timeout = None
             response.mimetype = "application/json-lines"
+            response.headers[SERVER_TIMING_HEADER] = timer.header()
             return response
         else:
-            result = await complete_chat_request(request_body, request_headers)
-            return jsonify(result)
+            result = await timer.measure(
+                "upstream", complete_chat_request(request_body, request_headers)
+            )
+            if history_task:
+                title_task = await wait_for_history(history_task, timer)
+                reply_saver = getattr(current_app, "reply_saver", None)
+                if reply_saver:
+                    reply_saver.save_response(
+                        result,
+                        get_authenticated_user_details(request_headers=request_headers)["user_principal_id"],
+                        request_body["history_metadata"]["conversation_id"]
+                    )
+                if title_task:
+                    await current_app.conversation_titler.wait(title_task)
+            response = jsonify(result)
+            response.headers[SERVER_TIMING_HEADER] = timer.header()
+            return response
 
+    except RateLimitExceeded as ex:
+        logging.warning(f"Rejected chat request: {ex}")
+        return jsonify({"error": str(ex)}), ex.status_code, {"Retry-After": str(ex.retry_after)}
     except Exception as ex:
         logging.exception(ex)
         if hasattr(ex, "status_code"):
             return jsonify({"error": str(ex)}), ex.status_code
         else:
             return jsonify({"error": str(ex)}), 500
+    finally:
+        if admission:
+            admission.release()
 
 
 @bp.route("/conversation", methods=["POST"])
@@ -413,6 +910,49 @@ async def conversation():
     return await conversation_internal(request_json, request.headers)
 
 
+@bp.route("/metrics", methods=["GET"])
+async def get_metrics():
+    ## the counters are not tied to a user, so they are only served when enabled
+    if not app_settings.base_settings.metrics_enabled:
+        return jsonify({"error": "Not found"}), 404
+
+    metrics = {}
+    if getattr(current_app, "admission_controller", None):
+        metrics["admission"] = current_app.admission_controller.stats()
+    if getattr(current_app, "rate_limiter", None):
+        metrics["rate_limit"] = current_app.rate_limiter.stats()
+    if getattr(current_app, "openai_client_manager", None):
+        metrics["openai_client"] = current_app.openai_client_manager.stats()
+    if getattr(current_app, "backend_router", None):
+        metrics["backends"] = current_app.backend_router.stats()
+    if getattr(current_app, "history_budgeter", None):
+        metrics["history_budget"] = current_app.history_budgeter.stats()
+    if getattr(current_app, "rolling_summarizer", None):
+        metrics["history_summary"] = current_app.rolling_summarizer.stats()
+    if getattr(current_app, "conversation_titler", None):
+        metrics["conversation_titles"] = current_app.conversation_titler.stats()
+    if getattr(current_app, "reply_saver", None):
+        metrics["saved_replies"] = current_app.reply_saver.stats()
+    if getattr(getattr(current_app, "cosmos_conversation_client", None), "write_buffer", None):
+        metrics["history_writes"] = current_app.cosmos_conversation_client.write_buffer.stats()
+    if getattr(getattr(current_app, "cosmos_conversation_client", None), "bulk_deleter", None):
+        metrics["history_deletes"] = current_app.cosmos_conversation_client.bulk_deleter.stats()
+    if getattr(current_app, "delete_jobs", None):
+        metrics["delete_jobs"] = current_app.delete_jobs.stats()
+    if getattr(current_app, "response_cache", None):
+        metrics["response_cache"] = current_app.response_cache.stats()
+    if getattr(current_app, "single_flight", None):
+        metrics["single_flight"] = current_app.single_flight.stats()
+    if getattr(current_app, "semantic_cache", None):
+        metrics["semantic_cache"] = current_app.semantic_cache.stats()
+    if getattr(current_app, "group_filter_resolver", None):
+        metrics["group_filter"] = current_app.group_filter_resolver.stats()
+    if getattr(current_app, "promptflow_client", None):
+        metrics["promptflow"] = current_app.promptflow_client.stats()
+
+    return jsonify(metrics), 200
+
+
 @bp.route("/frontend_settings", methods=["GET"])
 def get_frontend_settings():
     try:
@@ -426,6 +966,7 @@ def get_frontend_settings():
 @bp.route("/history/generate", methods=["POST"])
 async def add_conversation():
     await cosmos_db_ready.wait()
+    timer = PhaseTimer()
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
 
@@ -438,26 +979,49 @@ async def add_conversation():
         if not current_app.cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
+        messages = request_json["messages"]
+        if not (len(messages) > 0 and messages[-1]["role"] == "user"):
+            raise Exception("No user message found")
+
         # check for the conversation_id, if the conversation is not set, we will create a new one
         history_metadata = {}
-        if not conversation_id:
-            title = await generate_title(request_json["messages"])
-            conversation_dict = await current_app.cosmos_conversation_client.create_conversation(
-                user_id=user_id, title=title
+        conversation_summary = None
+        if conversation_id and getattr(current_app, "rolling_summarizer", None):
+            conversation = await timer.measure(
+                "summary",
+                current_app.cosmos_conversation_client.get_conversation(user_id, conversation_id)
             )
-            conversation_id = conversation_dict["id"]
-            history_metadata["title"] = title
-            history_metadata["date"] = conversation_dict["createdAt"]
+            conversation_summary = conversation.get("summary") if conversation else None
+
+        async def persist_user_message():
+            # Runs while the answer is requested; the answer is only sent
+            # once the user message is stored
+            nonlocal conversation_id
+            title_task = None
+            if not conversation_id:
+                # Start with a provisional title; the generated one is written
+                # while the answer is streamed
+                title = provisional_title(messages)
+                conversation_dict = await current_app.cosmos_conversation_client.create_conversation(
+                    user_id=user_id, title=title
+                )
+                conversation_id = conversation_dict["id"]
+                history_metadata["title"] = title
+                history_metadata["date"] = conversation_dict["createdAt"]
+                title_task = current_app.conversation_titler.schedule(
+                    user_id, conversation_id, list(messages), history_metadata
+                )
+            history_metadata["conversation_id"] = conversation_id
 
-        ## Format the incoming message object in the "chat/completions" messages format
-        ## then write it to the conversation history in cosmos
-        messages = request_json["messages"]
-        if len(messages) > 0 and messages[-1]["role"] == "user":
+            ## Format the incoming message object in the "chat/completions" messages format
+            ## then write it to the conversation history in cosmos
             createdMessageValue = await current_app.cosmos_conversation_client.create_message(
                 uuid=str(uuid.uuid4()),
                 conversation_id=conversation_id,
                 user_id=user_id,
                 input_message=messages[-1],
+                ## the question is stored before the answer is sent
+                write_behind=False
             )
             if createdMessageValue == "Conversation not found":
                 raise Exception(
@@ -465,14 +1029,21 @@ async def add_conversation():
                     + conversation_id
                     + "."
                 )
-        else:
-            raise Exception("No user message found")
+
+            rolling_summarizer = getattr(current_app, "rolling_summarizer", None)
+            if rolling_summarizer:
+                rolling_summarizer.schedule(
+                    user_id, conversation_id, messages, conversation_summary
+                )
+            return title_task
 
         # Submit request to Chat Completions for response
         request_body = await request.get_json()
-        history_metadata["conversation_id"] = conversation_id
         request_body["history_metadata"] = history_metadata
-        return await conversation_internal(request_body, request.headers)
+        if conversation_summary:
+            request_body["history_summary"] = conversation_summary
+
+        return await conversation_internal(request_body, request.headers, persist_user_message, timer)
 
     except Exception as e:
         logging.exception("Exception in /history/generate")
@@ -505,7 +1076,7 @@ async def update_conversation():
             if len(messages) > 1 and messages[-2].get("role", None) == "tool":
                 # write the tool message first
                 await current_app.cosmos_conversation_client.create_message(
-                    uuid=str(uuid.uuid4()),
+                    uuid=tool_message_id(messages[-1]["id"]),
                     conversation_id=conversation_id,
                     user_id=user_id,
                     input_message=messages[-2],
@@ -618,10 +1189,29 @@ async def delete_conversation():
         return jsonify({"error": str(e)}), 500
 
 
+def get_history_page_args(args):
+    try:
+        offset = int(args.get("offset", 0))
+        page_size = int(args.get("page_size", HISTORY_LIST_PAGE_SIZE))
+    except ValueError:
+        raise ValueError("offset and page_size must be integers")
+    if not 1 <= page_size <= MAX_HISTORY_LIST_PAGE_SIZE:
+        raise ValueError(f"page_size must be between 1 and {MAX_HISTORY_LIST_PAGE_SIZE}")
+
+    return offset, page_size, args.get("continuation_token", None)
+
+
+async def make_history_page_response(items, continuation_token):
+    ## the token for the next page is returned in a header
+    response = await make_response(jsonify(items), 200)
+    if continuation_token:
+        response.headers[CONTINUATION_TOKEN_HEADER] = continuation_token
+    return response
+
+
 @bp.route("/history/list", methods=["GET"])
 async def list_conversations():
     await cosmos_db_ready.wait()
-    offset = request.args.get("offset", 0)
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user["user_principal_id"]
 
@@ -629,16 +1219,52 @@ async def list_conversations():
     if not current_app.cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
-    ## get the conversations from cosmos
-    conversations = await current_app.cosmos_conversation_client.get_conversations(
-        user_id, offset=offset, limit=25
-    )
+    ## get the conversations from cosmos. The first page and requests with a
+    ## continuation token are read page by page; offset is kept for older clients
+    try:
+        offset, page_size, continuation_token = get_history_page_args(request.args)
+        if continuation_token or not offset:
+            conversations, continuation_token = await current_app.cosmos_conversation_client.get_conversations_page(
+                user_id, page_size, continuation_token=continuation_token
+            )
+        else:
+            conversations = await current_app.cosmos_conversation_client.get_conversations(
+                user_id, offset=offset, limit=page_size
+            )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     if not isinstance(conversations, list):
         return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
     ## return the conversation ids
+    return await make_history_page_response(conversations, continuation_token)
+
+
+@bp.route("/history/summaries", methods=["GET"])
+async def list_conversation_summaries():
+    await cosmos_db_ready.wait()
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user["user_principal_id"]
 
-    return jsonify(conversations), 200
+    ## make sure cosmos is configured
+    if not current_app.cosmos_conversation_client:
+        raise Exception("CosmosDB is not configured or not working")
+
+    ## a page of conversations with what the history list shows; messages
+    ## are read with /history/read when a conversation is opened
+    try:
+        offset, page_size, continuation_token = get_history_page_args(request.args)
+        summaries, continuation_token = await current_app.cosmos_conversation_client.get_conversation_summaries(
+            user_id,
+            page_size,
+            continuation_token=continuation_token,
+            offset=offset,
+            count_messages=app_settings.chat_history.summary_message_counts
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return await make_history_page_response(summaries, continuation_token)
 
 
 @bp.route("/history/read", methods=["POST"])
@@ -749,23 +1375,28 @@ async def delete_all_conversations():
         if not current_app.cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
-        conversations = await current_app.cosmos_conversation_client.get_conversations(
-            user_id, offset=0, limit=None
-        )
-        if not conversations:
+        ## ids of every conversation and message of the user
+        item_ids = await current_app.cosmos_conversation_client.get_history_item_ids(user_id)
+        if not item_ids:
             return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
-        # delete each conversation
-        for conversation in conversations:
-            ## delete the conversation messages from cosmos first
-            deleted_messages = await current_app.cosmos_conversation_client.delete_messages(
-                conversation["id"], user_id
+        ## very large histories are deleted in the background
+        delete_jobs = getattr(current_app, "delete_jobs", None)
+        if delete_jobs and len(item_ids) > app_settings.chat_history.background_delete_threshold:
+            job = await delete_jobs.start(user_id, item_ids)
+            return (
+                jsonify(
+                    {
+                        "message": f"Deleting conversations and messages for user {user_id}",
+                        "job_id": job["id"],
+                        "status": job["status"],
+                        "total": job["total"],
+                    }
+                ),
+                202,
             )
 
-            ## Now delete the conversation
-            deleted_conversation = await current_app.cosmos_conversation_client.delete_conversation(
-                user_id, conversation["id"]
-            )
+        await current_app.cosmos_conversation_client.delete_items(user_id, item_ids)
         return (
             jsonify(
                 {
@@ -780,6 +1411,40 @@ async def delete_all_conversations():
         return jsonify({"error": str(e)}), 500
 
 
+@bp.route("/history/delete_status/<job_id>", methods=["GET"])
+async def delete_status(job_id):
+    await cosmos_db_ready.wait()
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user["user_principal_id"]
+
+    try:
+        ## make sure cosmos is configured
+        if not getattr(current_app, "delete_jobs", None):
+            raise Exception("CosmosDB is not configured or not working")
+
+        job = await current_app.delete_jobs.get(user_id, job_id)
+        if not job:
+            return jsonify({"error": f"Delete job {job_id} was not found"}), 404
+
+        return (
+            jsonify(
+                {
+                    "job_id": job["id"],
+                    "status": job["status"],
+                    "total": job["total"],
+                    "deleted": job["deleted"],
+                    "error": job.get("error"),
+                    "createdAt": job["createdAt"],
+                    "updatedAt": job["updatedAt"],
+                }
+            ),
+            200,
+        )
+    except Exception as e:
+        logging.exception("Exception in /history/delete_status")
+        return jsonify({"error": str(e)}), 500
+
+
 @bp.route("/history/clear", methods=["POST"])
 async def clear_messages():
     await cosmos_db_ready.wait()
@@ -803,6 +1468,9 @@ async def clear_messages():
         deleted_messages = await current_app.cosmos_conversation_client.delete_messages(
             conversation_id, user_id
         )
+        await current_app.cosmos_conversation_client.reset_cleared_conversation(
+            user_id, conversation_id
+        )
 
         return (
             jsonify(
@@ -859,7 +1527,7 @@ async def ensure_cosmos():
             return jsonify({"error": "CosmosDB is not working"}), 500
 
 
-async def generate_title(conversation_messages) -> str:
+async def generate_title(conversation_messages) -> Optional[str]:
     ## make sure the messages are sorted by _ts descending
     title_prompt = "Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Do not include any other commentary or description."
 
@@ -869,17 +1537,24 @@ async def generate_title(conversation_messages) -> str:
     ]
     messages.append({"role": "user", "content": title_prompt})
 
+    reservation = None
     try:
-        azure_openai_client = await init_openai_client()
+        reservation = await reserve_quota(messages, 64)
+        azure_openai_client = await get_openai_client()
         response = await azure_openai_client.chat.completions.create(
             model=app_settings.azure_openai.model, messages=messages, temperature=1, max_tokens=64
         )
+        if reservation:
+            reservation.settle(response.usage.total_tokens if response.usage else reservation.tokens)
 
         title = response.choices[0].message.content
         return title
     except Exception as e:
         logging.exception("Exception while generating title", e)
-        return messages[-2]["content"]
+        if reservation:
+            reservation.cancel(e)
+        # Keep the provisional title
+        return None
 
 
 app = create_app()
@@ -0,0 +1,196 @@
+import asyncio
+import math
+import time
+from collections import defaultdict, deque
+from typing import AsyncIterable
+
+# Weight of the newest request in the moving average of service time
+SERVICE_TIME_SMOOTHING = 0.2
+
+
+class AdmissionRejected(Exception):
+    status_code = 429
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Admission:
+    '''
+    A slot held by one admitted request. Releasing is idempotent, so the
+    slot can be handed to a streamed response and released when the stream
+    ends, is closed, or is garbage collected without ever being read.
+    '''
+
+    def __init__(self, controller: 'AdmissionController', user_id: str):
+        self.controller = controller
+        self.user_id = user_id
+        self.started_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller.release(self.user_id, time.monotonic() - self.started_at)
+
+    def hold(self, stream: AsyncIterable) -> '_AdmittedStream':
+        return _AdmittedStream(stream, self)
+
+
+class _AdmittedStream:
+    def __init__(self, stream: AsyncIterable, admission: Admission):
+        self._iterator = stream.__aiter__()
+        self._admission = admission
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self._iterator.__anext__()
+        except BaseException:
+            # StopAsyncIteration, an upstream error or a client disconnect
+            self._admission.release()
+            raise
+
+    async def aclose(self):
+        self._admission.release()
+        close = getattr(self._iterator, "aclose", None)
+        if close:
+            await close()
+
+    def __del__(self):
+        self._admission.release()
+
+
+class AdmissionController:
+    '''
+    Limits the chat requests a worker sends upstream at once, both overall
+    and per user. Requests over the limit wait in a bounded FIFO queue.
+    Requests that would wait longer than queue_timeout are rejected right
+    away with a Retry-After hint instead of piling up until the gunicorn
+    timeout.
+    '''
+
+    def __init__(
+        self,
+        max_in_flight: int = 32,
+        max_per_user: int = 4,
+        max_queue: int = 64,
+        queue_timeout: float = 10.0
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_queue_full = 0
+        self.rejected_deadline = 0
+        self.rejected_timeout = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.service_time = None
+        self._user_in_flight = defaultdict(int)
+        self._waiters = deque()
+
+    def _can_admit(self, user_id: str) -> bool:
+        return (
+            self.in_flight < self.max_in_flight and
+            self._user_in_flight.get(user_id, 0) < self.max_per_user
+        )
+
+    def _admit(self, user_id: str) -> Admission:
+        self.in_flight += 1
+        self._user_in_flight[user_id] += 1
+        self.admitted += 1
+        return Admission(self, user_id)
+
+    def _dispatch(self):
+        # Admit waiters in arrival order, skipping users that are at their
+        # own limit so they do not hold up everybody else
+        for waiter in list(self._waiters):
+            if self.in_flight >= self.max_in_flight:
+                break
+            user_id, future = waiter
+            if self._can_admit(user_id):
+                self._waiters.remove(waiter)
+                future.set_result(self._admit(user_id))
+
+    def estimate_wait(self, position: int) -> float:
+        # Requests ahead of this one drain max_in_flight at a time
+        if not self.service_time:
+            return 0.0
+        return math.ceil(position / self.max_in_flight) * self.service_time
+
+    def _reject(self, message: str, position: int) -> AdmissionRejected:
+        retry_after = max(1, math.ceil(self.estimate_wait(position) or self.queue_timeout))
+        return AdmissionRejected(message, retry_after)
+
+    async def acquire(self, user_id: str) -> Admission:
+        user_id = user_id or ""
+        if self._can_admit(user_id):
+            return self._admit(user_id)
+
+        position = len(self._waiters) + 1
+        if len(self._waiters) >= self.max_queue:
+            self.rejected_queue_full += 1
+            raise self._reject("Too many requests, please retry later", position)
+        if self.estimate_wait(position) > self.queue_timeout:
+            self.rejected_deadline += 1
+            raise self._reject("Too many requests, please retry later", position)
+
+        waiter = (user_id, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self.queued += 1
+        started = time.monotonic()
+        try:
+            admission = await asyncio.wait_for(asyncio.shield(waiter[1]), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter[1].done():
+                admission = waiter[1].result()
+            else:
+                self._waiters.remove(waiter)
+                self.rejected_timeout += 1
+                raise self._reject("Timed out waiting for capacity, please retry later", position)
+        except asyncio.CancelledError:
+            # The client went away; give back a slot that was already granted
+            if waiter[1].done():
+                waiter[1].result().release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+        finally:
+            wait_time = time.monotonic() - started
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+        return admission
+
+    def release(self, user_id: str, service_time: float):
+        self.in_flight -= 1
+        self._user_in_flight[user_id] -= 1
+        if not self._user_in_flight[user_id]:
+            del self._user_in_flight[user_id]
+
+        self.service_time = service_time if self.service_time is None else (
+            SERVICE_TIME_SMOOTHING * service_time +
+            (1 - SERVICE_TIME_SMOOTHING) * self.service_time
+        )
+        self._dispatch()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "queue_depth": len(self._waiters),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_deadline": self.rejected_deadline,
+            "rejected_timeout": self.rejected_timeout,
+            "average_wait_time": self.total_wait_time / self.queued if self.queued else 0.0,
+            "max_wait_time": self.max_wait_time,
+            "average_service_time": self.service_time or 0.0,
+        }
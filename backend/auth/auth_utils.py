@@ -1,3 +1,8 @@
+import base64
+import json
+import time
+
+
 def get_authenticated_user_details(request_headers):
     user_object = {}
 
@@ -17,4 +22,96 @@ def get_authenticated_user_details(request_headers):
     user_object['client_principal_b64'] = raw_user_object.get('X-Ms-Client-Principal')
     user_object['aad_id_token'] = raw_user_object.get('X-Ms-Token-Aad-Id-Token')
 
-    return user_object
\ No newline at end of file
+    return user_object
+
+
+GROUPS_CLAIM_TYPES = (
+    "groups",
+    "http://schemas.microsoft.com/ws/2008/06/identity/claims/groups",
+)
+OBJECT_ID_CLAIM_TYPES = (
+    "oid",
+    "http://schemas.microsoft.com/identity/claims/objectidentifier",
+)
+
+
+def _b64decode_json(value):
+    # Handles both the standard (X-Ms-Client-Principal) and the url-safe
+    # (JWT) alphabet, with or without padding
+    try:
+        return json.loads(base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)))
+    except (ValueError, TypeError):
+        return None
+
+
+def decode_client_principal(client_principal_b64):
+    ## returns the EasyAuth principal claims as {claim type: [values]}
+    if not client_principal_b64:
+        return None
+
+    principal = _b64decode_json(client_principal_b64)
+    if not isinstance(principal, dict):
+        return None
+
+    claims = {}
+    for claim in principal.get("claims") or []:
+        claims.setdefault(claim.get("typ"), []).append(claim.get("val"))
+    return claims
+
+
+def decode_jwt_claims(token):
+    ## returns the unverified payload of a JWT; the signature was already
+    ## checked by App Service authentication before the header was set
+    if not token or token.count(".") != 2:
+        return None
+
+    claims = _b64decode_json(token.split(".")[1])
+    return claims if isinstance(claims, dict) else None
+
+
+def _principal_groups(claims, principal_id):
+    object_ids = [v for t in OBJECT_ID_CLAIM_TYPES for v in claims.get(t, [])]
+    if principal_id not in object_ids:
+        return None
+
+    # Group overage: the token only links to Graph instead of listing groups
+    if "hasgroups" in claims or any("groups" in v for v in claims.get("_claim_names", [])):
+        return None
+
+    groups = [v for t in GROUPS_CLAIM_TYPES for v in claims.get(t, [])]
+    return groups or None
+
+
+def _id_token_groups(claims, principal_id):
+    if claims.get("oid") != principal_id or claims.get("exp", 0) <= time.time():
+        return None
+
+    if claims.get("hasgroups") or "groups" in (claims.get("_claim_names") or {}):
+        return None
+
+    groups = claims.get("groups")
+    return list(groups) if isinstance(groups, list) and groups else None
+
+
+def get_group_ids_from_claims(request_headers):
+    '''
+    Returns the user's group IDs from the EasyAuth principal or ID token
+    claims, or None when they have to be looked up in Microsoft Graph: no
+    App Service authentication, no groups claim, claims that do not belong
+    to the signed in user, an expired token, or group overage.
+    '''
+    principal_id = request_headers.get("X-Ms-Client-Principal-Id")
+    if not principal_id:
+        return None
+
+    principal_claims = decode_client_principal(request_headers.get("X-Ms-Client-Principal"))
+    if principal_claims:
+        groups = _principal_groups(principal_claims, principal_id)
+        if groups is not None:
+            return groups
+
+    id_token_claims = decode_jwt_claims(request_headers.get("X-Ms-Token-Aad-Id-Token"))
+    if id_token_claims:
+        return _id_token_groups(id_token_claims, principal_id)
+
+    return None
@@ -0,0 +1,219 @@
+import hashlib
+import importlib
+import json
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Optional
+
+# Model arguments that do not change the generated answer. "user" carries the
+# Defender payload (IP, conversation id) and must never split the cache.
+IGNORED_MODEL_ARGS = {"user", "stream"}
+
+
+class CacheBackend(ABC):
+    @abstractmethod
+    async def get(self, key: str) -> Optional[dict]:
+        pass
+
+    @abstractmethod
+    async def set(self, key: str, value: dict, ttl: float):
+        pass
+
+    def stats(self) -> dict:
+        return {}
+
+
+class InMemoryCacheBackend(CacheBackend):
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: dict, ttl: float):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "evictions": self.evictions,
+        }
+
+
+def load_cache_backend(backend: str, max_entries: int) -> CacheBackend:
+    '''
+    Resolve the RESPONSE_CACHE_BACKEND setting. "memory" selects the per-worker
+    LRU; anything else is a "package.module:ClassName" path to a shared backend.
+    '''
+    if backend == "memory":
+        return InMemoryCacheBackend(max_entries=max_entries)
+
+    module_name, _, class_name = backend.partition(":")
+    if not class_name:
+        raise ValueError(
+            f"RESPONSE_CACHE_BACKEND must be 'memory' or 'module:ClassName', got '{backend}'"
+        )
+    backend_class = getattr(importlib.import_module(module_name), class_name)
+    return backend_class()
+
+
+def make_cache_key(model_args: dict) -> str:
+    canonical_args = {
+        k: v for k, v in model_args.items() if k not in IGNORED_MODEL_ARGS
+    }
+    canonical_json = json.dumps(
+        canonical_args, sort_keys=True, separators=(",", ":"), default=str
+    )
+    return hashlib.sha256(canonical_json.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    '''
+    Exact-match cache of chat completions keyed on the canonical model
+    arguments, including the datasource payload and its per-user filter.
+    '''
+
+    def __init__(self, backend: CacheBackend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    async def get(self, key: str) -> Optional[dict]:
+        entry = await self.backend.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    async def set(self, key: str, entry: dict):
+        await self.backend.set(key, entry, self.ttl)
+        self.stores += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "backend": self.backend.stats(),
+        }
+
+
+def entry_from_completion(completion) -> Optional[dict]:
+    if len(completion.choices) == 0 or not completion.choices[0].message:
+        return None
+
+    message = completion.choices[0].message
+    entry = {
+        "id": completion.id,
+        "model": completion.model,
+        "created": completion.created,
+        "object": completion.object,
+        "content": message.content,
+    }
+    if hasattr(message, "context"):
+        entry["context"] = message.context
+
+    return entry
+
+
+async def record_stream(stream, on_complete):
+    '''
+    Pass the upstream chunks through unchanged and hand the assembled answer
+    to on_complete once the stream has been consumed to the end.
+    '''
+    entry = {"content": ""}
+    async for chunk in stream:
+        if chunk.id:
+            entry["id"] = chunk.id
+            entry["model"] = chunk.model
+            entry["created"] = chunk.created
+            entry["object"] = chunk.object
+
+        if len(chunk.choices) > 0 and chunk.choices[0].delta:
+            delta = chunk.choices[0].delta
+            if hasattr(delta, "context"):
+                entry["context"] = delta.context
+            if delta.content:
+                entry["content"] += delta.content
+
+        yield chunk
+
+    if entry.get("id") and entry["content"]:
+        await on_complete(entry)
+
+
+def new_completion_id() -> str:
+    # The answer's id becomes the id of the stored assistant message, so two
+    # answers must never share one
+    return f"chatcmpl-{uuid.uuid4().hex}"
+
+
+def _envelope(entry: dict) -> dict:
+    return {
+        "id": new_completion_id(),
+        "model": entry["model"],
+        "created": entry["created"],
+        "object": entry["object"],
+    }
+
+
+def replay_completion(entry: dict) -> SimpleNamespace:
+    '''
+    Rebuild a ChatCompletion-shaped object that format_non_streaming_response
+    can consume exactly like an upstream response, under a new id.
+    '''
+    message = SimpleNamespace(role="assistant", content=entry["content"])
+    if "context" in entry:
+        message.context = entry["context"]
+
+    return SimpleNamespace(
+        **_envelope(entry),
+        choices=[SimpleNamespace(message=message)]
+    )
+
+
+async def replay_stream(entry: dict):
+    '''
+    Yield ChatCompletionChunk-shaped objects so format_stream_response emits
+    the same NDJSON frames a live stream would, under a new id.
+    '''
+    envelope = _envelope(entry)
+    if "context" in entry:
+        context_delta = SimpleNamespace(
+            role="assistant", content=None, context=entry["context"]
+        )
+        yield SimpleNamespace(
+            **envelope,
+            choices=[SimpleNamespace(delta=context_delta)]
+        )
+
+    content_delta = SimpleNamespace(role="assistant", content=entry["content"])
+    yield SimpleNamespace(
+        **envelope,
+        choices=[SimpleNamespace(delta=content_delta)]
+    )
@@ -0,0 +1,190 @@
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import numpy as np
+
+from backend.cache.response_cache import make_cache_key
+
+EmbedFunction = Callable[[str], Awaitable[List[float]]]
+
+
+class AzureOpenAIEmbedder:
+    '''
+    Embeds text with the AZURE_OPENAI_EMBEDDING_* deployment, reusing the
+    pooled chat client (or its httpx pool) rather than opening new connections.
+    '''
+
+    def __init__(
+        self,
+        openai_client_manager,
+        embedding_name: str = None,
+        embedding_endpoint: str = None,
+        embedding_key: str = None
+    ):
+        if not embedding_name and not embedding_endpoint:
+            raise ValueError(
+                "AZURE_OPENAI_EMBEDDING_NAME or AZURE_OPENAI_EMBEDDING_ENDPOINT is required for the semantic cache"
+            )
+        if not embedding_name and not embedding_key and not openai_client_manager.token_cache:
+            raise ValueError(
+                "AZURE_OPENAI_EMBEDDING_KEY is required when Azure OpenAI uses key authentication"
+            )
+
+        self.openai_client_manager = openai_client_manager
+        self.embedding_name = embedding_name
+        self.embedding_endpoint = embedding_endpoint
+        self.embedding_key = embedding_key
+
+    async def __call__(self, text: str) -> List[float]:
+        if self.embedding_name:
+            response = await self.openai_client_manager.client.embeddings.create(
+                model=self.embedding_name, input=text
+            )
+            return response.data[0].embedding
+
+        if self.embedding_key:
+            headers = {"api-key": self.embedding_key}
+        else:
+            token = await self.openai_client_manager.token_cache.get_token()
+            headers = {"Authorization": f"Bearer {token}"}
+
+        response = await self.openai_client_manager.http_client.post(
+            self.embedding_endpoint, json={"input": text}, headers=headers
+        )
+        response.raise_for_status()
+        return response.json()["data"][0]["embedding"]
+
+
+def make_partition_key(model_args: dict) -> str:
+    # Everything but the conversation itself: model parameters, system
+    # message and the datasource payload with its per-user filter
+    partition_args = {k: v for k, v in model_args.items() if k != "messages"}
+    partition_args["system"] = [
+        m["content"] for m in model_args["messages"] if m["role"] == "system"
+    ]
+    return make_cache_key(partition_args)
+
+
+def get_standalone_question(messages: list) -> Optional[str]:
+    '''
+    Return the user question when it opens the conversation. Follow-up turns
+    depend on earlier answers, so they are never matched semantically.
+    '''
+    turns = [m for m in messages if m["role"] in ("user", "assistant")]
+    if len(turns) == 1 and turns[0]["role"] == "user" and isinstance(turns[0]["content"], str):
+        return turns[0]["content"]
+
+    return None
+
+
+class _Partition:
+    def __init__(self):
+        self.vectors = None
+        self.entries = []
+        self.expires_at = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def drop(self, count: int):
+        self.vectors = self.vectors[count:]
+        self.entries = self.entries[count:]
+        self.expires_at = self.expires_at[count:]
+
+    def purge_expired(self, now: float) -> int:
+        # Entries are appended in insertion order with the same TTL, so the
+        # expired ones always form a prefix
+        expired = 0
+        while expired < len(self.expires_at) and self.expires_at[expired] <= now:
+            expired += 1
+        if expired:
+            self.drop(expired)
+        return expired
+
+
+class SemanticCache:
+    '''
+    Serves answers to paraphrased questions by brute-force cosine similarity
+    over the embeddings of recently answered questions.
+
+    Entries are partitioned by a caller supplied key (the datasource payload,
+    including any per-user security filter), so a hit can only return an
+    answer grounded in the same documents.
+    '''
+
+    def __init__(
+        self,
+        embed: EmbedFunction,
+        similarity_threshold: float = 0.95,
+        max_entries: int = 500,
+        max_partitions: int = 100,
+        ttl: float = 3600
+    ):
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.max_partitions = max_partitions
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._partitions = OrderedDict()
+
+    async def embed_question(self, question: str) -> np.ndarray:
+        vector = np.asarray(await self.embed(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def search(self, partition_key: str, vector: np.ndarray) -> Optional[dict]:
+        partition = self._partitions.get(partition_key)
+        if partition is not None:
+            self.evictions += partition.purge_expired(time.monotonic())
+
+        if not partition:
+            self.misses += 1
+            return None
+
+        self._partitions.move_to_end(partition_key)
+        similarities = partition.vectors @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.similarity_threshold:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return partition.entries[best]
+
+    async def lookup(self, partition_key: str, question: str) -> Tuple[Optional[dict], np.ndarray]:
+        vector = await self.embed_question(question)
+        return self.search(partition_key, vector), vector
+
+    def add(self, partition_key: str, vector: np.ndarray, entry: dict):
+        partition = self._partitions.get(partition_key)
+        if partition is None:
+            partition = self._partitions[partition_key] = _Partition()
+            while len(self._partitions) > self.max_partitions:
+                _, evicted = self._partitions.popitem(last=False)
+                self.evictions += len(evicted)
+        self._partitions.move_to_end(partition_key)
+
+        row = vector.reshape(1, -1)
+        partition.vectors = row if partition.vectors is None else np.vstack([partition.vectors, row])
+        partition.entries.append(entry)
+        partition.expires_at.append(time.monotonic() + self.ttl)
+
+        if len(partition) > self.max_entries:
+            overflow = len(partition) - self.max_entries
+            partition.drop(overflow)
+            self.evictions += overflow
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "partitions": len(self._partitions),
+            "entries": sum(len(p) for p in self._partitions.values()),
+        }
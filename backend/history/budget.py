@@ -0,0 +1,130 @@
+import functools
+import logging
+from typing import List, Tuple
+
+import tiktoken
+
+# Tokens the chat format adds around every message (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Rough characters-per-token ratio used when no tiktoken encoding can be loaded
+FALLBACK_CHARS_PER_TOKEN = 4
+
+
+class TokenCounter:
+    '''
+    Counts tokens with tiktoken, caching results per message text so the
+    history of a long conversation is only tokenized once per worker.
+    '''
+
+    def __init__(self, encoding_name: str = "cl100k_base", cache_size: int = 4096):
+        try:
+            self.encoding = tiktoken.get_encoding(encoding_name)
+        except Exception:
+            logging.warning(
+                f"Could not load tiktoken encoding '{encoding_name}', estimating token counts from text length"
+            )
+            self.encoding = None
+
+        self.count = functools.lru_cache(maxsize=cache_size)(self._count)
+
+    def _count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self.encoding is None:
+            return len(text) // FALLBACK_CHARS_PER_TOKEN + 1
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+
+class HistoryBudgeter:
+    '''
+    Keeps the conversation sent to the model within a prompt token budget.
+
+    Messages use the request format, where assistant citations are still a
+    JSON string in "context". Old citation contexts are dropped first, then
+    the oldest turns; system messages and the latest user message are
+    always kept.
+    '''
+
+    def __init__(self, counter: TokenCounter, max_prompt_tokens: int):
+        self.counter = counter
+        self.max_prompt_tokens = max_prompt_tokens
+        self.requests = 0
+        self.trimmed_requests = 0
+        self.tokens_saved = 0
+        self.contexts_dropped = 0
+        self.messages_dropped = 0
+
+    def _content_tokens(self, message: dict) -> int:
+        content = message.get("content")
+        return MESSAGE_OVERHEAD_TOKENS + self.counter.count(
+            content if isinstance(content, str) else str(content)
+        )
+
+    def _context_tokens(self, message: dict) -> int:
+        return self.counter.count(message.get("context") or "")
+
+    def trim(self, messages: List[dict]) -> Tuple[List[dict], int]:
+        self.requests += 1
+        messages = [m for m in messages if m]
+        content_tokens = [self._content_tokens(m) for m in messages]
+        context_tokens = [self._context_tokens(m) for m in messages]
+        original_tokens = total = sum(content_tokens) + sum(context_tokens)
+        if total <= self.max_prompt_tokens:
+            return messages, 0
+
+        keep = [True] * len(messages)
+        keep_context = [True] * len(messages)
+        last_user = max(
+            (i for i, m in enumerate(messages) if m["role"] == "user"),
+            default=len(messages) - 1
+        )
+
+        # Citation contexts of earlier answers are the bulkiest and least
+        # useful part of the history, so they go first
+        for i in range(last_user):
+            if total <= self.max_prompt_tokens:
+                break
+            if context_tokens[i]:
+                keep_context[i] = False
+                total -= context_tokens[i]
+                self.contexts_dropped += 1
+
+        # Then drop whole messages, oldest first, and keep going until the
+        # history resumes on a user turn rather than an orphaned answer
+        for i in range(last_user):
+            if messages[i]["role"] == "system":
+                continue
+            if total <= self.max_prompt_tokens and messages[i]["role"] == "user":
+                break
+            keep[i] = False
+            total -= content_tokens[i] + (context_tokens[i] if keep_context[i] else 0)
+            self.messages_dropped += 1
+
+        trimmed = []
+        for i, message in enumerate(messages):
+            if not keep[i]:
+                continue
+            if not keep_context[i]:
+                message = {k: v for k, v in message.items() if k != "context"}
+            trimmed.append(message)
+
+        saved = original_tokens - total
+        self.trimmed_requests += 1
+        self.tokens_saved += saved
+        logging.debug(
+            f"Trimmed conversation history from {original_tokens} to {total} tokens ({saved} saved)"
+        )
+        return trimmed, saved
+
+    def stats(self) -> dict:
+        cache_info = self.counter.count.cache_info()
+        return {
+            "max_prompt_tokens": self.max_prompt_tokens,
+            "requests": self.requests,
+            "trimmed_requests": self.trimmed_requests,
+            "tokens_saved": self.tokens_saved,
+            "contexts_dropped": self.contexts_dropped,
+            "messages_dropped": self.messages_dropped,
+            "token_count_cache_hits": cache_info.hits,
+            "token_count_cache_misses": cache_info.misses,
+        }
@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime
+from typing import Awaitable, Callable, List, Optional
+
+from azure.cosmos import exceptions
+
+# Largest number of operations Cosmos DB accepts in one transactional batch
+MAX_BATCH_OPERATIONS = 100
+# Finished jobs are removed by Cosmos DB after a day if the container has TTL enabled
+JOB_TTL_SECONDS = 24 * 60 * 60
+PROGRESS_INTERVAL = 1.0
+
+
+async def _gather(*aws):
+    # Wait for every delete before raising, so none keeps running unobserved
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+class BulkDeleter:
+    '''
+    Deletes many chat history items of one user. Items are deleted in
+    transactional batches of up to max_batch_size items, with at most
+    max_concurrency requests per worker in flight. Items that are already
+    gone count as deleted.
+
+    A batch that fails because one item is already gone, and SDK versions
+    older than 4.7 without transactional batches, fall back to single-item
+    deletes under the same concurrency limit.
+    '''
+
+    def __init__(self, container_client, max_batch_size: int = MAX_BATCH_OPERATIONS, max_concurrency: int = 10):
+        self.container_client = container_client
+        self.max_batch_size = min(max_batch_size, MAX_BATCH_OPERATIONS)
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.deleted = 0
+        self.missing = 0
+        self.batches = 0
+        self.failures = 0
+        self._limit = asyncio.Semaphore(max_concurrency)
+
+    async def delete_items(
+        self,
+        user_id: str,
+        item_ids: List[str],
+        on_progress: Optional[Callable[[int], Awaitable[None]]] = None
+    ) -> int:
+        done = 0
+
+        async def delete_chunk(chunk):
+            nonlocal done
+            await self._delete_chunk(user_id, chunk)
+            done += len(chunk)
+            if on_progress:
+                await on_progress(done)
+
+        try:
+            await _gather(*(
+                delete_chunk(item_ids[i:i + self.max_batch_size])
+                for i in range(0, len(item_ids), self.max_batch_size)
+            ))
+        except Exception:
+            self.failures += 1
+            raise
+        return done
+
+    async def _delete_chunk(self, user_id: str, item_ids: List[str]):
+        execute_item_batch = getattr(self.container_client, "execute_item_batch", None)
+        if execute_item_batch is not None:
+            try:
+                async with self._limit:
+                    self.in_flight += 1
+                    try:
+                        await execute_item_batch(
+                            batch_operations=[("delete", (item_id,)) for item_id in item_ids],
+                            partition_key=user_id
+                        )
+                    finally:
+                        self.in_flight -= 1
+                self.batches += 1
+                self.deleted += len(item_ids)
+                return
+            except Exception as e:
+                # One item that is already gone fails the whole batch;
+                # delete the rest one by one
+                if getattr(e, "status_code", None) != 404:
+                    raise
+
+        await _gather(*(self._delete_one(user_id, item_id) for item_id in item_ids))
+
+    async def _delete_one(self, user_id: str, item_id: str):
+        async with self._limit:
+            self.in_flight += 1
+            try:
+                await self.container_client.delete_item(item=item_id, partition_key=user_id)
+                self.deleted += 1
+            except exceptions.CosmosResourceNotFoundError:
+                self.missing += 1
+            finally:
+                self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "deleted": self.deleted,
+            "missing": self.missing,
+            "batches": self.batches,
+            "failures": self.failures,
+        }
+
+
+class DeleteJobs:
+    '''
+    Runs large deletes in the background. Each job is stored as a
+    'deleteJob' document in the user's partition and its progress is
+    written to it at most every progress_interval seconds, so any worker
+    can report the status of a job started by another.
+    '''
+
+    def __init__(self, container_client, bulk_deleter: BulkDeleter, progress_interval: float = PROGRESS_INTERVAL):
+        self.container_client = container_client
+        self.bulk_deleter = bulk_deleter
+        self.progress_interval = progress_interval
+        self.started = 0
+        self.succeeded = 0
+        self.failed = 0
+        self._tasks = set()
+
+    async def start(self, user_id: str, item_ids: List[str]) -> dict:
+        now = datetime.utcnow().isoformat()
+        job = {
+            'id': str(uuid.uuid4()),
+            'type': 'deleteJob',
+            'userId': user_id,
+            'status': 'running',
+            'total': len(item_ids),
+            'deleted': 0,
+            'createdAt': now,
+            'updatedAt': now,
+            'ttl': JOB_TTL_SECONDS,
+        }
+        job = await self.container_client.upsert_item(job)
+        self.started += 1
+
+        task = asyncio.create_task(self._run(job, item_ids))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    async def get(self, user_id: str, job_id: str) -> Optional[dict]:
+        try:
+            job = await self.container_client.read_item(item=job_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+        if job.get('type') != 'deleteJob':
+            return None
+        return job
+
+    async def _update(self, job: dict, **fields):
+        fields['updatedAt'] = datetime.utcnow().isoformat()
+        await self.container_client.patch_item(
+            item=job['id'],
+            partition_key=job['userId'],
+            patch_operations=[
+                {'op': 'set', 'path': f'/{name}', 'value': value} for name, value in fields.items()
+            ]
+        )
+
+    async def _run(self, job: dict, item_ids: List[str]):
+        last_update = time.monotonic()
+
+        async def on_progress(deleted):
+            nonlocal last_update
+            if time.monotonic() - last_update < self.progress_interval:
+                return
+            last_update = time.monotonic()
+            try:
+                await self._update(job, deleted=deleted)
+            except Exception:
+                logging.warning(f"Failed to record progress of delete job {job['id']}")
+
+        try:
+            deleted = await self.bulk_deleter.delete_items(job['userId'], item_ids, on_progress)
+            result = dict(status='succeeded', deleted=deleted)
+            self.succeeded += 1
+        except asyncio.CancelledError:
+            self.failed += 1
+            await self._finish(job, status='failed', error='Interrupted by a server restart')
+            raise
+        except Exception as e:
+            self.failed += 1
+            logging.exception(f"Delete job {job['id']} failed")
+            result = dict(status='failed', error=str(e))
+        await self._finish(job, **result)
+
+    async def _finish(self, job: dict, **fields):
+        try:
+            await self._update(job, **fields)
+        except Exception:
+            logging.exception(f"Failed to record the result of delete job {job['id']}")
+
+    async def close(self):
+        # Deletes can take minutes; stop them instead of holding up shutdown.
+        # Running the delete again removes whatever is left.
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self._tasks),
+            "started": self.started,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+        }
@@ -1,11 +1,35 @@
+import base64
+import binascii
+import json
 import uuid
 from datetime import datetime
 from azure.cosmos.aio import CosmosClient
 from azure.cosmos import exceptions
+from backend.history.bulk_delete import BulkDeleter
+from backend.history.write_behind import WriteBehindBuffer
+
+MESSAGE_PREVIEW_LENGTH = 100
+
+
+def _encode_continuation_token(token):
+    ## callers get an opaque, URL safe token
+    if not token:
+        return None
+    return base64.urlsafe_b64encode(token.encode()).decode()
+
+
+def _decode_continuation_token(token):
+    if not token:
+        return None
+    try:
+        return base64.urlsafe_b64decode(token.encode()).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError("Invalid continuation token")
+
   
 class CosmosConversationClient():
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False, write_behind_options: dict = None, delete_concurrency: int = 10):
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
@@ -28,7 +52,22 @@ class CosmosConversationClient():
             self.container_client = self.database_client.get_container_client(container_name)
         except exceptions.CosmosResourceNotFoundError:
             raise ValueError("Invalid CosmosDB container name") 
-        
+
+        ## optional per-worker write-behind queue for message writes
+        self.write_buffer = None
+        if write_behind_options is not None:
+            self.write_buffer = WriteBehindBuffer(self.container_client, **write_behind_options)
+
+        self.bulk_deleter = BulkDeleter(self.container_client, max_concurrency=delete_concurrency)
+
+    async def _read_own_writes(self, user_id):
+        if self.write_buffer:
+            await self.write_buffer.flush(user_id)
+
+    async def close(self):
+        if self.write_buffer:
+            await self.write_buffer.close()
+        await self.cosmosdb_client.close()
 
     async def ensure(self):
         if not self.cosmosdb_client or not self.database_client or not self.container_client:
@@ -68,27 +107,122 @@ class CosmosConversationClient():
         else:
             return False
 
+    async def update_conversation_summary(self, user_id, conversation_id, summary):
+        resp = await self.container_client.patch_item(
+            item=conversation_id,
+            partition_key=user_id,
+            patch_operations=[
+                {'op': 'set', 'path': '/summary', 'value': summary}
+            ]
+        )
+        if resp:
+            return resp
+        else:
+            return False
+
+    async def update_conversation_title(self, user_id, conversation_id, title, expected_title=None):
+        ## only replace expected_title, so a rename by the user is kept
+        kwargs = {}
+        if expected_title is not None:
+            kwargs["filter_predicate"] = f"from c where c.title = {json.dumps(expected_title)}"
+        try:
+            resp = await self.container_client.patch_item(
+                item=conversation_id,
+                partition_key=user_id,
+                patch_operations=[
+                    {'op': 'set', 'path': '/title', 'value': title}
+                ],
+                **kwargs
+            )
+        except exceptions.CosmosHttpResponseError as e:
+            if e.status_code == 412:
+                return False
+            raise
+        if resp:
+            return resp
+        else:
+            return False
+
+    async def reset_cleared_conversation(self, user_id, conversation_id):
+        ## the preview and the rolling summary describe messages that were deleted;
+        ## set rather than remove, since removing a missing path fails the patch
+        try:
+            resp = await self.container_client.patch_item(
+                item=conversation_id,
+                partition_key=user_id,
+                patch_operations=[
+                    {'op': 'set', 'path': '/lastMessagePreview', 'value': None},
+                    {'op': 'set', 'path': '/summary', 'value': None}
+                ]
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            return False
+        if resp:
+            return resp
+        else:
+            return False
+
     async def delete_conversation(self, user_id, conversation_id):
-        conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)        
-        if conversation:
+        await self._read_own_writes(user_id)
+        ## a conversation that does not exist counts as deleted; the id of
+        ## any other item in the partition is left alone
+        try:
+            conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)
+            if conversation.get('type') != 'conversation':
+                return False
             resp = await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
             return resp
-        else:
+        except exceptions.CosmosResourceNotFoundError:
             return True
 
         
     async def delete_messages(self, conversation_id, user_id):
-        ## get a list of all the messages in the conversation
-        messages = await self.get_messages(user_id, conversation_id)
-        response_list = []
-        if messages:
-            for message in messages:
-                resp = await self.container_client.delete_item(item=message['id'], partition_key=user_id)
-                response_list.append(resp)
-            return response_list
+        await self._read_own_writes(user_id)
+        ## get the ids of all the messages in the conversation
+        parameters = [
+            {
+                'name': '@conversationId',
+                'value': conversation_id
+            },
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = f"SELECT VALUE c.id FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId"
+        message_ids = []
+        async for item in self.container_client.query_items(query=query, parameters=parameters):
+            message_ids.append(item)
+
+        ## returns the number of deleted messages
+        return await self.bulk_deleter.delete_items(user_id, message_ids)
+
+    async def get_history_item_ids(self, user_id):
+        await self._read_own_writes(user_id)
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        ## conversations first, so they disappear from the history list before their messages are deleted
+        query = f"SELECT c.id, c.type FROM c WHERE c.userId = @userId AND (c.type='conversation' OR c.type='message')"
+        conversation_ids = []
+        message_ids = []
+        async for item in self.container_client.query_items(query=query, parameters=parameters):
+            if item['type'] == 'conversation':
+                conversation_ids.append(item['id'])
+            else:
+                message_ids.append(item['id'])
+
+        return conversation_ids + message_ids
+
+    async def delete_items(self, user_id, item_ids, on_progress=None):
+        return await self.bulk_deleter.delete_items(user_id, item_ids, on_progress)
 
 
     async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        await self._read_own_writes(user_id)
         parameters = [
             {
                 'name': '@userId',
@@ -105,29 +239,106 @@ class CosmosConversationClient():
         
         return conversations
 
-    async def get_conversation(self, user_id, conversation_id):
+    async def get_conversations_page(self, user_id, page_size, continuation_token=None, sort_order = 'DESC'):
+        await self._read_own_writes(user_id)
         parameters = [
             {
-                'name': '@conversationId',
-                'value': conversation_id
-            },
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
+        return await self._query_page(query, parameters, user_id, page_size, continuation_token)
+
+    async def get_conversation_summaries(self, user_id, page_size, continuation_token=None, offset=0, count_messages=False):
+        await self._read_own_writes(user_id)
+        parameters = [
             {
                 'name': '@userId',
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
-        conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
-            conversations.append(item)
+        ## only the fields the history list shows, not the whole documents
+        query = f"SELECT c.id, c.title, c.createdAt, c.updatedAt, c.lastMessagePreview FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt DESC"
+        if offset and not continuation_token:
+            query += f" offset {int(offset)} limit {int(page_size)}"
+            summaries = []
+            async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
+                summaries.append(item)
+        else:
+            summaries, continuation_token = await self._query_page(query, parameters, user_id, page_size, continuation_token)
+
+        for summary in summaries:
+            summary.setdefault('lastMessagePreview', None)
+
+        ## counting costs a second query, so it is only done when asked for;
+        ## the messages of the whole page are counted at once
+        if count_messages:
+            message_counts = await self._count_messages(user_id, [summary['id'] for summary in summaries])
+            for summary in summaries:
+                summary['messageCount'] = message_counts.get(summary['id'], 0)
+
+        return summaries, continuation_token
+
+    async def _count_messages(self, user_id, conversation_ids):
+        if not conversation_ids:
+            return {}
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            },
+            {
+                'name': '@conversationIds',
+                'value': conversation_ids
+            }
+        ]
+        ## tool messages hold citations and are not shown as messages
+        query = f"SELECT c.conversationId, COUNT(1) AS messageCount FROM c WHERE c.userId = @userId AND c.type='message' AND c.role != 'tool' AND ARRAY_CONTAINS(@conversationIds, c.conversationId) GROUP BY c.conversationId"
+        message_counts = {}
+        async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
+            message_counts[item['conversationId']] = item['messageCount']
+
+        return message_counts
+
+    async def _query_page(self, query, parameters, user_id, page_size, continuation_token):
+        ## the query resumes where the previous page ended instead of skipping rows like offset does
+        pages = self.container_client.query_items(
+            query=query,
+            parameters=parameters,
+            partition_key=user_id,
+            max_item_count=page_size
+        ).by_page(_decode_continuation_token(continuation_token))
+
+        items = []
+        try:
+            async for page in pages:
+                async for item in page:
+                    items.append(item)
+                if items:
+                    break
+        except exceptions.CosmosHttpResponseError as e:
+            ## cosmos rejects continuation tokens it did not issue
+            if e.status_code == 400 and continuation_token:
+                raise ValueError("Invalid continuation token") from e
+            raise
+
+        return items, _encode_continuation_token(pages.continuation_token)
 
-        ## if no conversations are found, return None
-        if len(conversations) == 0:
+    async def get_conversation(self, user_id, conversation_id):
+        await self._read_own_writes(user_id)
+        ## id and partition key are both known, so a point read is enough
+        try:
+            conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
             return None
-        else:
-            return conversations[0]
+
+        ## if no conversation is found, return None
+        if conversation.get('type') != 'conversation':
+            return None
+        return conversation
  
-    async def create_message(self, uuid, conversation_id, user_id, input_message: dict):
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict, write_behind: bool = True):
         message = {
             'id': uuid,
             'type': 'message',
@@ -141,29 +352,89 @@ class CosmosConversationClient():
 
         if self.enable_message_feedback:
             message['feedback'] = ''
+
+        ## bump the parent conversation's updatedAt field, and keep a preview of
+        ## the latest message on it for the history list
+        touch_conversation = [
+            {'op': 'set', 'path': '/updatedAt', 'value': message['createdAt']}
+        ]
+        if message['role'] in ('user', 'assistant') and isinstance(message['content'], str):
+            touch_conversation.append(
+                {'op': 'set', 'path': '/lastMessagePreview', 'value': message['content'][:MESSAGE_PREVIEW_LENGTH]}
+            )
+
+        if self.write_buffer and write_behind:
+            ## queued writes are checked when they are flushed, so a message for a
+            ## missing conversation is only reported in the logs
+            await self.write_buffer.upsert(user_id, message)
+            await self.write_buffer.patch(user_id, conversation_id, touch_conversation)
+            return message
+
+        ## a write that must be stored before the caller goes on skips the
+        ## queue; earlier queued writes of the user go first to keep the order
+        await self._read_own_writes(user_id)
         
-        resp = await self.container_client.upsert_item(message)  
+        ## write the message and touch the conversation in one round trip;
+        ## a missing conversation fails the patch with a 404
+        execute_item_batch = getattr(self.container_client, "execute_item_batch", None)
+        if execute_item_batch:
+            ## transactional batch: nothing is written if the conversation is missing
+            try:
+                await execute_item_batch(
+                    batch_operations=[
+                        ("patch", (conversation_id, touch_conversation)),
+                        ("upsert", (message,)),
+                    ],
+                    partition_key=user_id
+                )
+            except Exception as e:
+                if getattr(e, "status_code", None) == 404:
+                    return "Conversation not found"
+                raise
+            return message
+
+        ## without batches the conversation is touched first, so a missing
+        ## conversation never leaves an orphaned message behind
+        try:
+            await self.container_client.patch_item(
+                item=conversation_id,
+                partition_key=user_id,
+                patch_operations=touch_conversation
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            return "Conversation not found"
+        resp = await self.container_client.upsert_item(message)
         if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
-            if not conversation:
-                return "Conversation not found"
-            conversation['updatedAt'] = message['createdAt']
-            await self.upsert_conversation(conversation)
             return resp
         else:
             return False
     
     async def update_message_feedback(self, user_id, message_id, feedback):
-        message = await self.container_client.read_item(item=message_id, partition_key=user_id)
-        if message:
-            message['feedback'] = feedback
-            resp = await self.container_client.upsert_item(message)
+        await self._read_own_writes(user_id)
+        ## patch the feedback field in place instead of reading and rewriting the message;
+        ## the predicate keeps the patch off conversations and other items
+        try:
+            resp = await self.container_client.patch_item(
+                item=message_id,
+                partition_key=user_id,
+                patch_operations=[
+                    {'op': 'set', 'path': '/feedback', 'value': feedback}
+                ],
+                filter_predicate="FROM c WHERE c.type = 'message'"
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            return False
+        except exceptions.CosmosHttpResponseError as e:
+            if e.status_code == 412:
+                return False
+            raise
+        if resp:
             return resp
         else:
             return False
 
     async def get_messages(self, user_id, conversation_id):
+        await self._read_own_writes(user_id)
         parameters = [
             {
                 'name': '@conversationId',
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import uuid
+from typing import Optional
+
+
+def tool_message_id(message_id: str) -> str:
+    '''
+    Id of the tool message stored with an assistant message. Derived from
+    the assistant message id so storing the same reply twice (by the server
+    and again through /history/update) replaces it instead of adding a
+    second copy.
+    '''
+    return str(uuid.uuid5(uuid.NAMESPACE_OID, f"{message_id}/tool"))
+
+
+class _Reply:
+    def __init__(self):
+        self.message_id = None
+        self.tool_content = None
+        self.content = []
+
+    def add(self, response_obj: dict):
+        if not response_obj or "error" in response_obj:
+            return
+        for message in response_obj.get("choices", [{}])[0].get("messages", []):
+            if message.get("role") == "tool":
+                self.tool_content = message.get("content")
+            elif message.get("role") == "assistant" and message.get("content"):
+                self.message_id = response_obj.get("id")
+                self.content.append(message["content"])
+
+
+class ReplySaver:
+    '''
+    Stores the assistant reply of /history/generate, and the tool message
+    with its citations, once it has been sent, so the browser does not have
+    to post the whole answer back to /history/update. Replies are written
+    in the background after the response has finished.
+    '''
+
+    def __init__(self, conversation_client):
+        self.conversation_client = conversation_client
+        self.replies_saved = 0
+        self.failures = 0
+        self._tasks = set()
+
+    async def collect(self, stream, user_id: str, conversation_id: str):
+        '''
+        Pass a stream of format_stream_response frames through and save the
+        reply once the stream has completed. A stream that is closed early,
+        when the user stops the answer, saves the part that was sent. Failed
+        streams are not saved.
+        '''
+        reply = _Reply()
+        try:
+            async for response_obj in stream:
+                reply.add(response_obj)
+                yield response_obj
+        except (GeneratorExit, asyncio.CancelledError):
+            self._schedule(reply, user_id, conversation_id)
+            raise
+
+        self._schedule(reply, user_id, conversation_id)
+
+    def save_response(self, response_obj: dict, user_id: str, conversation_id: str):
+        reply = _Reply()
+        reply.add(response_obj)
+        self._schedule(reply, user_id, conversation_id)
+
+    def _schedule(self, reply: _Reply, user_id: str, conversation_id: str) -> Optional[asyncio.Task]:
+        if not reply.content or not reply.message_id:
+            return None
+
+        task = asyncio.create_task(self._save(reply, user_id, conversation_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _save(self, reply: _Reply, user_id: str, conversation_id: str):
+        try:
+            if reply.tool_content:
+                # write the tool message first
+                await self.conversation_client.create_message(
+                    uuid=tool_message_id(reply.message_id),
+                    conversation_id=conversation_id,
+                    user_id=user_id,
+                    input_message={"role": "tool", "content": reply.tool_content},
+                )
+            await self.conversation_client.create_message(
+                uuid=reply.message_id,
+                conversation_id=conversation_id,
+                user_id=user_id,
+                input_message={"role": "assistant", "content": "".join(reply.content)},
+            )
+            self.replies_saved += 1
+        except Exception:
+            self.failures += 1
+            logging.exception(f"Failed to save reply to conversation {conversation_id}")
+
+    async def close(self):
+        # Let pending writes finish so replies are not lost on shutdown
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "in_progress": len(self._tasks),
+            "replies_saved": self.replies_saved,
+            "failures": self.failures,
+        }
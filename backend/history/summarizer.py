@@ -0,0 +1,159 @@
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+from typing import List, Optional
+
+SUMMARY_PROMPT = "Summarize the conversation below so it can replace the original messages as context for future answers. Keep names, numbers, decisions and open questions. Be concise and do not add commentary."
+SUMMARY_MESSAGE_PREFIX = "Summary of the earlier conversation:\n"
+
+
+def _turns(messages: List[dict]) -> List[dict]:
+    return [m for m in messages if m and m.get("role") in ("user", "assistant")]
+
+
+class ConversationSummarizer(ABC):
+    @abstractmethod
+    async def summarize(self, previous_summary: Optional[str], messages: List[dict]) -> str:
+        pass
+
+
+class AzureOpenAISummarizer(ConversationSummarizer):
+    '''
+    Summarizes with a chat completion. reserve_quota(messages, max_tokens),
+    when given, returns a quota reservation (or None) so summaries are
+    paced against the same deployment quota as chat requests.
+    '''
+
+    def __init__(self, get_client, model: str, max_tokens: int = 400, reserve_quota=None):
+        self.get_client = get_client
+        self.model = model
+        self.max_tokens = max_tokens
+        self.reserve_quota = reserve_quota
+
+    async def summarize(self, previous_summary: Optional[str], messages: List[dict]) -> str:
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        if previous_summary:
+            transcript = f"{SUMMARY_MESSAGE_PREFIX}{previous_summary}\n\n{transcript}"
+        prompt = [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript},
+        ]
+
+        reservation = await self.reserve_quota(prompt, self.max_tokens) if self.reserve_quota else None
+        try:
+            azure_openai_client = await self.get_client()
+            response = await azure_openai_client.chat.completions.create(
+                model=self.model,
+                messages=prompt,
+                temperature=0,
+                max_tokens=self.max_tokens
+            )
+        except Exception as e:
+            if reservation:
+                reservation.cancel(e)
+            raise
+
+        if reservation:
+            reservation.settle(response.usage.total_tokens if response.usage else reservation.tokens)
+        return response.choices[0].message.content
+
+
+def apply_conversation_summary(messages: List[dict], summary: Optional[dict]) -> List[dict]:
+    '''
+    Replace the turns covered by a stored summary with a single system
+    message. System messages and everything after the covered turns are
+    passed through unchanged.
+    '''
+    if not summary or not summary.get("content"):
+        return messages
+
+    covered_turns = summary.get("coveredTurns", 0)
+    if covered_turns <= 0 or covered_turns >= len(_turns(messages)):
+        return messages
+
+    compacted = []
+    summary_message = {
+        "role": "system",
+        "content": SUMMARY_MESSAGE_PREFIX + summary["content"]
+    }
+    seen_turns = 0
+    for message in messages:
+        if message and message.get("role") in ("user", "assistant"):
+            seen_turns += 1
+            if seen_turns == covered_turns + 1:
+                compacted.append(summary_message)
+        if seen_turns <= covered_turns and message and message.get("role") != "system":
+            # Covered turns and the tool messages that belong to them
+            continue
+        compacted.append(message)
+
+    return compacted
+
+
+class RollingSummarizer:
+    '''
+    Compacts long conversations in the background. Once a conversation has
+    more than threshold_turns unsummarized turns, everything but the newest
+    keep_recent_turns is folded into the summary stored on the conversation.
+    '''
+
+    def __init__(
+        self,
+        summarizer: ConversationSummarizer,
+        conversation_client,
+        threshold_turns: int = 20,
+        keep_recent_turns: int = 6
+    ):
+        self.summarizer = summarizer
+        self.conversation_client = conversation_client
+        self.threshold_turns = threshold_turns
+        self.keep_recent_turns = keep_recent_turns
+        self.summaries_written = 0
+        self.failures = 0
+        self._tasks = {}
+
+    def needs_summary(self, messages: List[dict], summary: Optional[dict]) -> bool:
+        covered_turns = (summary or {}).get("coveredTurns", 0)
+        return len(_turns(messages)) - covered_turns > self.threshold_turns
+
+    def schedule(self, user_id: str, conversation_id: str, messages: List[dict], summary: Optional[dict]):
+        if conversation_id in self._tasks or not self.needs_summary(messages, summary):
+            return None
+
+        task = asyncio.create_task(
+            self._summarize(user_id, conversation_id, messages, summary)
+        )
+        self._tasks[conversation_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(conversation_id, None))
+        return task
+
+    async def _summarize(self, user_id: str, conversation_id: str, messages: List[dict], summary: Optional[dict]):
+        turns = _turns(messages)
+        covered_turns = (summary or {}).get("coveredTurns", 0)
+        new_covered_turns = len(turns) - self.keep_recent_turns
+        try:
+            content = await self.summarizer.summarize(
+                (summary or {}).get("content"),
+                turns[covered_turns:new_covered_turns]
+            )
+            await self.conversation_client.update_conversation_summary(
+                user_id,
+                conversation_id,
+                {"content": content, "coveredTurns": new_covered_turns}
+            )
+            self.summaries_written += 1
+        except Exception:
+            self.failures += 1
+            logging.exception(f"Failed to summarize conversation {conversation_id}")
+
+    async def close(self):
+        # Let in-progress summaries finish so their work is not lost on shutdown
+        if self._tasks:
+            await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "in_progress": len(self._tasks),
+            "summaries_written": self.summaries_written,
+            "failures": self.failures,
+        }
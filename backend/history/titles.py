@@ -0,0 +1,114 @@
+import asyncio
+import logging
+import re
+from typing import Awaitable, Callable, List, Optional
+
+PROVISIONAL_TITLE_MAX_WORDS = 6
+PROVISIONAL_TITLE_MAX_LENGTH = 60
+DEFAULT_TITLE = "New chat"
+
+
+def provisional_title(messages: List[dict]) -> str:
+    '''
+    A title taken from the first words of the latest user message, used
+    until the generated title is ready.
+    '''
+    content = next(
+        (m.get("content") for m in reversed(messages) if m and m.get("role") == "user"),
+        None
+    )
+    if not isinstance(content, str):
+        return DEFAULT_TITLE
+
+    words = re.sub(r"[^\w\s'-]", " ", content).split()
+    title = " ".join(words[:PROVISIONAL_TITLE_MAX_WORDS])[:PROVISIONAL_TITLE_MAX_LENGTH].strip()
+    return title or DEFAULT_TITLE
+
+
+class ConversationTitler:
+    '''
+    Generates conversation titles in the background so a new conversation
+    does not wait for an extra chat completion before its answer starts.
+
+    The conversation is created with a provisional title. Once the generated
+    title is ready it is written to the conversation, unless the user has
+    renamed it in the meantime, and to the history_metadata returned with
+    the answer.
+    '''
+
+    def __init__(
+        self,
+        generate_title: Callable[[List[dict]], Awaitable[Optional[str]]],
+        conversation_client,
+        wait_timeout: float = 2.0
+    ):
+        self.generate_title = generate_title
+        self.conversation_client = conversation_client
+        self.wait_timeout = wait_timeout
+        self.titles_written = 0
+        self.late_titles = 0
+        self.failures = 0
+        self._tasks = set()
+
+    def schedule(self, user_id: str, conversation_id: str, messages: List[dict], history_metadata: dict):
+        task = asyncio.create_task(
+            self._generate(user_id, conversation_id, messages, history_metadata)
+        )
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _generate(self, user_id: str, conversation_id: str, messages: List[dict], history_metadata: dict):
+        provisional = history_metadata.get("title")
+        try:
+            title = await self.generate_title(messages)
+            if not title or title == provisional:
+                return
+
+            updated = await self.conversation_client.update_conversation_title(
+                user_id, conversation_id, title, provisional
+            )
+            if not updated:
+                return
+            history_metadata["title"] = title
+            self.titles_written += 1
+        except Exception:
+            self.failures += 1
+            logging.exception(f"Failed to update title of conversation {conversation_id}")
+
+    async def wait(self, task: Optional[asyncio.Task]):
+        # Give a title that is almost ready the chance to reach the answer;
+        # a late one still reaches the stored conversation
+        if task is None or task.done():
+            return
+        done, _ = await asyncio.wait({task}, timeout=self.wait_timeout)
+        if not done:
+            self.late_titles += 1
+
+    async def hold_last_frame(self, stream, task: Optional[asyncio.Task]):
+        '''
+        Pass a response stream through, holding back its last frame until
+        the title is ready (or wait_timeout has passed). The frames share
+        the history_metadata dict the title is written to.
+        '''
+        previous = None
+        async for frame in stream:
+            if previous is not None:
+                yield previous
+            previous = frame
+
+        await self.wait(task)
+        if previous is not None:
+            yield previous
+
+    async def close(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self) -> dict:
+        return {
+            "in_progress": len(self._tasks),
+            "titles_written": self.titles_written,
+            "late_titles": self.late_titles,
+            "failures": self.failures,
+        }
@@ -0,0 +1,228 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from azure.cosmos import exceptions
+
+# Largest number of operations Cosmos DB accepts in one transactional batch
+MAX_BATCH_OPERATIONS = 100
+MAX_ATTEMPTS = 3
+
+
+class _Operation:
+    def __init__(self, kind: str, item_id: str, args: tuple):
+        self.kind = kind
+        self.item_id = item_id
+        self.args = args
+        self.attempts = 0
+
+    @property
+    def key(self) -> Tuple[str, str]:
+        # A newer write to the same item replaces a queued one
+        return (self.kind, self.item_id)
+
+
+class WriteBehindBuffer:
+    '''
+    Queues chat history writes per worker and writes them in the background.
+
+    Writes are grouped by partition key (userId) and sent as transactional
+    batches once a user has max_batch_size writes queued or flush_interval
+    has passed, and on shutdown. When max_queue writes are waiting, new
+    writes wait for a flush (backpressure) instead of growing the queue.
+    Callers flush a user's writes before reading that user's data, so each
+    worker reads its own writes.
+
+    SDK versions without transactional batch support fall back to
+    concurrent single-item writes per user.
+    '''
+
+    def __init__(
+        self,
+        container_client,
+        max_batch_size: int = MAX_BATCH_OPERATIONS,
+        flush_interval: float = 0.2,
+        max_queue: int = 1000
+    ):
+        self.container_client = container_client
+        self.max_batch_size = min(max_batch_size, MAX_BATCH_OPERATIONS)
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.queued = 0
+        self.written = 0
+        self.batches = 0
+        self.flushes = 0
+        self.failures = 0
+        self.dropped = 0
+        self.backpressure_waits = 0
+        self.total_flush_time = 0.0
+        self.max_flush_time = 0.0
+        self._pending: Dict[str, OrderedDict] = {}
+        self._depth = 0
+        self._flushing: Dict[str, asyncio.Task] = {}
+        self._space = asyncio.Condition()
+        self._flush_loop = None
+        self._closed = False
+
+    def _start(self):
+        if self._flush_loop is None:
+            self._flush_loop = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("Failed to flush chat history writes")
+
+    async def upsert(self, user_id: str, item: dict):
+        await self._enqueue(user_id, _Operation("upsert", item["id"], (item,)))
+
+    async def patch(self, user_id: str, item_id: str, patch_operations: List[dict]):
+        await self._enqueue(user_id, _Operation("patch", item_id, (item_id, patch_operations)))
+
+    async def _enqueue(self, user_id: str, operation: _Operation):
+        if self._closed:
+            raise RuntimeError("Chat history write buffer is closed")
+        self._start()
+
+        async with self._space:
+            if self._depth >= self.max_queue:
+                self.backpressure_waits += 1
+                asyncio.ensure_future(self.flush())
+                await self._space.wait_for(lambda: self._depth < self.max_queue)
+
+            operations = self._pending.setdefault(user_id, OrderedDict())
+            if operations.pop(operation.key, None) is None:
+                self._depth += 1
+            operations[operation.key] = operation
+            self.queued += 1
+            full = len(operations) >= self.max_batch_size
+
+        if full:
+            asyncio.ensure_future(self.flush(user_id))
+
+    async def flush(self, user_id: Optional[str] = None):
+        user_ids = [user_id] if user_id is not None else list(self._pending)
+        tasks = [self._flush_user(u) for u in user_ids]
+        if user_id is None:
+            tasks.extend(asyncio.shield(t) for t in list(self._flushing.values()))
+        await asyncio.gather(*tasks)
+
+    async def _flush_user(self, user_id: str):
+        previous = self._flushing.get(user_id)
+        operations = self._pending.pop(user_id, None)
+        if operations:
+            task = asyncio.ensure_future(self._write(user_id, previous, list(operations.values())))
+            self._flushing[user_id] = task
+            task.add_done_callback(
+                lambda t: self._flushing.pop(user_id, None) if self._flushing.get(user_id) is t else None
+            )
+        else:
+            task = previous
+
+        if task is not None:
+            await asyncio.shield(task)
+
+    async def _write(self, user_id: str, previous: Optional[asyncio.Task], operations: List[_Operation]):
+        # Keep each user's writes in order
+        if previous is not None:
+            await asyncio.gather(asyncio.shield(previous), return_exceptions=True)
+
+        started = time.monotonic()
+        failed = []
+        try:
+            for i in range(0, len(operations), self.max_batch_size):
+                chunk = operations[i:i + self.max_batch_size]
+                try:
+                    await self._write_batch(user_id, chunk)
+                    self.written += len(chunk)
+                except Exception:
+                    logging.exception(f"Failed to write {len(chunk)} chat history items")
+                    self.failures += 1
+                    failed.extend(chunk)
+                self.batches += 1
+        finally:
+            flush_time = time.monotonic() - started
+            self.flushes += 1
+            self.total_flush_time += flush_time
+            self.max_flush_time = max(self.max_flush_time, flush_time)
+            await self._requeue(user_id, failed, len(operations))
+
+    async def _write_batch(self, user_id: str, operations: List[_Operation]):
+        execute_item_batch = getattr(self.container_client, "execute_item_batch", None)
+        if execute_item_batch is None:
+            await asyncio.gather(*(self._write_one(user_id, op) for op in operations))
+            return
+
+        try:
+            await execute_item_batch(
+                batch_operations=[(op.kind, op.args) for op in operations],
+                partition_key=user_id
+            )
+        except Exception as e:
+            # One missing document fails the whole batch; write the rest
+            # one by one so only the missing one is dropped
+            if getattr(e, "status_code", None) != 404:
+                raise
+            await asyncio.gather(*(self._write_one(user_id, op) for op in operations))
+
+    async def _write_one(self, user_id: str, operation: _Operation):
+        try:
+            if operation.kind == "upsert":
+                await self.container_client.upsert_item(*operation.args)
+            else:
+                item_id, patch_operations = operation.args
+                await self.container_client.patch_item(
+                    item=item_id, partition_key=user_id, patch_operations=patch_operations
+                )
+        except exceptions.CosmosResourceNotFoundError:
+            self.dropped += 1
+            logging.warning(f"Dropping {operation.kind} of missing chat history item {operation.item_id}")
+
+    async def _requeue(self, user_id: str, failed: List[_Operation], flushed: int):
+        async with self._space:
+            self._depth -= flushed
+            retry = OrderedDict()
+            for operation in failed:
+                operation.attempts += 1
+                newer = self._pending.get(user_id, {})
+                if operation.key in newer:
+                    continue
+                if operation.attempts >= MAX_ATTEMPTS:
+                    self.dropped += 1
+                    logging.error(f"Dropping {operation.kind} of chat history item {operation.item_id}")
+                    continue
+                retry[operation.key] = operation
+            if retry:
+                # Failed writes go back ahead of newer ones
+                self._depth += len(retry)
+                retry.update(self._pending.get(user_id, {}))
+                self._pending[user_id] = retry
+            self._space.notify_all()
+
+    async def close(self):
+        self._closed = True
+        if self._flush_loop is not None:
+            self._flush_loop.cancel()
+            await asyncio.gather(self._flush_loop, return_exceptions=True)
+        # Retried writes are requeued; each is dropped after MAX_ATTEMPTS
+        while self._pending or self._flushing:
+            await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._depth,
+            "queued": self.queued,
+            "written": self.written,
+            "batches": self.batches,
+            "flushes": self.flushes,
+            "failures": self.failures,
+            "dropped": self.dropped,
+            "backpressure_waits": self.backpressure_waits,
+            "average_flush_time": self.total_flush_time / self.flushes if self.flushes else 0.0,
+            "max_flush_time": self.max_flush_time,
+        }
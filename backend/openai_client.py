@@ -0,0 +1,193 @@
+import asyncio
+import importlib.util
+import logging
+import time
+
+import httpx
+from openai import DEFAULT_MAX_RETRIES, AsyncAzureOpenAI, DefaultAsyncHttpxClient
+
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+# Refresh the cached bearer token this many seconds before it expires
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+TOKEN_RETRY_SECONDS = 10
+# Requests never use a token closer than this to its expiry
+TOKEN_MIN_VALIDITY_SECONDS = 60
+
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+class AzureADTokenCache:
+    '''
+    Holds an Entra ID bearer token for a single scope and keeps it fresh from a
+    background task, so request handlers never wait on the token endpoint.
+    '''
+
+    def __init__(
+        self,
+        credential,
+        scope: str = COGNITIVE_SERVICES_SCOPE,
+        refresh_margin: float = TOKEN_REFRESH_MARGIN_SECONDS
+    ):
+        self.credential = credential
+        self.scope = scope
+        self.refresh_margin = refresh_margin
+        self.refresh_count = 0
+        self.refresh_failures = 0
+        self._token = None
+        self._lock = asyncio.Lock()
+        self._refresh_task = None
+
+    def _is_valid(self, margin: float = 0) -> bool:
+        return self._token is not None and self._token.expires_on - margin > time.time()
+
+    async def _refresh(self, margin: float):
+        async with self._lock:
+            # Another caller may have refreshed while we were waiting on the lock
+            if self._is_valid(margin):
+                return
+            try:
+                self._token = await self.credential.get_token(self.scope)
+                self.refresh_count += 1
+            except Exception:
+                self.refresh_failures += 1
+                raise
+
+    async def _refresh_loop(self):
+        while True:
+            if self._token is None:
+                delay = 0
+            else:
+                # A token issued with less than refresh_margin left is due
+                # right away; wait a little instead of refreshing back to back
+                delay = max(
+                    self._token.expires_on - self.refresh_margin - time.time(),
+                    TOKEN_RETRY_SECONDS
+                )
+            await asyncio.sleep(delay)
+            try:
+                await self._refresh(self.refresh_margin)
+            except Exception:
+                logging.exception("Failed to refresh Azure Entra ID token")
+                await asyncio.sleep(TOKEN_RETRY_SECONDS)
+
+    async def start(self):
+        await self._refresh(self.refresh_margin)
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def get_token(self) -> str:
+        # Fall back to an inline refresh only if the background task fell behind
+        if not self._is_valid(TOKEN_MIN_VALIDITY_SECONDS):
+            await self._refresh(TOKEN_MIN_VALIDITY_SECONDS)
+        return self._token.token
+
+    async def close(self):
+        if self._refresh_task:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+
+        if hasattr(self.credential, "close"):
+            await self.credential.close()
+
+    def stats(self) -> dict:
+        return {
+            "refresh_count": self.refresh_count,
+            "refresh_failures": self.refresh_failures,
+            "expires_in": (
+                int(self._token.expires_on - time.time()) if self._token else None
+            ),
+        }
+
+
+class AzureOpenAIClientManager:
+    '''
+    Owns a single AsyncAzureOpenAI client per worker process, backed by one
+    keep-alive httpx connection pool and (without an API key) a cached token.
+    '''
+
+    def __init__(
+        self,
+        endpoint: str,
+        api_version: str,
+        api_key: str = None,
+        credential=None,
+        default_headers: dict = None,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        http2: bool = True,
+        max_retries: int = DEFAULT_MAX_RETRIES
+    ):
+        if not api_key and not credential:
+            raise ValueError("Either an API key or a credential is required")
+
+        self.endpoint = endpoint
+        self.token_cache = AzureADTokenCache(credential) if not api_key else None
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self.requests_sent = 0
+        self.responses_received = 0
+        self.created_at = time.time()
+
+        self.http_client = DefaultAsyncHttpxClient(
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections
+            ),
+            event_hooks={
+                "request": [self._on_request],
+                "response": [self._on_response],
+            }
+        )
+        self.client = AsyncAzureOpenAI(
+            api_version=api_version,
+            api_key=api_key,
+            azure_ad_token_provider=(
+                self.token_cache.get_token if self.token_cache else None
+            ),
+            default_headers=default_headers,
+            azure_endpoint=endpoint,
+            http_client=self.http_client,
+            max_retries=max_retries,
+        )
+
+    async def _on_request(self, request):
+        self.requests_sent += 1
+
+    async def _on_response(self, response):
+        self.responses_received += 1
+
+    async def start(self):
+        if self.token_cache:
+            await self.token_cache.start()
+
+    async def close(self):
+        await self.client.close()
+        if self.token_cache:
+            await self.token_cache.close()
+
+    def stats(self) -> dict:
+        stats = {
+            "endpoint": self.endpoint,
+            "http2": self.http2,
+            "requests_sent": self.requests_sent,
+            "responses_received": self.responses_received,
+            "awaiting_response": self.requests_sent - self.responses_received,
+            "uptime_seconds": int(time.time() - self.created_at),
+        }
+
+        # httpx does not expose its pool publicly; report it when we can find it
+        pool = getattr(self.http_client._transport, "_pool", None)
+        connections = getattr(pool, "connections", None)
+        if connections is not None:
+            stats["connections"] = len(connections)
+            stats["idle_connections"] = sum(1 for c in connections if c.is_idle())
+
+        if self.token_cache:
+            stats["token"] = self.token_cache.stats()
+
+        return stats
@@ -0,0 +1,118 @@
+import json
+import logging
+from typing import Optional
+
+import httpx
+
+from backend.utils import convert_to_pf_format
+
+EVENT_STREAM_CONTENT_TYPE = "text/event-stream"
+
+
+class PromptflowClient:
+    '''
+    Client for a deployed Promptflow endpoint. One client (and its
+    keep-alive connection pool) is shared by every request.
+
+    stream() asks the endpoint for server-sent events and yields each
+    event's outputs as they arrive. Flows without streaming outputs answer
+    with a single JSON body, which is yielded as one event.
+    '''
+
+    def __init__(
+        self,
+        endpoint: str,
+        api_key: str,
+        request_field_name: str = "query",
+        response_field_name: str = "reply",
+        timeout: float = 30.0,
+        max_connections: int = 100,
+        transport: Optional[httpx.AsyncBaseTransport] = None
+    ):
+        self.endpoint = endpoint
+        self.request_field_name = request_field_name
+        self.response_field_name = response_field_name
+        self.requests = 0
+        self.streamed_requests = 0
+        self.headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}",
+        }
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections
+            ),
+            timeout=timeout,
+            transport=transport
+        )
+
+    def _build_request(self, request) -> dict:
+        pf_formatted_obj = convert_to_pf_format(
+            request,
+            self.request_field_name,
+            self.response_field_name
+        )
+        # NOTE: This only support question and chat_history parameters
+        # If you need to add more parameters, you need to modify the request body
+        return {
+            self.request_field_name: pf_formatted_obj[-1]["inputs"][self.request_field_name],
+            "chat_history": pf_formatted_obj[:-1],
+        }
+
+    async def complete(self, request) -> dict:
+        self.requests += 1
+        response = await self.http_client.post(
+            self.endpoint,
+            json=self._build_request(request),
+            headers=self.headers,
+        )
+        resp = response.json()
+        resp["id"] = request["messages"][-1]["id"]
+        return resp
+
+    async def stream(self, request):
+        self.requests += 1
+        message_id = request["messages"][-1]["id"]
+        async with self.http_client.stream(
+            "POST",
+            self.endpoint,
+            json=self._build_request(request),
+            headers={**self.headers, "Accept": EVENT_STREAM_CONTENT_TYPE},
+        ) as response:
+            content_type = response.headers.get("content-type", "")
+            if not content_type.startswith(EVENT_STREAM_CONTENT_TYPE):
+                await response.aread()
+                resp = response.json()
+                resp["id"] = message_id
+                yield resp
+                return
+
+            self.streamed_requests += 1
+            data = []
+            async for line in response.aiter_lines():
+                if line.startswith("data:"):
+                    data.append(line[5:].lstrip())
+                elif not line and data:
+                    yield self._parse_event(data, message_id)
+                    data = []
+            if data:
+                yield self._parse_event(data, message_id)
+
+    def _parse_event(self, data: list, message_id: str) -> dict:
+        try:
+            event = json.loads("\n".join(data))
+        except ValueError:
+            logging.error(f"Invalid event in promptflow response stream: {data}")
+            return {"id": message_id}
+        event["id"] = message_id
+        return event
+
+    async def close(self):
+        await self.http_client.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "streamed_requests": self.streamed_requests,
+        }
@@ -0,0 +1,292 @@
+import asyncio
+import logging
+import math
+import os
+import struct
+import time
+from typing import Callable, List, Optional
+
+from backend.history.budget import MESSAGE_OVERHEAD_TOKENS, TokenCounter
+from backend.utils import close_stream
+
+# tokens, requests, updated_at, paused_until
+STATE_FORMAT = "dddd"
+STATE_SIZE = struct.calcsize(STATE_FORMAT)
+
+
+class RateLimitExceeded(Exception):
+    status_code = 429
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LocalQuotaState:
+    '''Bucket levels for a single worker.'''
+
+    def __init__(self):
+        self._state = None
+
+    def transact(self, update: Callable[[Optional[tuple]], tuple]):
+        self._state, result = update(self._state)
+        return result
+
+
+class FileQuotaState:
+    '''
+    Bucket levels shared by every worker on the machine through a small file
+    updated under an exclusive flock. Each update reads and writes a few
+    bytes, so holding the lock from the event loop is cheap. flock is only
+    available on POSIX systems; check supported() before using it.
+    '''
+
+    def __init__(self, path: str):
+        # fcntl does not exist on Windows, so it is only imported here
+        import fcntl
+        self._fcntl = fcntl
+        self.path = path
+
+    @staticmethod
+    def supported() -> bool:
+        return os.name == "posix"
+
+    def transact(self, update: Callable[[Optional[tuple]], tuple]):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            self._fcntl.flock(fd, self._fcntl.LOCK_EX)
+            data = os.pread(fd, STATE_SIZE, 0)
+            state = struct.unpack(STATE_FORMAT, data) if len(data) == STATE_SIZE else None
+            state, result = update(state)
+            os.pwrite(fd, struct.pack(STATE_FORMAT, *state), 0)
+            return result
+        finally:
+            os.close(fd)
+
+
+class Reservation:
+    def __init__(self, limiter: 'QuotaLimiter', prompt_tokens: int, tokens: int):
+        self.limiter = limiter
+        self.prompt_tokens = prompt_tokens
+        self.tokens = tokens
+        self.settled = False
+
+    def settle(self, used_tokens: int):
+        # Give back (or charge) the difference between estimate and usage
+        if not self.settled:
+            self.settled = True
+            self.limiter.settle(self.tokens, used_tokens)
+
+    def cancel(self, error: Exception = None):
+        # A rejected or failed call did not use the quota it reserved
+        self.settle(0)
+        retry_after = get_retry_after(error) if error else None
+        if retry_after:
+            self.limiter.pause(retry_after)
+
+    def track_stream(self, stream, count_tokens: Callable[[str], int]) -> '_TrackedStream':
+        return _TrackedStream(self, stream, count_tokens)
+
+
+class _TrackedStream:
+    '''
+    Passes a streamed completion through and settles its reservation once
+    the stream ends, fails or is closed. Settled from the usage chunk when
+    the service sends one, otherwise from the streamed text. Closing it
+    before the first chunk still settles and closes the upstream stream.
+    '''
+
+    def __init__(self, reservation: Reservation, stream, count_tokens: Callable[[str], int]):
+        self._reservation = reservation
+        self._stream = stream
+        self._iterator = stream.__aiter__()
+        self._count_tokens = count_tokens
+        self._content = []
+        self._usage = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await self._iterator.__anext__()
+        except BaseException:
+            # StopAsyncIteration, an upstream error or a client disconnect
+            self._settle()
+            raise
+
+        self._usage = getattr(chunk, "usage", None) or self._usage
+        for choice in getattr(chunk, "choices", None) or []:
+            delta = getattr(choice, "delta", None)
+            if delta and getattr(delta, "content", None):
+                self._content.append(delta.content)
+        return chunk
+
+    def _settle(self):
+        if self._usage and getattr(self._usage, "total_tokens", None):
+            self._reservation.settle(self._usage.total_tokens)
+        else:
+            self._reservation.settle(
+                self._reservation.prompt_tokens + self._count_tokens("".join(self._content))
+            )
+
+    async def aclose(self):
+        self._settle()
+        await close_stream(self._stream)
+
+
+def get_retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class QuotaLimiter:
+    '''
+    Token buckets matching the deployment's tokens-per-minute and
+    requests-per-minute quotas. Each call reserves its estimated prompt
+    tokens plus max_tokens up front and is settled against the reported
+    usage afterwards, so requests wait here instead of coming back as 429.
+
+    Azure OpenAI enforces quotas over short windows, so each bucket holds
+    burst_seconds worth of quota rather than a full minute.
+    '''
+
+    def __init__(
+        self,
+        tokens_per_minute: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+        burst_seconds: float = 10,
+        max_wait: float = 30,
+        counter: Optional[TokenCounter] = None,
+        state=None
+    ):
+        self.token_rate = tokens_per_minute / 60 if tokens_per_minute else None
+        self.request_rate = requests_per_minute / 60 if requests_per_minute else None
+        self.token_capacity = self.token_rate * burst_seconds if self.token_rate else None
+        self.request_capacity = max(1.0, self.request_rate * burst_seconds) if self.request_rate else None
+        self.max_wait = max_wait
+        self.counter = counter or TokenCounter()
+        self.state = state or LocalQuotaState()
+        self.requests = 0
+        self.delayed_requests = 0
+        self.rejected_requests = 0
+        self.total_delay = 0.0
+        self.reserved_tokens = 0
+        self.used_tokens = 0
+        self.pauses = 0
+
+    def estimate_tokens(self, messages: List[dict]) -> int:
+        prompt_tokens = 0
+        for message in messages:
+            content = message.get("content")
+            prompt_tokens += MESSAGE_OVERHEAD_TOKENS + self.counter.count(
+                content if isinstance(content, str) else str(content)
+            )
+        return prompt_tokens
+
+    def _refill(self, state: Optional[tuple], now: float) -> list:
+        if state is None:
+            return [self.token_capacity or 0.0, self.request_capacity or 0.0, now, 0.0]
+
+        tokens, requests, updated_at, paused_until = state
+        elapsed = max(0.0, now - updated_at)
+        if self.token_rate:
+            tokens = min(self.token_capacity, tokens + elapsed * self.token_rate)
+        if self.request_rate:
+            requests = min(self.request_capacity, requests + elapsed * self.request_rate)
+        return [tokens, requests, now, paused_until]
+
+    def _try_reserve(self, tokens: int) -> float:
+        def update(state):
+            now = time.time()
+            state = self._refill(state, now)
+            if state[3] > now:
+                return tuple(state), state[3] - now
+
+            # A request larger than the bucket only waits for a full bucket
+            needed = min(tokens, self.token_capacity) if self.token_rate else 0
+            wait = 0.0
+            if self.token_rate and state[0] < needed:
+                wait = (needed - state[0]) / self.token_rate
+            if self.request_rate and state[1] < 1:
+                wait = max(wait, (1 - state[1]) / self.request_rate)
+            if wait == 0.0:
+                if self.token_rate:
+                    state[0] -= tokens
+                if self.request_rate:
+                    state[1] -= 1
+            return tuple(state), wait
+
+        return self.state.transact(update)
+
+    async def acquire(self, prompt_tokens: int, max_tokens: Optional[int] = None) -> Reservation:
+        tokens = prompt_tokens + (max_tokens or 0)
+        self.requests += 1
+        waited = 0.0
+        while True:
+            wait = self._try_reserve(tokens)
+            if wait == 0.0:
+                break
+            if waited + wait > self.max_wait:
+                self.rejected_requests += 1
+                # wait is how long until the buckets hold enough again
+                raise RateLimitExceeded(
+                    "Azure OpenAI quota exhausted, please retry later", max(1, math.ceil(wait))
+                )
+            await asyncio.sleep(wait)
+            waited += wait
+
+        if waited:
+            self.delayed_requests += 1
+            self.total_delay += waited
+        self.reserved_tokens += tokens
+        return Reservation(self, prompt_tokens, tokens)
+
+    def settle(self, reserved_tokens: int, used_tokens: int):
+        self.used_tokens += used_tokens
+        refund = reserved_tokens - used_tokens
+        if not self.token_rate or not refund:
+            return
+
+        def update(state):
+            state = self._refill(state, time.time())
+            state[0] = min(self.token_capacity, state[0] + refund)
+            return tuple(state), None
+
+        self.state.transact(update)
+
+    def pause(self, seconds: float):
+        # The service said when it will accept requests again; every worker
+        # sharing the state holds back until then
+        logging.warning(f"Azure OpenAI rate limit reached, pausing requests for {seconds:.1f}s")
+        self.pauses += 1
+
+        def update(state):
+            now = time.time()
+            state = self._refill(state, now)
+            state[3] = max(state[3], now + seconds)
+            return tuple(state), None
+
+        self.state.transact(update)
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "delayed_requests": self.delayed_requests,
+            "rejected_requests": self.rejected_requests,
+            "total_delay_seconds": self.total_delay,
+            "reserved_tokens": self.reserved_tokens,
+            "used_tokens": self.used_tokens,
+            "pauses": self.pauses,
+        }
@@ -0,0 +1,363 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import List, Optional
+from urllib.parse import urlparse
+
+import httpx
+import openai
+
+from backend.rate_limit import get_retry_after
+
+# Weight of the newest sample in the moving average of time to first token
+TTFT_SMOOTHING = 0.2
+# Number of recent time to first token samples the hedge threshold is taken from
+TTFT_WINDOW = 200
+
+
+class NoBackendAvailable(Exception):
+    status_code = 503
+
+
+class OpenAIBackend:
+    '''One Azure OpenAI deployment the router can send chat requests to.'''
+
+    def __init__(self, client_manager, deployment: str, weight: float = 1.0, name: str = None):
+        self.client_manager = client_manager
+        self.deployment = deployment
+        self.weight = weight
+        self.name = name or f"{urlparse(client_manager.endpoint).hostname}/{deployment}"
+        self.ewma_ttft = None
+        self.in_flight = 0
+        self.ejected_until = 0.0
+        self.remaining_tokens = None
+        self.remaining_requests = None
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.ejections = 0
+
+    def is_available(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+    def has_quota(self, tokens: int) -> bool:
+        if self.remaining_requests is not None and self.remaining_requests < 1:
+            return False
+        return self.remaining_tokens is None or self.remaining_tokens >= tokens
+
+    def score(self) -> float:
+        # Expected wait for a new request, spread by weight. Backends without
+        # a measurement yet score zero so they are tried early.
+        return (self.ewma_ttft or 0.0) * (self.in_flight + 1) / self.weight
+
+    def record_ttft(self, seconds: float):
+        self.ewma_ttft = seconds if self.ewma_ttft is None else (
+            TTFT_SMOOTHING * seconds + (1 - TTFT_SMOOTHING) * self.ewma_ttft
+        )
+
+    def record_quota(self, headers):
+        for header, attribute in (
+            ("x-ratelimit-remaining-tokens", "remaining_tokens"),
+            ("x-ratelimit-remaining-requests", "remaining_requests"),
+        ):
+            try:
+                setattr(self, attribute, int(headers[header]))
+            except (KeyError, TypeError, ValueError):
+                pass
+
+    def eject(self, seconds: float):
+        self.ejections += 1
+        self.ejected_until = max(self.ejected_until, time.monotonic() + seconds)
+        logging.warning(f"Ejecting Azure OpenAI backend {self.name} for {seconds:.0f}s")
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "weight": self.weight,
+            "ewma_ttft_ms": self.ewma_ttft * 1000 if self.ewma_ttft is not None else None,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "errors": self.errors,
+            "throttled": self.throttled,
+            "ejections": self.ejections,
+            "ejected": not self.is_available(time.monotonic()),
+            "remaining_tokens": self.remaining_tokens,
+            "remaining_requests": self.remaining_requests,
+        }
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return status_code == 429 or (status_code is not None and status_code >= 500)
+
+
+class _StartedStream:
+    # A streamed completion whose first chunk has already been read
+    def __init__(self, backend: OpenAIBackend, response, iterator, first_chunk, headers):
+        self.backend = backend
+        self.response = response
+        self.iterator = iterator
+        self.first_chunk = first_chunk
+        self.headers = headers
+
+    async def close(self):
+        self.backend.in_flight -= 1
+        await _close_stream(self.response)
+
+
+class _RoutedStream:
+    '''
+    The stream handed to the caller. The backend's in-flight slot is
+    released when the stream ends, fails or is closed. aclose() also works
+    before the first chunk has been read, when an async generator would not
+    run its cleanup.
+    '''
+
+    def __init__(self, started_stream: _StartedStream):
+        self._started_stream = started_stream
+        self._first_chunk = started_stream.first_chunk
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._closed:
+            raise StopAsyncIteration
+        if self._first_chunk is not None:
+            chunk, self._first_chunk = self._first_chunk, None
+            return chunk
+        try:
+            return await self._started_stream.iterator.__anext__()
+        except BaseException:
+            # StopAsyncIteration, an upstream error or a client disconnect
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            await self._started_stream.close()
+
+
+async def _close_stream(response):
+    # Closing the connection stops the service from generating (and
+    # billing) the rest of an abandoned answer
+    close = getattr(response, "close", None)
+    if close:
+        try:
+            await close()
+        except Exception:
+            logging.debug("Failed to close abandoned stream", exc_info=True)
+
+
+class BackendRouter:
+    '''
+    Spreads chat completions over several deployments of the same model.
+
+    Each request goes to the available backend with the lowest expected
+    time to first token that still reports enough quota. A backend that
+    answers 429 or 5xx (or cannot be reached) is ejected for a while and
+    the request is retried on the next backend. Requests are only retried
+    before any part of the answer has been returned.
+
+    With hedging, a stream whose first chunk takes longer than the recent
+    hedge_percentile of time to first token is duplicated on a second
+    backend; the first to produce a chunk wins and the other is closed.
+    At most hedge_budget of streamed requests are hedged.
+    '''
+
+    def __init__(
+        self,
+        backends: List[OpenAIBackend],
+        eject_seconds: float = 30,
+        hedge: bool = False,
+        hedge_budget: float = 0.1,
+        hedge_percentile: float = 0.9,
+        hedge_min_samples: int = 20
+    ):
+        if not backends:
+            raise ValueError("At least one Azure OpenAI backend is required")
+
+        self.backends = backends
+        self.eject_seconds = eject_seconds
+        self.hedge = hedge and len(backends) > 1
+        self.hedge_budget = hedge_budget
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.retries = 0
+        self.streams = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._ttft_samples = deque(maxlen=TTFT_WINDOW)
+
+    def pick(self, tokens: int = 0, exclude=()) -> Optional[OpenAIBackend]:
+        candidates = [b for b in self.backends if b not in exclude]
+        if not candidates:
+            return None
+
+        now = time.monotonic()
+        available = [b for b in candidates if b.is_available(now)]
+        if not available:
+            # Everything is ejected; the one that comes back first is the
+            # best remaining bet
+            return min(candidates, key=lambda b: b.ejected_until)
+
+        with_quota = [b for b in available if b.has_quota(tokens)]
+        return min(with_quota or available, key=OpenAIBackend.score)
+
+    def _record_ttft(self, backend: OpenAIBackend, seconds: float):
+        backend.record_ttft(seconds)
+        self._ttft_samples.append(seconds)
+
+    def _record_error(self, backend: OpenAIBackend, error: Exception):
+        backend.errors += 1
+        if is_retryable(error):
+            if getattr(error, "status_code", None) == 429:
+                backend.throttled += 1
+            backend.eject(get_retry_after(error) or self.eject_seconds)
+
+    def hedge_threshold(self) -> Optional[float]:
+        if len(self._ttft_samples) < self.hedge_min_samples:
+            return None
+        samples = sorted(self._ttft_samples)
+        return samples[min(len(samples) - 1, int(len(samples) * self.hedge_percentile))]
+
+    async def _send(self, backend: OpenAIBackend, model_args: dict):
+        backend.requests += 1
+        backend.in_flight += 1
+        try:
+            raw_response = await backend.client_manager.client.chat.completions.with_raw_response.create(
+                **{**model_args, "model": backend.deployment}
+            )
+            response = raw_response.parse()
+        except BaseException as e:
+            backend.in_flight -= 1
+            if isinstance(e, Exception):
+                self._record_error(backend, e)
+            raise
+
+        backend.record_quota(raw_response.headers)
+        return response, raw_response.headers
+
+    async def _start_stream(self, backend: OpenAIBackend, model_args: dict) -> _StartedStream:
+        started = time.monotonic()
+        response, headers = await self._send(backend, model_args)
+        iterator = response.__aiter__()
+        try:
+            first_chunk = await iterator.__anext__()
+        except StopAsyncIteration:
+            first_chunk = None
+        except BaseException as e:
+            backend.in_flight -= 1
+            await _close_stream(response)
+            if isinstance(e, Exception):
+                self._record_error(backend, e)
+            raise
+
+        self._record_ttft(backend, time.monotonic() - started)
+        return _StartedStream(backend, response, iterator, first_chunk, headers)
+
+    async def _discard(self, task: asyncio.Task):
+        if not task.done():
+            task.cancel()
+        else:
+            stream = task.result() if not task.cancelled() and not task.exception() else None
+            if stream:
+                await stream.close()
+
+    async def _start_hedged_stream(self, backend: OpenAIBackend, model_args: dict, tokens: int, tried: list):
+        primary = asyncio.ensure_future(self._start_stream(backend, model_args))
+        tasks = [primary]
+        winner = None
+        try:
+            threshold = self.hedge_threshold()
+            if threshold is not None and self.hedged < self.hedge_budget * self.streams:
+                done, _ = await asyncio.wait(tasks, timeout=threshold)
+                hedge_backend = None if done else self.pick(tokens, exclude=tried)
+                if hedge_backend is not None:
+                    self.hedged += 1
+                    tried.append(hedge_backend)
+                    tasks.append(asyncio.ensure_future(self._start_stream(hedge_backend, model_args)))
+
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in tasks:
+                    if task in done and not task.exception():
+                        winner = task
+                        if task is not primary:
+                            self.hedge_wins += 1
+                        return task.result()
+
+            # Every attempt failed; report the primary's error
+            return primary.result()
+        finally:
+            # Stop the losing request right away
+            for task in tasks:
+                if task is not winner:
+                    await self._discard(task)
+
+    async def create_chat_completion(self, model_args: dict, tokens: int = 0):
+        '''
+        Returns (response, headers, backend). Streaming responses are
+        returned once their first chunk has arrived.
+        '''
+        stream = model_args.get("stream")
+        if stream:
+            self.streams += 1
+
+        tried = []
+        last_error = None
+        while True:
+            backend = self.pick(tokens, exclude=tried)
+            if backend is None:
+                if last_error:
+                    raise last_error
+                raise NoBackendAvailable("No Azure OpenAI backend is available")
+            if tried:
+                self.retries += 1
+            tried.append(backend)
+
+            started = time.monotonic()
+            try:
+                if not stream:
+                    response, headers = await self._send(backend, model_args)
+                elif self.hedge:
+                    started_stream = await self._start_hedged_stream(backend, model_args, tokens, tried)
+                else:
+                    started_stream = await self._start_stream(backend, model_args)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                last_error = e
+                continue
+
+            if not stream:
+                self._record_ttft(backend, time.monotonic() - started)
+                backend.in_flight -= 1
+                return response, headers, backend
+
+            return (
+                _RoutedStream(started_stream),
+                started_stream.headers,
+                started_stream.backend
+            )
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.client_manager.close()
+
+    def stats(self) -> dict:
+        threshold = self.hedge_threshold()
+        return {
+            "retries": self.retries,
+            "streams": self.streams,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "hedge_threshold_ms": threshold * 1000 if threshold is not None else None,
+            "backends": [backend.stats() for backend in self.backends],
+        }
@@ -0,0 +1,170 @@
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+import httpx
+
+from backend.auth.auth_utils import get_group_ids_from_claims
+
+GRAPH_ENDPOINT = "https://graph.microsoft.com/v1.0"
+TRANSITIVE_MEMBER_OF_PATH = "/me/transitiveMemberOf?$select=id"
+
+
+class GraphClient:
+    '''
+    Async Microsoft Graph client for group membership lookups. One client
+    (and its keep-alive connection pool) is shared by every request.
+    '''
+
+    def __init__(
+        self,
+        endpoint: str = GRAPH_ENDPOINT,
+        max_connections: int = 20,
+        timeout: float = 10.0,
+        transport: Optional[httpx.AsyncBaseTransport] = None
+    ):
+        self.endpoint = endpoint.rstrip("/")
+        self.requests = 0
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections
+            ),
+            timeout=timeout,
+            transport=transport
+        )
+
+    async def fetch_user_group_ids(self, user_token: str) -> List[str]:
+        # Follow @odata.nextLink page by page instead of recursing
+        group_ids = []
+        next_link = self.endpoint + TRANSITIVE_MEMBER_OF_PATH
+        headers = {"Authorization": "bearer " + user_token}
+        while next_link:
+            self.requests += 1
+            response = await self.http_client.get(next_link, headers=headers)
+            response.raise_for_status()
+            page = response.json()
+            group_ids.extend(group["id"] for group in page.get("value", []))
+            next_link = page.get("@odata.nextLink")
+
+        return group_ids
+
+    async def close(self):
+        await self.http_client.aclose()
+
+
+def build_filter_string(permitted_groups_column: str, group_ids: List[str]) -> str:
+    return f"{permitted_groups_column}/any(g:search.in(g, '{', '.join(group_ids)}'))"
+
+
+class GroupFilterResolver:
+    '''
+    Resolves the document-level security filter for a user.
+
+    With use_claims, group IDs already present in the user's EasyAuth
+    claims are used directly and Graph is only called on group overage.
+    Graph filters are cached per access token (tokens are per user, so the
+    cache never hands one user's groups to another) with a TTL and a size
+    bound. Concurrent lookups for the same token share a single Graph call.
+    Failed lookups fall back to a filter that matches no groups and are
+    not cached.
+    '''
+
+    def __init__(
+        self,
+        graph_client: GraphClient,
+        permitted_groups_column: str,
+        ttl: float = 300,
+        max_entries: int = 10000,
+        use_claims: bool = False
+    ):
+        self.graph_client = graph_client
+        self.permitted_groups_column = permitted_groups_column
+        self.use_claims = use_claims
+        self.claims_resolved = 0
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._entries = OrderedDict()
+        self._in_flight = {}
+
+    def _cached(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, filter_string = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return filter_string
+
+    def _store(self, key: str, filter_string: str):
+        self._entries[key] = (time.monotonic() + self.ttl, filter_string)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _resolve(self, key: str, user_token: str) -> str:
+        try:
+            group_ids = await self.graph_client.fetch_user_group_ids(user_token)
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Exception fetching user groups: {e}")
+            return build_filter_string(self.permitted_groups_column, [])
+        finally:
+            self._in_flight.pop(key, None)
+
+        if not group_ids:
+            logging.debug("No user groups found")
+        filter_string = build_filter_string(self.permitted_groups_column, group_ids)
+        self._store(key, filter_string)
+        return filter_string
+
+    def get_filter_from_claims(self, request_headers) -> Optional[str]:
+        group_ids = get_group_ids_from_claims(request_headers) if self.use_claims else None
+        if group_ids is None:
+            return None
+
+        self.claims_resolved += 1
+        return build_filter_string(self.permitted_groups_column, group_ids)
+
+    async def get_filter(self, user_token: str) -> str:
+        key = hashlib.sha256(user_token.encode("utf-8")).hexdigest()
+        filter_string = self._cached(key)
+        if filter_string is not None:
+            self.hits += 1
+            return filter_string
+
+        self.misses += 1
+        call = self._in_flight.get(key)
+        if call is None:
+            call = self._in_flight[key] = asyncio.ensure_future(self._resolve(key, user_token))
+
+        # Shield the shared lookup so one disconnecting caller does not
+        # cancel it for the others
+        filter_string = await asyncio.shield(call)
+        logging.debug(f"FILTER: {filter_string}")
+        return filter_string
+
+    async def close(self):
+        await self.graph_client.close()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "claims_resolved": self.claims_resolved,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "graph_requests": self.graph_client.requests,
+            "errors": self.errors,
+            "entries": len(self._entries),
+        }
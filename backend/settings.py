@@ -1,4 +1,5 @@
 import os
+import copy
 import json
 import logging
 from abc import ABC, abstractmethod
@@ -18,8 +19,7 @@ from pydantic.alias_generators import to_snake
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from typing import List, Literal, Optional
 from typing_extensions import Self
-from quart import Request
-from backend.utils import parse_multi_columns, generateFilterString
+from backend.utils import parse_multi_columns
 
 DOTENV_PATH = os.environ.get(
     "DOTENV_PATH",
@@ -64,6 +64,28 @@ class _ChatHistorySettings(BaseSettings):
     account_key: Optional[str] = None
     conversations_container: str
     enable_feedback: bool = False
+    save_replies: bool = False
+    write_behind_enabled: bool = False
+    write_behind_max_batch_size: conint(ge=1, le=100) = 100
+    write_behind_flush_interval_ms: confloat(gt=0) = 200
+    write_behind_max_queue: conint(ge=1) = 1000
+    delete_concurrency: conint(ge=1) = 10
+    background_delete_threshold: conint(ge=1) = 1000
+    summary_message_counts: bool = False
+
+
+class _HistorySummarySettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="HISTORY_SUMMARY_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    enabled: bool = False
+    threshold_turns: conint(ge=1) = 20
+    keep_recent_turns: conint(ge=0) = 6
+    max_tokens: int = 400
 
 
 class _PromptflowSettings(BaseSettings):
@@ -77,11 +99,99 @@ class _PromptflowSettings(BaseSettings):
     endpoint: str
     api_key: str
     response_timeout: float = 30.0
+    stream: bool = False
+    max_connections: conint(ge=1) = 100
     request_field_name: str = "query"
     response_field_name: str = "reply"
     citations_field_name: str = "documents"
 
 
+class _StreamSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="STREAM_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    flush_max_tokens: conint(ge=1) = 1
+    flush_interval_ms: confloat(ge=0) = 0
+
+
+class _ResponseCacheSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="RESPONSE_CACHE_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    enabled: bool = False
+    ttl_seconds: float = 600
+    max_entries: int = 1000
+    backend: str = "memory"
+
+
+class _SemanticCacheSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="SEMANTIC_CACHE_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    enabled: bool = False
+    similarity_threshold: confloat(ge=0.0, le=1.0) = 0.95
+    max_entries: int = 500
+    max_partitions: int = 100
+    ttl_seconds: float = 3600
+
+
+class _AdmissionSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="ADMISSION_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    enabled: bool = False
+    max_in_flight: conint(ge=1) = 32
+    max_per_user: conint(ge=1) = 4
+    max_queue: conint(ge=0) = 64
+    queue_timeout_seconds: float = 10.0
+
+
+class _RateLimitSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="RATE_LIMIT_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    tokens_per_minute: Optional[conint(ge=1)] = None
+    requests_per_minute: Optional[conint(ge=1)] = None
+    burst_seconds: confloat(gt=0) = 10
+    max_wait_seconds: float = 30
+    state_file: Optional[str] = None
+
+
+class _GraphSettings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="GRAPH_",
+        env_file=DOTENV_PATH,
+        extra="ignore",
+        env_ignore_empty=True
+    )
+
+    endpoint: str = "https://graph.microsoft.com/v1.0"
+    max_connections: int = 20
+    timeout_seconds: float = 10.0
+    group_cache_ttl_seconds: float = 300
+    group_cache_max_entries: int = 10000
+
+
 class _AzureOpenAIFunction(BaseModel):
     name: str = Field(..., min_length=1)
     description: str = Field(..., min_length=1)
@@ -93,6 +203,13 @@ class _AzureOpenAITool(BaseModel):
     function: _AzureOpenAIFunction
     
 
+class _AzureOpenAIBackend(BaseModel):
+    endpoint: str
+    deployment: Optional[str] = None
+    key: Optional[str] = None
+    weight: confloat(gt=0) = 1.0
+
+
 class _AzureOpenAISettings(BaseSettings):
     model_config = SettingsConfigDict(
         env_prefix="AZURE_OPENAI_",
@@ -123,6 +240,17 @@ class _AzureOpenAISettings(BaseSettings):
     embedding_endpoint: Optional[str] = None
     embedding_key: Optional[str] = None
     embedding_name: Optional[str] = None
+    max_prompt_tokens: Optional[conint(ge=1)] = None
+    tokenizer_encoding: str = "cl100k_base"
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    http2: bool = True
+    backends: List[_AzureOpenAIBackend] = []
+    backend_eject_seconds: float = 30
+    hedge_requests: bool = False
+    hedge_budget: confloat(ge=0.0, le=1.0) = 0.1
+    hedge_percentile: confloat(gt=0.0, lt=1.0) = 0.9
+    hedge_min_samples: conint(ge=1) = 20
     
     @field_validator('tools', mode='before')
     @classmethod
@@ -224,18 +352,39 @@ class _SearchCommonSettings(BaseSettings):
 
 class DatasourcePayloadConstructor(BaseModel, ABC):
     _settings: '_AppSettings' = PrivateAttr()
+    _payload_template: Optional[dict] = PrivateAttr(default=None)
     
     def __init__(self, settings: '_AppSettings', **data):
         super().__init__(**data)
         self._settings = settings
     
     @abstractmethod
+    def build_payload_template(self) -> dict:
+        pass
+    
+    def compile_payload_template(self) -> dict:
+        # The datasource settings do not change after startup, so the static
+        # part of the payload is dumped once and shared by every request
+        self._payload_template = copy.deepcopy(self.build_payload_template())
+        return self._payload_template
+    
     def construct_payload_configuration(
         self,
         *args,
         **kwargs
     ):
-        pass
+        # Per-request values such as the user's security filter are laid over
+        # a shallow copy; the nested template values are shared, not copied
+        template = self._payload_template or self.compile_payload_template()
+        parameters = dict(template["parameters"])
+        request_parameters = kwargs.pop('request_parameters', None)
+        if request_parameters:
+            parameters.update(request_parameters)
+        
+        return {
+            "type": template["type"],
+            "parameters": parameters
+        }
 
 
 class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
@@ -270,6 +419,7 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
         'vectorSemanticHybrid'
     ] = "simple"
     permitted_groups_column: Optional[str] = Field(default=None, exclude=True)
+    permitted_groups_from_claims: bool = Field(default=False, exclude=True)
     
     # Constructed fields
     endpoint: Optional[str] = None
@@ -315,30 +465,7 @@ class _AzureSearchSettings(BaseSettings, DatasourcePayloadConstructor):
     def set_query_type(self) -> Self:
         self.query_type = to_snake(self.query_type)
 
-    def _set_filter_string(self, request: Request) -> str:
-        if self.permitted_groups_column:
-            user_token = request.headers.get("X-MS-TOKEN-AAD-ACCESS-TOKEN", "")
-            logging.debug(f"USER TOKEN is {'present' if user_token else 'not present'}")
-            if not user_token:
-                raise ValueError(
-                    "Document-level access control is enabled, but user access token could not be fetched."
-                )
-
-            filter_string = generateFilterString(user_token)
-            logging.debug(f"FILTER: {filter_string}")
-            return filter_string
-        
-        return None
-            
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
-        request = kwargs.pop('request', None)
-        if request and self.permitted_groups_column:
-            self.filter = self._set_filter_string(request)
-            
+    def build_payload_template(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
         parameters = self.model_dump(exclude_none=True, by_alias=True)
@@ -407,11 +534,7 @@ class _AzureCosmosDbMongoVcoreSettings(
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def build_payload_template(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
         parameters = self.model_dump(exclude_none=True, by_alias=True)
@@ -477,11 +600,7 @@ class _ElasticsearchSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def build_payload_template(self) -> dict:
         self.embedding_dependency = \
             {"type": "model_id", "model_id": self.embedding_model_id} if self.embedding_model_id else \
             self._settings.azure_openai.extract_embedding_dependency() 
@@ -549,11 +668,7 @@ class _PineconeSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def build_payload_template(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
         parameters = self.model_dump(exclude_none=True, by_alias=True)
@@ -607,11 +722,7 @@ class _AzureMLIndexSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def build_payload_template(self) -> dict:
         parameters = self.model_dump(exclude_none=True, by_alias=True)
         parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
         
@@ -654,11 +765,7 @@ class _AzureSqlServerSettings(BaseSettings, DatasourcePayloadConstructor):
             }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def build_payload_template(self) -> dict:
         parameters = self.model_dump(exclude_none=True, by_alias=True)
         #parameters.update(self._settings.search.model_dump(exclude_none=True, by_alias=True))
         
@@ -728,11 +835,7 @@ class _MongoDbSettings(BaseSettings, DatasourcePayloadConstructor):
         }
         return self
     
-    def construct_payload_configuration(
-        self,
-        *args,
-        **kwargs
-    ):
+    def build_payload_template(self) -> dict:
         self.embedding_dependency = \
             self._settings.azure_openai.extract_embedding_dependency()
             
@@ -756,6 +859,8 @@ class _BaseSettings(BaseSettings):
     auth_enabled: bool = True
     sanitize_answer: bool = False
     use_promptflow: bool = False
+    coalesce_chat_requests: bool = False
+    metrics_enabled: bool = False
 
 
 class _AppSettings(BaseModel):
@@ -763,6 +868,13 @@ class _AppSettings(BaseModel):
     azure_openai: _AzureOpenAISettings = _AzureOpenAISettings()
     search: _SearchCommonSettings = _SearchCommonSettings()
     ui: Optional[_UiSettings] = _UiSettings()
+    stream: _StreamSettings = _StreamSettings()
+    history_summary: _HistorySummarySettings = _HistorySummarySettings()
+    response_cache: _ResponseCacheSettings = _ResponseCacheSettings()
+    semantic_cache: _SemanticCacheSettings = _SemanticCacheSettings()
+    graph: _GraphSettings = _GraphSettings()
+    admission: _AdmissionSettings = _AdmissionSettings()
+    rate_limit: _RateLimitSettings = _RateLimitSettings()
     
     # Constructed properties
     chat_history: Optional[_ChatHistorySettings] = None
@@ -823,6 +935,9 @@ class _AppSettings(BaseModel):
             else:
                 self.datasource = None
                 logging.warning("No datasource configuration found in the environment -- calls will be made to Azure OpenAI without grounding data.")
+            
+            if self.datasource:
+                self.datasource.compile_payload_template()
                 
             return self
 
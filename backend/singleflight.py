@@ -0,0 +1,164 @@
+import asyncio
+import copy
+import logging
+from typing import Any, Awaitable, Callable
+
+from backend.cache.response_cache import new_completion_id
+
+
+def _with_id(item, response_id: str):
+    # Items are shared with the other callers, so change a copy
+    if not getattr(item, "id", None):
+        return item
+    item = copy.copy(item)
+    item.id = response_id
+    return item
+
+
+async def _rename_stream(stream, response_id: str):
+    async for item in stream:
+        yield _with_id(item, response_id)
+
+
+class StreamBroadcast:
+    '''
+    Consumes one upstream async iterator and fans every item out to any
+    number of subscribers. Each subscriber starts from the first item, so a
+    request that joins late still receives the complete answer.
+    '''
+
+    def __init__(self, source, on_done: Callable[[], None] = None):
+        self._source = source
+        self._on_done = on_done
+        self._items = []
+        self._error = None
+        self._done = False
+        self._subscribers = 0
+        self._changed = asyncio.Condition()
+        self._pump_task = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        try:
+            async for item in self._source:
+                async with self._changed:
+                    self._items.append(item)
+                    self._changed.notify_all()
+        except asyncio.CancelledError:
+            self._error = RuntimeError("The shared upstream stream was cancelled")
+            await self._close_source()
+            raise
+        except Exception as e:
+            self._error = e
+        finally:
+            self._done = True
+            if self._on_done:
+                self._on_done()
+            async with self._changed:
+                self._changed.notify_all()
+
+    async def _close_source(self):
+        close = getattr(self._source, "aclose", None) or getattr(self._source, "close", None)
+        if close:
+            try:
+                await close()
+            except Exception:
+                logging.debug("Failed to close abandoned upstream stream", exc_info=True)
+
+    def subscribe(self):
+        # Count the subscriber before it starts iterating so an early
+        # disconnect by another caller cannot cancel the shared stream
+        self._subscribers += 1
+        return self._iterate()
+
+    async def _iterate(self):
+        index = 0
+        try:
+            while True:
+                async with self._changed:
+                    await self._changed.wait_for(
+                        lambda: index < len(self._items) or self._done
+                    )
+                    pending = self._items[index:]
+                if pending:
+                    for item in pending:
+                        yield item
+                    index += len(pending)
+                elif self._done:
+                    break
+
+            if self._error:
+                raise self._error
+        finally:
+            self._subscribers -= 1
+            # Stop paying for tokens nobody is going to read
+            if self._subscribers == 0 and not self._done:
+                self._pump_task.cancel()
+
+
+class SingleFlight:
+    '''
+    Collapses concurrent calls that share a key into one upstream call.
+
+    The wrapped function returns a (response, apim_request_id) tuple. Plain
+    responses are shared as-is; streaming responses are shared through a
+    StreamBroadcast and every caller receives its own subscription.
+    '''
+
+    def __init__(self):
+        self.leaders = 0
+        self.followers = 0
+        self._in_flight = {}
+
+    async def _run(self, key: str, fn: Callable[[], Awaitable[Any]], stream: bool):
+        task = asyncio.current_task()
+
+        def release():
+            if self._in_flight.get(key) is task:
+                del self._in_flight[key]
+
+        try:
+            response, apim_request_id = await fn()
+        except BaseException:
+            release()
+            raise
+
+        if not stream:
+            release()
+            return response, apim_request_id
+
+        # Keep the key joinable until the upstream stream has finished
+        return StreamBroadcast(response, on_done=release), apim_request_id
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]], stream: bool = False):
+        call = self._in_flight.get(key)
+        follower = call is not None
+        if call is None:
+            call = asyncio.ensure_future(self._run(key, fn, stream))
+            self._in_flight[key] = call
+            self.leaders += 1
+        else:
+            self.followers += 1
+
+        # Shield the shared call so one caller disconnecting does not cancel
+        # the upstream request for everyone else
+        response, apim_request_id = await asyncio.shield(call)
+        if stream:
+            response = response.subscribe()
+
+        # Followers answer under their own completion id; it becomes the id
+        # of the stored assistant message
+        if follower:
+            response_id = new_completion_id()
+            if stream:
+                response = _rename_stream(response, response_id)
+            else:
+                response = _with_id(response, response_id)
+
+        return response, apim_request_id
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._in_flight),
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
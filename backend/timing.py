@@ -0,0 +1,41 @@
+import logging
+import time
+from typing import Awaitable, TypeVar
+
+T = TypeVar("T")
+
+SERVER_TIMING_HEADER = "Server-Timing"
+
+
+class PhaseTimer:
+    '''
+    Wall-clock durations of the phases of one request. Phases may overlap
+    (history writes run while the upstream call is in flight), so their sum
+    can exceed the total. Reported as a Server-Timing header, which browser
+    developer tools display per request, and in the debug log.
+    '''
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.phases = {}
+
+    async def measure(self, name: str, awaitable: Awaitable[T]) -> T:
+        started = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            self.record(name, time.monotonic() - started)
+
+    def record(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def header(self) -> str:
+        phases = {**self.phases, "total": self.elapsed()}
+        timings = ", ".join(
+            f"{name};dur={seconds * 1000:.1f}" for name, seconds in phases.items()
+        )
+        logging.debug(f"Request phases: {timings}")
+        return timings
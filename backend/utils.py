@@ -1,7 +1,9 @@
 import os
 import json
+import time
+import asyncio
 import logging
-import requests
+import orjson
 import dataclasses
 
 from typing import List
@@ -10,10 +12,6 @@ DEBUG = os.environ.get("DEBUG", "false")
 if DEBUG.lower() == "true":
     logging.basicConfig(level=logging.DEBUG)
 
-AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get(
-    "AZURE_SEARCH_PERMITTED_GROUPS_COLUMN"
-)
-
 
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
@@ -31,48 +29,188 @@ async def format_as_ndjson(r):
         yield json.dumps({"error": str(error)})
 
 
-def parse_multi_columns(columns: str) -> list:
-    if "|" in columns:
-        return columns.split("|")
-    else:
-        return columns.split(",")
+STREAM_FORMAT_HEADER = "X-Stream-Format"
+COMPACT_STREAM_FORMAT = "compact"
+ENVELOPE_FIELDS = ("id", "model", "created", "object", "history_metadata", "apim-request-id")
 
 
-def fetchUserGroups(userToken, nextLink=None):
-    # Recursively fetch group membership
-    if nextLink:
-        endpoint = nextLink
-    else:
-        endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
+def compact_stream_frames(response_obj, envelope):
+    '''
+    Translate one format_stream_response frame into compact frames. The
+    envelope is only emitted when it differs from the last one sent; content
+    deltas become {"c": "..."} and any other messages {"m": [...]}.
+    '''
+    if not response_obj:
+        return
+
+    if "error" in response_obj:
+        yield {"error": response_obj["error"]}
+        return
+
+    frame_envelope = {field: response_obj.get(field) for field in ENVELOPE_FIELDS}
+    if frame_envelope != envelope:
+        envelope.clear()
+        envelope.update(frame_envelope)
+        yield {"e": frame_envelope}
+
+    messages = response_obj["choices"][0]["messages"]
+    if _is_content_delta(response_obj):
+        yield {"c": messages[0]["content"]}
+    elif messages:
+        yield {"m": messages}
 
-    headers = {"Authorization": "bearer " + userToken}
+
+async def format_as_compact_ndjson(r):
+    envelope = {}
     try:
-        r = requests.get(endpoint, headers=headers)
-        if r.status_code != 200:
-            logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
-            return []
+        async for event in r:
+            for frame in compact_stream_frames(event, envelope):
+                yield orjson.dumps(frame, option=orjson.OPT_APPEND_NEWLINE)
+    except Exception as error:
+        logging.exception("Exception while generating response stream: %s", error)
+        yield orjson.dumps({"error": str(error)}, option=orjson.OPT_APPEND_NEWLINE)
 
-        r = r.json()
-        if "@odata.nextLink" in r:
-            nextLinkData = fetchUserGroups(userToken, r["@odata.nextLink"])
-            r["value"].extend(nextLinkData)
 
-        return r["value"]
-    except Exception as e:
-        logging.error(f"Exception in fetchUserGroups: {e}")
-        return []
+def _is_content_delta(response_obj) -> bool:
+    messages = response_obj.get("choices", [{}])[0].get("messages", []) if response_obj else []
+    return (
+        len(messages) == 1 and
+        messages[0].get("role") == "assistant" and
+        set(messages[0]) == {"role", "content"}
+    )
+
+
+async def coalesce_stream_responses(r, max_tokens: int, max_interval_ms: float):
+    '''
+    Merge consecutive assistant content deltas from format_stream_response
+    into one frame, flushing after max_tokens deltas or max_interval_ms since
+    the first buffered delta, whichever comes first. Either limit works on
+    its own: max_tokens of 1 or less only flushes on the interval, and an
+    interval of 0 only on the token count. Any other frame (tool context,
+    errors) flushes the buffer and passes through.
+    '''
+    token_limit = max_tokens if max_tokens > 1 else None
+    max_interval = max_interval_ms / 1000 if max_interval_ms > 0 else None
+    if token_limit is None and max_interval is None:
+        async for event in r:
+            yield event
+        return
+
+    iterator = r.__aiter__()
+    buffered = None
+    buffered_tokens = 0
+    deadline = None
+    next_event = None
+
+    def flush():
+        nonlocal buffered, buffered_tokens, deadline
+        frame = buffered
+        buffered, buffered_tokens, deadline = None, 0, None
+        return frame
 
+    try:
+        while True:
+            if next_event is None:
+                next_event = asyncio.ensure_future(iterator.__anext__())
+
+            if buffered is not None and deadline is not None:
+                # Do not hold a partially filled frame past its deadline
+                # while the upstream is slow to produce the next token
+                done, _ = await asyncio.wait(
+                    {next_event}, timeout=max(deadline - time.monotonic(), 0)
+                )
+                if not done:
+                    yield flush()
+                    continue
+
+            try:
+                event = await next_event
+            except StopAsyncIteration:
+                break
+            finally:
+                next_event = None
+
+            if not event and buffered is not None:
+                # Empty keep-alive frames carry nothing the client renders
+                continue
+
+            if _is_content_delta(event):
+                if buffered is not None and buffered["id"] == event["id"]:
+                    buffered["choices"][0]["messages"][0]["content"] += \
+                        event["choices"][0]["messages"][0]["content"]
+                else:
+                    if buffered is not None:
+                        yield flush()
+                    buffered = event
+                    if max_interval is not None:
+                        deadline = time.monotonic() + max_interval
+                buffered_tokens += 1
+
+                if token_limit is not None and buffered_tokens >= token_limit:
+                    yield flush()
+            else:
+                if buffered is not None:
+                    yield flush()
+                yield event
+
+        if buffered is not None:
+            yield flush()
+    finally:
+        if next_event is not None:
+            # Let the pending read finish before the source is closed, or
+            # closing it fails with "asynchronous generator is already running"
+            next_event.cancel()
+            await asyncio.gather(next_event, return_exceptions=True)
+
+
+async def close_stream(stream):
+    close = getattr(stream, "aclose", None) or getattr(stream, "close", None)
+    if close:
+        try:
+            await close()
+        except Exception:
+            logging.debug("Failed to close stream", exc_info=True)
+
+
+class ClosingStream:
+    '''
+    Iterates stream and closes the sources it was built from once it ends,
+    fails or is closed. Closing an async generator that has not started yet
+    does not reach the streams it reads from, so a response that is dropped
+    before its first frame would otherwise hold the upstream open.
+    '''
+
+    def __init__(self, stream, *sources):
+        self._iterator = stream.__aiter__()
+        self._sources = sources
+        self._closed = False
 
-def generateFilterString(userToken):
-    # Get list of groups user is a member of
-    userGroups = fetchUserGroups(userToken)
+    def __aiter__(self):
+        return self
 
-    # Construct filter string
-    if not userGroups:
-        logging.debug("No user groups found")
+    async def __anext__(self):
+        if self._closed:
+            raise StopAsyncIteration
+        try:
+            return await self._iterator.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
 
-    group_ids = ", ".join([obj["id"] for obj in userGroups])
-    return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
+    async def aclose(self):
+        if self._closed:
+            return
+        self._closed = True
+        await close_stream(self._iterator)
+        for source in self._sources:
+            await close_stream(source)
+
+
+def parse_multi_columns(columns: str) -> list:
+    if "|" in columns:
+        return columns.split("|")
+    else:
+        return columns.split(",")
 
 
 def format_non_streaming_response(chatCompletion, history_metadata, apim_request_id):
@@ -190,6 +328,43 @@ def format_pf_non_streaming_response(
         return {}
 
 
+def format_pf_stream_response(
+    pfChunk, history_metadata, response_field_name, citations_field_name
+):
+    '''
+    Translate one event from a streamed promptflow response into the frame
+    format_stream_response produces for Azure OpenAI.
+    '''
+    if "error" in pfChunk:
+        logging.error(f"Error in promptflow response api: {pfChunk['error']}")
+        return {"error": pfChunk["error"]}
+
+    response_obj = {
+        "id": pfChunk["id"],
+        "model": "",
+        "created": "",
+        "object": "",
+        "choices": [{"messages": []}],
+        "history_metadata": history_metadata,
+        "apim-request-id": None,
+    }
+
+    messages = response_obj["choices"][0]["messages"]
+    if pfChunk.get(citations_field_name) is not None:
+        citation_content = {"citations": pfChunk[citations_field_name]}
+        messages.append({
+            "role": "tool",
+            "content": json.dumps(citation_content)
+        })
+    if pfChunk.get(response_field_name):
+        messages.append({
+            "role": "assistant",
+            "content": pfChunk[response_field_name]
+        })
+
+    return response_obj if messages else {}
+
+
 def convert_to_pf_format(input_json, request_field_name, response_field_name):
     output_json = []
     logging.debug(f"Input json: {input_json}")
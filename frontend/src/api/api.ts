@@ -35,8 +35,19 @@ export const fetchChatHistoryInit = (): Conversation[] | null => {
   return chatHistorySampleData
 }
 
+// Where the next page of the history list starts. Pages can be shorter than
+// the page size, so the next page resumes from the last response instead of
+// the offset the caller asks for; offset 0 starts over.
+let historyListNextPage: { offset: number; continuationToken: string | null } | null = null
+
 export const historyList = async (offset = 0): Promise<Conversation[] | null> => {
-  const response = await fetch(`/history/list?offset=${offset}`, {
+  if (offset === 0) {
+    historyListNextPage = null
+  }
+  const start = historyListNextPage?.offset ?? offset
+  const continuationToken = historyListNextPage?.continuationToken
+  const query = continuationToken ? `continuation_token=${encodeURIComponent(continuationToken)}` : `offset=${start}`
+  const response = await fetch(`/history/summaries?${query}`, {
     method: 'GET'
   })
     .then(async res => {
@@ -45,26 +56,23 @@ export const historyList = async (offset = 0): Promise<Conversation[] | null> =>
         console.error('There was an issue fetching your data.')
         return null
       }
-      const conversations: Conversation[] = await Promise.all(
-        payload.map(async (conv: any) => {
-          let convMessages: ChatMessage[] = []
-          convMessages = await historyRead(conv.id)
-            .then(res => {
-              return res
-            })
-            .catch(err => {
-              console.error('error fetching messages: ', err)
-              return []
-            })
-          const conversation: Conversation = {
-            id: conv.id,
-            title: conv.title,
-            date: conv.createdAt,
-            messages: convMessages
-          }
-          return conversation
-        })
-      )
+      historyListNextPage = {
+        offset: start + payload.length,
+        continuationToken: res.headers.get('X-Continuation-Token')
+      }
+      // Messages are read with historyRead when a conversation is opened
+      const conversations: Conversation[] = payload.map((conv: any) => {
+        const conversation: Conversation = {
+          id: conv.id,
+          title: conv.title,
+          date: conv.createdAt,
+          messages: [],
+          messageCount: conv.messageCount,
+          lastMessagePreview: conv.lastMessagePreview,
+          messagesLoaded: false
+        }
+        return conversation
+      })
       return conversations
     })
     .catch(_err => {
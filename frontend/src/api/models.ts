@@ -59,6 +59,9 @@ export type Conversation = {
   title: string
   messages: ChatMessage[]
   date: string
+  messageCount?: number
+  lastMessagePreview?: string | null
+  messagesLoaded?: boolean
 }
 
 export enum ChatCompletionType {
@@ -139,6 +142,7 @@ export type FrontendSettings = {
   ui?: UI
   sanitize_answer?: boolean
   oyd_enabled?: boolean
+  replies_saved_by_server?: boolean
 }
 
 export enum Feedback {
@@ -18,7 +18,7 @@ import {
 } from '@fluentui/react'
 import { useBoolean } from '@fluentui/react-hooks'
 
-import { historyDelete, historyList, historyRename } from '../../api'
+import { historyDelete, historyList, historyRead, historyRename } from '../../api'
 import { Conversation } from '../../api/models'
 import { AppStateContext } from '../../state/AppProvider'
 
@@ -113,9 +113,18 @@ export const ChatHistoryListItemCell: React.FC<ChatHistoryListItemCellProps> = (
     setEditTitle(item?.title)
   }
 
-  const handleSelectItem = () => {
-    onSelect(item)
-    appStateContext?.dispatch({ type: 'UPDATE_CURRENT_CHAT', payload: item })
+  const handleSelectItem = async () => {
+    let conversation = item
+    if (item.messagesLoaded === false) {
+      // The history list only has summaries; read the messages when the conversation is opened
+      const messages = await historyRead(item.id)
+      conversation = { ...item, messages, messagesLoaded: true }
+    }
+    onSelect(conversation)
+    appStateContext?.dispatch({ type: 'UPDATE_CURRENT_CHAT', payload: conversation })
+    if (conversation !== item) {
+      appStateContext?.dispatch({ type: 'UPDATE_CHAT_HISTORY', payload: conversation })
+    }
   }
 
   const truncatedTitle = item?.title?.length > 28 ? `${item.title.substring(0, 28)} ...` : item.title
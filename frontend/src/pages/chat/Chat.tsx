@@ -651,8 +651,10 @@ const Chat = () => {
           return
         }
         const noContentError = appStateContext.state.currentChat.messages.find(m => m.role === ERROR)
+        // The server stores the answer itself when the stream ends
+        const repliesSavedByServer = appStateContext.state.frontendSettings?.replies_saved_by_server
 
-        if (!noContentError) {
+        if (!noContentError && !repliesSavedByServer) {
           saveToDB(appStateContext.state.currentChat.messages, appStateContext.state.currentChat.id)
             .then(res => {
               if (!res.ok) {
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import re
+import pytest
+from azure.cosmos import exceptions
+
+
+def matches(item, filter_predicate):
+    # Supports the single-comparison predicates the history client sends
+    field, value = re.fullmatch(r"from c where c\.(\w+) = (.+)", filter_predicate, re.IGNORECASE).groups()
+    return item.get(field) == (value[1:-1] if value.startswith("'") else json.loads(value))
+
+
+class FakeContainer:
+    '''
+    In-memory Cosmos DB container with single-item operations only, like SDK
+    versions without batch support. Every request waits delay seconds and
+    counts as a round trip. fail_next fails that many requests and fail_on
+    fails every request for one item id, both with a 503.
+    '''
+
+    def __init__(self, delay=0):
+        self.items = {}
+        self.delay = delay
+        self.round_trips = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.fail_next = 0
+        self.fail_on = None
+
+    async def _request(self, item_id=None):
+        self.round_trips += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        if self.fail_next or (item_id is not None and item_id == self.fail_on):
+            self.fail_next = max(self.fail_next - 1, 0)
+            raise exceptions.CosmosHttpResponseError(status_code=503, message="Service unavailable")
+
+    def _get(self, item_id):
+        if item_id not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Not found")
+        return self.items[item_id]
+
+    async def upsert_item(self, item):
+        await self._request(item["id"])
+        self.items[item["id"]] = dict(item)
+        return item
+
+    async def read_item(self, item, partition_key):
+        await self._request(item)
+        return dict(self._get(item))
+
+    async def patch_item(self, item, partition_key, patch_operations, filter_predicate=None):
+        await self._request(item)
+        target = self._get(item)
+        if filter_predicate and not matches(target, filter_predicate):
+            raise exceptions.CosmosHttpResponseError(status_code=412, message="Precondition failed")
+        for operation in patch_operations:
+            target[operation["path"].lstrip("/")] = operation["value"]
+        return target
+
+    async def delete_item(self, item, partition_key):
+        await self._request(item)
+        self._get(item)
+        del self.items[item]
+
+    def query_items(self, *args, **kwargs):
+        raise AssertionError("lookups by id should not query")
+
+
+class FakeBatchContainer(FakeContainer):
+    '''
+    Also runs transactional batches, recorded in batches as
+    (partition_key, [(operation, item_id), ...]). A batch that patches or
+    deletes a missing item fails as a whole.
+    '''
+
+    def __init__(self, delay=0):
+        super().__init__(delay)
+        self.batches = []
+
+    async def execute_item_batch(self, batch_operations, partition_key):
+        await self._request()
+        operations = [
+            (kind, args[0]["id"] if kind == "upsert" else args[0]) for kind, args in batch_operations
+        ]
+        if any(kind != "upsert" and item_id not in self.items for kind, item_id in operations):
+            raise exceptions.CosmosHttpResponseError(status_code=404, message="Not found")
+        self.batches.append((partition_key, operations))
+        for kind, args in batch_operations:
+            if kind == "upsert":
+                self.items[args[0]["id"]] = dict(args[0])
+            elif kind == "patch":
+                for operation in args[1]:
+                    self.items[args[0]][operation["path"].lstrip("/")] = operation["value"]
+            else:
+                del self.items[args[0]]
+
+
+@pytest.fixture
+def fake_container():
+    return FakeContainer
+
+
+@pytest.fixture
+def fake_batch_container():
+    return FakeBatchContainer
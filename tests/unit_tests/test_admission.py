@@ -0,0 +1,140 @@
+import asyncio
+import gc
+import pytest
+from backend.admission import AdmissionController, AdmissionRejected
+
+
+class FakeUpstream:
+    '''Stands in for Azure OpenAI with a fixed latency per request.'''
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.concurrent = 0
+        self.max_concurrent = 0
+
+    async def complete(self):
+        self.concurrent += 1
+        self.max_concurrent = max(self.max_concurrent, self.concurrent)
+        try:
+            await asyncio.sleep(self.latency)
+            return "answer"
+        finally:
+            self.concurrent -= 1
+
+    async def stream(self, tokens: int = 3):
+        for _ in range(tokens):
+            await asyncio.sleep(self.latency / tokens)
+            yield "token"
+
+
+async def call(controller, upstream, user_id):
+    admission = await controller.acquire(user_id)
+    try:
+        return await upstream.complete()
+    finally:
+        admission.release()
+
+
+@pytest.mark.asyncio
+async def test_global_limit_queues_excess_requests():
+    controller = AdmissionController(max_in_flight=2, max_per_user=10, max_queue=10, queue_timeout=5)
+    upstream = FakeUpstream(latency=0.02)
+
+    results = await asyncio.gather(*[call(controller, upstream, f"user-{i}") for i in range(6)])
+
+    assert results == ["answer"] * 6
+    assert upstream.max_concurrent == 2
+    stats = controller.stats()
+    assert stats["admitted"] == 6
+    assert stats["queued"] == 4
+    assert stats["in_flight"] == 0
+    assert stats["queue_depth"] == 0
+    assert stats["max_wait_time"] > 0
+
+
+@pytest.mark.asyncio
+async def test_per_user_limit_does_not_block_other_users():
+    controller = AdmissionController(max_in_flight=4, max_per_user=1, max_queue=10, queue_timeout=5)
+    upstream = FakeUpstream(latency=0.05)
+
+    heavy = [asyncio.create_task(call(controller, upstream, "heavy")) for _ in range(3)]
+    await asyncio.sleep(0)
+    light = asyncio.create_task(call(controller, upstream, "light"))
+    await asyncio.sleep(0.01)
+
+    # The second user is admitted while the first user's extra requests wait
+    assert upstream.concurrent == 2
+    assert controller.stats()["queue_depth"] == 2
+    await asyncio.gather(light, *heavy)
+
+
+@pytest.mark.asyncio
+async def test_full_queue_is_rejected_immediately_with_retry_after():
+    controller = AdmissionController(max_in_flight=1, max_per_user=10, max_queue=1, queue_timeout=5)
+    upstream = FakeUpstream(latency=0.05)
+
+    running = asyncio.create_task(call(controller, upstream, "a"))
+    queued = asyncio.create_task(call(controller, upstream, "b"))
+    await asyncio.sleep(0)
+
+    with pytest.raises(AdmissionRejected) as rejected:
+        await controller.acquire("c")
+
+    assert rejected.value.status_code == 429
+    assert rejected.value.retry_after >= 1
+    assert controller.stats()["rejected_queue_full"] == 1
+    await asyncio.gather(running, queued)
+
+
+@pytest.mark.asyncio
+async def test_requests_that_would_miss_the_deadline_are_rejected_up_front():
+    controller = AdmissionController(max_in_flight=1, max_per_user=10, max_queue=10, queue_timeout=0.1)
+    upstream = FakeUpstream(latency=0.08)
+
+    # Learn the service time from one request
+    await call(controller, upstream, "a")
+
+    running = asyncio.create_task(call(controller, upstream, "a"))
+    await asyncio.sleep(0)
+    queued = asyncio.create_task(call(controller, upstream, "b"))
+    await asyncio.sleep(0)
+
+    # Two requests ahead at ~0.08 s each cannot finish within 0.1 s
+    with pytest.raises(AdmissionRejected):
+        await controller.acquire("c")
+    assert controller.stats()["rejected_deadline"] == 1
+    await asyncio.gather(running, queued)
+
+
+@pytest.mark.asyncio
+async def test_queued_requests_time_out():
+    controller = AdmissionController(max_in_flight=1, max_per_user=10, max_queue=10, queue_timeout=0.02)
+    upstream = FakeUpstream(latency=0.1)
+
+    running = asyncio.create_task(call(controller, upstream, "a"))
+    await asyncio.sleep(0)
+
+    with pytest.raises(AdmissionRejected):
+        await controller.acquire("b")
+    assert controller.stats()["rejected_timeout"] == 1
+    assert controller.stats()["queue_depth"] == 0
+    await running
+
+
+@pytest.mark.asyncio
+async def test_streams_hold_their_slot_until_consumed_or_dropped():
+    controller = AdmissionController(max_in_flight=1, max_per_user=1, max_queue=1, queue_timeout=1)
+    upstream = FakeUpstream(latency=0.01)
+
+    admission = await controller.acquire("a")
+    stream = admission.hold(upstream.stream())
+    assert controller.stats()["in_flight"] == 1
+    assert [token async for token in stream] == ["token"] * 3
+    assert controller.stats()["in_flight"] == 0
+
+    # A response that is never read still gives its slot back
+    admission = await controller.acquire("a")
+    stream = admission.hold(upstream.stream())
+    del stream
+    gc.collect()
+    assert controller.stats()["in_flight"] == 0
@@ -0,0 +1,95 @@
+import base64
+import json
+import time
+from backend.auth.auth_utils import (
+    decode_client_principal,
+    decode_jwt_claims,
+    get_group_ids_from_claims,
+)
+
+USER_ID = "00000000-0000-0000-0000-000000000001"
+OBJECT_ID_CLAIM = "http://schemas.microsoft.com/identity/claims/objectidentifier"
+GROUPS_CLAIM = "groups"
+
+
+def encode_principal(claims):
+    principal = {
+        "auth_typ": "aad",
+        "claims": [{"typ": typ, "val": val} for typ, val in claims],
+        "name_typ": "name",
+        "role_typ": "roles",
+    }
+    return base64.b64encode(json.dumps(principal).encode()).decode()
+
+
+def encode_jwt(payload):
+    def segment(obj):
+        return base64.urlsafe_b64encode(json.dumps(obj).encode()).decode().rstrip("=")
+
+    return f"{segment({'alg': 'RS256', 'typ': 'JWT'})}.{segment(payload)}.signature"
+
+
+def test_decode_client_principal_groups_claims_by_type():
+    claims = decode_client_principal(encode_principal([
+        (OBJECT_ID_CLAIM, USER_ID), (GROUPS_CLAIM, "group-1"), (GROUPS_CLAIM, "group-2")
+    ]))
+
+    assert claims[GROUPS_CLAIM] == ["group-1", "group-2"]
+    assert decode_client_principal("not base64 json") is None
+    assert decode_jwt_claims("not-a-jwt") is None
+
+
+def test_groups_are_read_from_the_client_principal():
+    headers = {
+        "X-Ms-Client-Principal-Id": USER_ID,
+        "X-Ms-Client-Principal": encode_principal([
+            (OBJECT_ID_CLAIM, USER_ID), (GROUPS_CLAIM, "group-1"), (GROUPS_CLAIM, "group-2")
+        ]),
+    }
+
+    assert get_group_ids_from_claims(headers) == ["group-1", "group-2"]
+
+
+def test_groups_fall_back_to_the_id_token():
+    headers = {
+        "X-Ms-Client-Principal-Id": USER_ID,
+        "X-Ms-Client-Principal": encode_principal([(OBJECT_ID_CLAIM, USER_ID)]),
+        "X-Ms-Token-Aad-Id-Token": encode_jwt({
+            "oid": USER_ID, "exp": time.time() + 3600, "groups": ["group-3"]
+        }),
+    }
+
+    assert get_group_ids_from_claims(headers) == ["group-3"]
+
+
+def test_group_overage_requires_graph():
+    headers = {
+        "X-Ms-Client-Principal-Id": USER_ID,
+        "X-Ms-Client-Principal": encode_principal([
+            (OBJECT_ID_CLAIM, USER_ID), ("_claim_names", '{"groups":"src1"}')
+        ]),
+        "X-Ms-Token-Aad-Id-Token": encode_jwt({
+            "oid": USER_ID,
+            "exp": time.time() + 3600,
+            "_claim_names": {"groups": "src1"},
+            "_claim_sources": {"src1": {"endpoint": "https://graph.microsoft.com/v1.0/users/x/getMemberObjects"}},
+        }),
+    }
+
+    assert get_group_ids_from_claims(headers) is None
+
+
+def test_claims_of_another_user_or_expired_tokens_are_ignored():
+    assert get_group_ids_from_claims({
+        "X-Ms-Client-Principal": encode_principal([(OBJECT_ID_CLAIM, USER_ID), (GROUPS_CLAIM, "group-1")]),
+    }) is None
+    assert get_group_ids_from_claims({
+        "X-Ms-Client-Principal-Id": "someone-else",
+        "X-Ms-Client-Principal": encode_principal([(OBJECT_ID_CLAIM, USER_ID), (GROUPS_CLAIM, "group-1")]),
+    }) is None
+    assert get_group_ids_from_claims({
+        "X-Ms-Client-Principal-Id": USER_ID,
+        "X-Ms-Token-Aad-Id-Token": encode_jwt({
+            "oid": USER_ID, "exp": time.time() - 60, "groups": ["group-3"]
+        }),
+    }) is None
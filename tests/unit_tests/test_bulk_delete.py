@@ -0,0 +1,104 @@
+import asyncio
+import pytest
+from azure.cosmos.aio import ContainerProxy
+from backend.history.bulk_delete import BulkDeleter, DeleteJobs
+
+
+def add_items(container, count):
+    ids = [f"item-{i}" for i in range(count)]
+    for item_id in ids:
+        container.items[item_id] = {"id": item_id}
+    return ids
+
+
+def test_pinned_sdk_runs_batches():
+    # The batch path is only taken when the SDK provides it
+    assert hasattr(ContainerProxy, "execute_item_batch")
+
+
+@pytest.mark.asyncio
+async def test_deletes_in_batches_and_reports_progress(fake_batch_container):
+    container = fake_batch_container()
+    ids = add_items(container, 250)
+    progress = []
+
+    async def on_progress(done):
+        progress.append(done)
+
+    deleter = BulkDeleter(container)
+    assert await deleter.delete_items("user-1", ids, on_progress) == 250
+    assert not container.items
+    assert sorted(len(operations) for _, operations in container.batches) == [50, 100, 100]
+    assert sorted(progress)[-1] == 250
+    assert deleter.stats()["batches"] == 3
+
+
+@pytest.mark.asyncio
+async def test_missing_item_falls_back_to_single_deletes(fake_batch_container):
+    container = fake_batch_container()
+    ids = add_items(container, 3)
+    del container.items["item-1"]
+
+    deleter = BulkDeleter(container)
+    assert await deleter.delete_items("user-1", ids) == 3
+    assert not container.items
+    assert deleter.stats()["missing"] == 1
+
+
+@pytest.mark.asyncio
+async def test_single_deletes_are_bounded(fake_container):
+    container = fake_container(delay=0.001)
+    ids = add_items(container, 50)
+
+    deleter = BulkDeleter(container, max_batch_size=10, max_concurrency=4)
+    await deleter.delete_items("user-1", ids)
+    assert not container.items
+    assert container.max_in_flight == 4
+
+
+@pytest.mark.asyncio
+async def test_delete_job_records_result(fake_container):
+    container = fake_container()
+    ids = add_items(container, 5)
+    jobs = DeleteJobs(container, BulkDeleter(container))
+
+    job = await jobs.start("user-1", ids)
+    assert job["status"] == "running"
+    assert (await jobs.get("user-1", job["id"]))["total"] == 5
+
+    await asyncio.gather(*jobs._tasks)
+    job = await jobs.get("user-1", job["id"])
+    assert job["status"] == "succeeded"
+    assert job["deleted"] == 5
+    assert await jobs.get("user-1", "missing") is None
+
+
+@pytest.mark.asyncio
+async def test_failed_delete_job_records_error(fake_container):
+    container = fake_container()
+    ids = add_items(container, 5)
+    container.fail_on = "item-2"
+    jobs = DeleteJobs(container, BulkDeleter(container))
+
+    job = await jobs.start("user-1", ids)
+    await asyncio.gather(*jobs._tasks)
+
+    job = await jobs.get("user-1", job["id"])
+    assert job["status"] == "failed"
+    assert "Service unavailable" in job["error"]
+    assert jobs.stats()["failed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_close_interrupts_running_jobs(fake_container):
+    container = fake_container(delay=0.05)
+    ids = add_items(container, 5)
+    jobs = DeleteJobs(container, BulkDeleter(container))
+
+    job = await jobs.start("user-1", ids)
+    await asyncio.sleep(0.01)
+    await jobs.close()
+
+    job = await jobs.get("user-1", job["id"])
+    assert job["status"] == "failed"
+    assert job["error"] == "Interrupted by a server restart"
@@ -0,0 +1,241 @@
+import pytest
+import pytest_asyncio
+from collections import Counter
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.summarizer import apply_conversation_summary
+
+
+class FakePages:
+    def __init__(self, items, page_size, continuation_token):
+        self.items = items
+        self.page_size = page_size
+        self.start = int(continuation_token or 0)
+        self.continuation_token = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.start >= len(self.items):
+            raise StopAsyncIteration
+        page = self.items[self.start:self.start + self.page_size]
+        self.start += self.page_size
+        self.continuation_token = str(self.start) if self.start < len(self.items) else None
+
+        async def items():
+            for item in page:
+                yield item
+        return items()
+
+
+@pytest.fixture
+def query_container(fake_container):
+    class FakeQueryContainer(fake_container):
+        def __init__(self):
+            super().__init__()
+            self.queries = []
+
+        def query_items(self, query, parameters, partition_key=None, max_item_count=None):
+            self.queries.append((query, partition_key))
+            if "GROUP BY" in query:
+                conversation_ids = parameters[1]["value"]
+                messages = [
+                    item for item in self.items.values()
+                    if item["type"] == "message" and item["role"] != "tool" and item["conversationId"] in conversation_ids
+                ]
+                items = [
+                    {"conversationId": conversation_id, "messageCount": count}
+                    for conversation_id, count in Counter(m["conversationId"] for m in messages).items()
+                ]
+            else:
+                items = sorted(
+                    (item for item in self.items.values() if item["type"] == "conversation"),
+                    key=lambda item: item["updatedAt"],
+                    reverse=True
+                )
+
+            class Query:
+                def by_page(self, continuation_token=None):
+                    return FakePages(items, max_item_count, continuation_token)
+
+                async def __aiter__(self):
+                    for item in items:
+                        yield item
+            return Query()
+
+    return FakeQueryContainer()
+
+
+@pytest_asyncio.fixture
+async def conversation_client():
+    client = CosmosConversationClient("https://localhost:8081/", "a2V5", "db", "conversations")
+    yield client
+    await client.close()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("batch, round_trips", [(False, 2), (True, 1)])
+async def test_create_message_touches_conversation(conversation_client, fake_container, fake_batch_container, batch, round_trips):
+    container = (fake_batch_container if batch else fake_container)()
+    container.items["conv-1"] = {"id": "conv-1", "type": "conversation", "updatedAt": "old"}
+    conversation_client.container_client = container
+
+    message = await conversation_client.create_message(
+        "msg-1", "conv-1", "user-1", {"role": "user", "content": "hello"}
+    )
+
+    assert message["id"] == "msg-1"
+    assert container.items["msg-1"]["content"] == "hello"
+    assert container.items["conv-1"]["updatedAt"] == container.items["msg-1"]["createdAt"]
+    assert container.round_trips == round_trips
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("batch", [False, True])
+async def test_create_message_conversation_not_found(conversation_client, fake_container, fake_batch_container, batch):
+    conversation_client.container_client = (fake_batch_container if batch else fake_container)()
+
+    result = await conversation_client.create_message(
+        "msg-1", "missing", "user-1", {"role": "user", "content": "hello"}
+    )
+
+    assert result == "Conversation not found"
+    assert "msg-1" not in conversation_client.container_client.items
+
+
+@pytest.mark.asyncio
+async def test_write_behind_can_be_skipped_per_message(fake_batch_container):
+    client = CosmosConversationClient(
+        "https://localhost:8081/", "a2V5", "db", "conversations", write_behind_options={"flush_interval": 60}
+    )
+    container = fake_batch_container()
+    container.items["conv-1"] = {"id": "conv-1", "type": "conversation", "updatedAt": "old"}
+    client.container_client = client.write_buffer.container_client = container
+    try:
+        await client.create_message("msg-1", "conv-1", "user-1", {"role": "assistant", "content": "queued"})
+        assert "msg-1" not in container.items
+
+        result = await client.create_message(
+            "msg-2", "missing", "user-1", {"role": "user", "content": "hello"}, write_behind=False
+        )
+        assert result == "Conversation not found"
+        assert "msg-2" not in container.items
+        # the queued write of the same user was flushed first
+        assert "msg-1" in container.items
+    finally:
+        await client.close()
+
+
+@pytest.mark.asyncio
+async def test_lookups_by_id_are_point_reads(conversation_client, fake_container):
+    container = fake_container()
+    container.items["conv-1"] = {"id": "conv-1", "type": "conversation"}
+    container.items["msg-1"] = {"id": "msg-1", "type": "message", "feedback": ""}
+    conversation_client.container_client = container
+
+    assert (await conversation_client.get_conversation("user-1", "conv-1"))["id"] == "conv-1"
+    assert await conversation_client.get_conversation("user-1", "missing") is None
+    assert await conversation_client.get_conversation("user-1", "msg-1") is None
+
+    feedback = await conversation_client.update_message_feedback("user-1", "msg-1", "positive")
+    assert feedback["feedback"] == "positive"
+    assert await conversation_client.update_message_feedback("user-1", "missing", "positive") is False
+
+    await conversation_client.delete_conversation("user-1", "conv-1")
+    assert "conv-1" not in container.items
+    assert await conversation_client.delete_conversation("user-1", "conv-1") is True
+    assert container.round_trips == 8
+
+
+@pytest.mark.asyncio
+async def test_item_types_are_checked_before_writes(conversation_client, fake_container):
+    container = fake_container()
+    container.items["conv-1"] = {"id": "conv-1", "type": "conversation"}
+    container.items["msg-1"] = {"id": "msg-1", "type": "message", "feedback": ""}
+    conversation_client.container_client = container
+
+    assert await conversation_client.update_message_feedback("user-1", "conv-1", "positive") is False
+    assert "feedback" not in container.items["conv-1"]
+
+    assert await conversation_client.delete_conversation("user-1", "msg-1") is False
+    assert "msg-1" in container.items
+
+
+@pytest.mark.asyncio
+async def test_conversations_are_paged_with_continuation_tokens(conversation_client, query_container):
+    container = query_container
+    for i in range(5):
+        container.items[f"conv-{i}"] = {"id": f"conv-{i}", "type": "conversation", "updatedAt": str(i)}
+    conversation_client.container_client = container
+
+    page, token = await conversation_client.get_conversations_page("user-1", 2)
+    assert [c["id"] for c in page] == ["conv-4", "conv-3"]
+    ids = [c["id"] for c in page]
+    while token:
+        page, token = await conversation_client.get_conversations_page("user-1", 2, continuation_token=token)
+        ids.extend(c["id"] for c in page)
+
+    assert ids == ["conv-4", "conv-3", "conv-2", "conv-1", "conv-0"]
+    assert all(partition_key == "user-1" and "offset" not in query for query, partition_key in container.queries)
+
+    with pytest.raises(ValueError):
+        await conversation_client.get_conversations_page("user-1", 2, continuation_token="not a token")
+
+
+@pytest.mark.asyncio
+async def test_conversation_summaries_count_messages_on_request(conversation_client, query_container):
+    container = query_container
+    conversation_client.container_client = container
+    for i in range(3):
+        container.items[f"conv-{i}"] = {"id": f"conv-{i}", "type": "conversation", "updatedAt": str(i)}
+    for role, content in [("user", "hello " * 30), ("tool", "{}"), ("assistant", "hi")]:
+        await conversation_client.create_message(
+            f"conv-2-{role}", "conv-2", "user-1", {"role": role, "content": content}
+        )
+
+    summaries, token = await conversation_client.get_conversation_summaries("user-1", 2)
+
+    assert [s["id"] for s in summaries] == ["conv-2", "conv-1"]
+    assert summaries[0]["lastMessagePreview"] == "hi"
+    assert summaries[1]["lastMessagePreview"] is None
+    assert "messageCount" not in summaries[0]
+    assert len(container.queries) == 1
+
+    summaries, _ = await conversation_client.get_conversation_summaries("user-1", 2, count_messages=True)
+    assert summaries[0]["messageCount"] == 2
+    assert summaries[1]["messageCount"] == 0
+    assert len(container.queries) == 3
+
+    summaries, token = await conversation_client.get_conversation_summaries("user-1", 2, continuation_token=token)
+    assert [s["id"] for s in summaries] == ["conv-0"]
+    assert token is None
+
+
+@pytest.mark.asyncio
+async def test_message_preview_is_truncated(conversation_client, fake_container):
+    container = fake_container()
+    container.items["conv-1"] = {"id": "conv-1", "type": "conversation"}
+    conversation_client.container_client = container
+
+    await conversation_client.create_message("msg-1", "conv-1", "user-1", {"role": "user", "content": "a" * 500})
+    assert container.items["conv-1"]["lastMessagePreview"] == "a" * 100
+
+
+@pytest.mark.asyncio
+async def test_cleared_conversation_drops_its_summary(conversation_client, fake_container):
+    container = fake_container()
+    container.items["conv-1"] = {
+        "id": "conv-1",
+        "type": "conversation",
+        "lastMessagePreview": "old",
+        "summary": {"content": "deleted turns", "coveredTurns": 2},
+    }
+    conversation_client.container_client = container
+
+    await conversation_client.reset_cleared_conversation("user-1", "conv-1")
+
+    conversation = container.items["conv-1"]
+    assert conversation["lastMessagePreview"] is None
+    messages = [{"role": "user", "content": str(i)} for i in range(4)]
+    assert apply_conversation_summary(messages, conversation["summary"]) == messages
+    assert await conversation_client.reset_cleared_conversation("user-1", "missing") is False
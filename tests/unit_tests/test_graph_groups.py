@@ -0,0 +1,144 @@
+import asyncio
+import pytest
+import pytest_asyncio
+from aiohttp import web
+from backend.security.graph_groups import (
+    GraphClient,
+    GroupFilterResolver,
+    build_filter_string,
+)
+
+USER_GROUPS = {
+    "token-a": ["group-1", "group-2", "group-3"],
+    "token-b": ["group-4"],
+}
+
+
+@pytest_asyncio.fixture
+async def graph_server():
+    # Minimal stand-in for /me/transitiveMemberOf, one group per page
+    state = {"requests": 0, "delay": 0}
+
+    async def transitive_member_of(request):
+        state["requests"] += 1
+        await asyncio.sleep(state["delay"])
+        token = request.headers["Authorization"].partition(" ")[2]
+        if token not in USER_GROUPS:
+            return web.json_response({"error": {"code": "InvalidAuthenticationToken"}}, status=401)
+
+        page = int(request.query.get("page", "0"))
+        groups = USER_GROUPS[token]
+        body = {"value": [{"id": groups[page]}]}
+        if page + 1 < len(groups):
+            body["@odata.nextLink"] = f"http://{request.host}{request.path}?$select=id&page={page + 1}"
+        return web.json_response(body)
+
+    app = web.Application()
+    app.router.add_get("/v1.0/me/transitiveMemberOf", transitive_member_of)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    yield f"http://127.0.0.1:{port}/v1.0", state
+
+    await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_graph_client_follows_next_links(graph_server):
+    endpoint, state = graph_server
+    graph_client = GraphClient(endpoint=endpoint)
+    try:
+        assert await graph_client.fetch_user_group_ids("token-a") == ["group-1", "group-2", "group-3"]
+    finally:
+        await graph_client.close()
+
+    assert state["requests"] == 3
+    assert graph_client.requests == 3
+
+
+@pytest.mark.asyncio
+async def test_resolver_caches_filter_per_user(graph_server):
+    endpoint, state = graph_server
+    resolver = GroupFilterResolver(GraphClient(endpoint=endpoint), "group_ids")
+    try:
+        first = await resolver.get_filter("token-a")
+        second = await resolver.get_filter("token-a")
+        other = await resolver.get_filter("token-b")
+    finally:
+        await resolver.close()
+
+    assert first == second == "group_ids/any(g:search.in(g, 'group-1, group-2, group-3'))"
+    assert other == "group_ids/any(g:search.in(g, 'group-4'))"
+    assert state["requests"] == 4
+    assert resolver.stats()["hits"] == 1
+    assert resolver.stats()["entries"] == 2
+
+
+@pytest.mark.asyncio
+async def test_concurrent_lookups_share_one_graph_call(graph_server):
+    endpoint, state = graph_server
+    state["delay"] = 0.05
+    resolver = GroupFilterResolver(GraphClient(endpoint=endpoint), "group_ids")
+    try:
+        filters = await asyncio.gather(*[resolver.get_filter("token-b") for _ in range(10)])
+    finally:
+        await resolver.close()
+
+    assert set(filters) == {"group_ids/any(g:search.in(g, 'group-4'))"}
+    assert state["requests"] == 1
+
+
+@pytest.mark.asyncio
+async def test_failed_lookups_match_no_groups_and_are_not_cached(graph_server):
+    endpoint, state = graph_server
+    resolver = GroupFilterResolver(GraphClient(endpoint=endpoint), "group_ids")
+    try:
+        assert await resolver.get_filter("expired") == build_filter_string("group_ids", [])
+        await resolver.get_filter("expired")
+    finally:
+        await resolver.close()
+
+    assert state["requests"] == 2
+    assert resolver.stats()["errors"] == 2
+    assert resolver.stats()["entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_cache_is_bounded_and_expires(graph_server):
+    endpoint, state = graph_server
+    resolver = GroupFilterResolver(GraphClient(endpoint=endpoint), "group_ids", ttl=0.05, max_entries=1)
+    try:
+        await resolver.get_filter("token-a")
+        await resolver.get_filter("token-b")
+        assert resolver.stats()["entries"] == 1
+
+        await asyncio.sleep(0.06)
+        await resolver.get_filter("token-b")
+    finally:
+        await resolver.close()
+
+    assert resolver.stats()["hits"] == 0
+    assert state["requests"] == 5
+
+
+@pytest.mark.asyncio
+async def test_claims_are_used_before_graph(graph_server):
+    from tests.unit_tests.test_auth_utils import OBJECT_ID_CLAIM, USER_ID, encode_principal
+
+    endpoint, state = graph_server
+    resolver = GroupFilterResolver(GraphClient(endpoint=endpoint), "group_ids", use_claims=True)
+    headers = {
+        "X-Ms-Client-Principal-Id": USER_ID,
+        "X-Ms-Client-Principal": encode_principal([(OBJECT_ID_CLAIM, USER_ID), ("groups", "group-9")]),
+    }
+    try:
+        assert resolver.get_filter_from_claims(headers) == "group_ids/any(g:search.in(g, 'group-9'))"
+        assert resolver.get_filter_from_claims({}) is None
+    finally:
+        await resolver.close()
+
+    assert state["requests"] == 0
+    assert resolver.stats()["claims_resolved"] == 1
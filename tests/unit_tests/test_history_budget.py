@@ -0,0 +1,70 @@
+import functools
+import json
+from backend.history.budget import HistoryBudgeter, MESSAGE_OVERHEAD_TOKENS
+
+
+class WordCounter:
+    # One token per word keeps the arithmetic in these tests readable
+    def __init__(self):
+        self.count = functools.lru_cache(maxsize=None)(lambda text: len(text.split()))
+
+
+def conversation(turns, context_words=0):
+    messages = [{"role": "system", "content": "be brief"}]
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i}"})
+        answer = {"role": "assistant", "content": f"answer {i}"}
+        if context_words:
+            answer["context"] = json.dumps({"citations": ["word " * context_words]})
+        messages.append(answer)
+    messages.append({"role": "user", "content": "latest question"})
+    return messages
+
+
+def test_history_within_budget_is_untouched():
+    budgeter = HistoryBudgeter(WordCounter(), max_prompt_tokens=1000)
+    messages = conversation(3, context_words=10)
+
+    trimmed, saved = budgeter.trim(messages)
+
+    assert trimmed == messages
+    assert saved == 0
+
+
+def test_old_contexts_are_dropped_before_turns():
+    budgeter = HistoryBudgeter(WordCounter(), max_prompt_tokens=60)
+    messages = conversation(2, context_words=50)
+
+    trimmed, saved = budgeter.trim(messages)
+
+    assert len(trimmed) == len(messages)
+    assert not any("context" in m for m in trimmed[:-2])
+    assert saved > 0
+    assert budgeter.stats()["contexts_dropped"] == 2
+
+
+def test_oldest_turns_are_dropped_keeping_system_and_latest():
+    per_message = MESSAGE_OVERHEAD_TOKENS + 2
+    budgeter = HistoryBudgeter(WordCounter(), max_prompt_tokens=per_message * 4)
+    messages = conversation(5)
+
+    trimmed, saved = budgeter.trim(messages)
+
+    assert trimmed[0] == messages[0]
+    assert trimmed[-1] == messages[-1]
+    assert trimmed[1]["role"] == "user"
+    assert [m["content"] for m in trimmed[1:]] == ["question 4", "answer 4", "latest question"]
+    assert saved == per_message * 8
+    stats = budgeter.stats()
+    assert stats["tokens_saved"] == saved
+    assert stats["messages_dropped"] == 8
+
+
+def test_history_resumes_on_a_user_turn():
+    per_message = MESSAGE_OVERHEAD_TOKENS + 2
+    budgeter = HistoryBudgeter(WordCounter(), max_prompt_tokens=per_message * 3)
+    messages = conversation(3)
+
+    trimmed, _ = budgeter.trim(messages)
+
+    assert [m["role"] for m in trimmed] == ["system", "user"]
@@ -0,0 +1,104 @@
+import asyncio
+import os
+import time
+import pytest
+from importlib import import_module, reload
+from azure.core.credentials import AccessToken
+from backend import openai_client
+from backend.openai_client import AzureADTokenCache, AzureOpenAIClientManager
+
+
+class FakeCredential:
+    def __init__(self, lifetime=3600):
+        self.lifetime = lifetime
+        self.calls = 0
+        self.closed = False
+
+    async def get_token(self, scope):
+        self.calls += 1
+        return AccessToken(f"token-{self.calls}", int(time.time() + self.lifetime))
+
+    async def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_token_cache_reuses_token():
+    credential = FakeCredential()
+    token_cache = AzureADTokenCache(credential)
+    await token_cache.start()
+
+    assert await token_cache.get_token() == "token-1"
+    assert await token_cache.get_token() == "token-1"
+    assert credential.calls == 1
+
+    await token_cache.close()
+    assert credential.closed
+
+
+@pytest.mark.asyncio
+async def test_token_cache_refreshes_expiring_token():
+    credential = FakeCredential(lifetime=30)
+    token_cache = AzureADTokenCache(credential, refresh_margin=10)
+
+    assert await token_cache.get_token() == "token-1"
+    # Within a minute of expiry the next caller refreshes inline
+    assert await token_cache.get_token() == "token-2"
+    assert token_cache.stats()["refresh_count"] == 2
+
+
+@pytest.mark.asyncio
+async def test_refresh_loop_waits_for_short_lived_tokens():
+    credential = FakeCredential(lifetime=30)
+    token_cache = AzureADTokenCache(credential, refresh_margin=300)
+    await token_cache.start()
+
+    await asyncio.sleep(0.05)
+    assert credential.calls == 1
+
+    await token_cache.close()
+
+
+@pytest.fixture
+def app_module(monkeypatch):
+    monkeypatch.setenv("DOTENV_PATH", os.path.join(os.path.dirname(__file__), "dotenv_data", "missing"))
+    monkeypatch.setenv("AZURE_OPENAI_RESOURCE", "dummy")
+    monkeypatch.setenv("AZURE_OPENAI_KEY", "dummy")
+    monkeypatch.setenv("AZURE_OPENAI_MODEL", "gpt-4o")
+    reload(import_module("backend.settings"))
+    return reload(import_module("app"))
+
+
+@pytest.mark.asyncio
+async def test_requests_share_one_client(app_module, monkeypatch):
+    http_clients = []
+
+    def make_http_client(**kwargs):
+        http_clients.append(openai_client.httpx.AsyncClient(**kwargs))
+        return http_clients[-1]
+
+    monkeypatch.setattr(openai_client, "DefaultAsyncHttpxClient", make_http_client)
+    app = app_module.create_app()
+
+    async with app.app_context():
+        first, second = await asyncio.gather(
+            app_module.get_openai_client(), app_module.get_openai_client()
+        )
+        assert first is second
+        assert first is await app_module.get_openai_client()
+
+    assert len(http_clients) == 1
+    assert app.openai_client_manager.token_cache is None
+    stats = app.openai_client_manager.stats()
+    assert stats["requests_sent"] == 0
+    assert stats["endpoint"].startswith("https://dummy.openai.azure.com")
+
+    await app.openai_client_manager.close()
+
+
+def test_client_manager_requires_auth():
+    with pytest.raises(ValueError):
+        AzureOpenAIClientManager(
+            endpoint="https://dummy.openai.azure.com/",
+            api_version="2024-05-01-preview",
+        )
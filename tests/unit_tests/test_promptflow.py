@@ -0,0 +1,99 @@
+import json
+import httpx
+import pytest
+from backend.promptflow import PromptflowClient
+from backend.utils import format_pf_stream_response
+
+REQUEST = {
+    "messages": [
+        {"id": "1", "role": "user", "content": "What is Contoso?"},
+        {"id": "2", "role": "assistant", "content": "A company."},
+        {"id": "3", "role": "user", "content": "Where is it?"},
+    ]
+}
+
+
+def make_client(handler):
+    return PromptflowClient(
+        "https://pf.example.com/score",
+        "key",
+        transport=httpx.MockTransport(handler)
+    )
+
+
+async def collect(client):
+    return [event async for event in client.stream(REQUEST)]
+
+
+@pytest.mark.asyncio
+async def test_stream_yields_events():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        body = (
+            'data: {"documents": [{"title": "doc"}]}\n\n'
+            'data: {"reply": "Red"}\n\n'
+            'data: {"reply": "mond"}\n\n'
+        )
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=body)
+
+    client = make_client(handler)
+    events = await collect(client)
+    await client.close()
+
+    assert events == [
+        {"documents": [{"title": "doc"}], "id": "3"},
+        {"reply": "Red", "id": "3"},
+        {"reply": "mond", "id": "3"},
+    ]
+    assert requests[0].headers["Accept"] == "text/event-stream"
+    assert requests[0].headers["Authorization"] == "Bearer key"
+    assert json.loads(requests[0].content) == {
+        "query": "Where is it?",
+        "chat_history": [{"inputs": {"query": "What is Contoso?"}, "outputs": {"reply": "A company."}}],
+    }
+    assert client.stats() == {"requests": 1, "streamed_requests": 1}
+
+
+@pytest.mark.asyncio
+async def test_stream_falls_back_to_json_response():
+    def handler(request):
+        return httpx.Response(200, json={"reply": "Redmond", "documents": []})
+
+    client = make_client(handler)
+    events = await collect(client)
+    await client.close()
+
+    assert events == [{"reply": "Redmond", "documents": [], "id": "3"}]
+    assert client.stats() == {"requests": 1, "streamed_requests": 0}
+
+
+@pytest.mark.asyncio
+async def test_complete():
+    def handler(request):
+        return httpx.Response(200, json={"reply": "Redmond"})
+
+    client = make_client(handler)
+    assert await client.complete(REQUEST) == {"reply": "Redmond", "id": "3"}
+    await client.close()
+
+
+def test_format_pf_stream_response():
+    history_metadata = {"conversation_id": "c"}
+    content = format_pf_stream_response(
+        {"id": "3", "reply": "Red"}, history_metadata, "reply", "documents"
+    )
+    assert content["id"] == "3"
+    assert content["history_metadata"] == history_metadata
+    assert content["choices"] == [{"messages": [{"role": "assistant", "content": "Red"}]}]
+
+    citations = format_pf_stream_response(
+        {"id": "3", "documents": [{"title": "doc"}]}, history_metadata, "reply", "documents"
+    )
+    assert citations["choices"][0]["messages"] == [
+        {"role": "tool", "content": json.dumps({"citations": [{"title": "doc"}]})}
+    ]
+
+    assert format_pf_stream_response({"id": "3", "reply": ""}, {}, "reply", "documents") == {}
+    assert format_pf_stream_response({"error": "boom"}, {}, "reply", "documents") == {"error": "boom"}
@@ -0,0 +1,127 @@
+import time
+import pytest
+from types import SimpleNamespace
+from backend.rate_limit import (
+    FileQuotaState,
+    QuotaLimiter,
+    RateLimitExceeded,
+    get_retry_after,
+)
+
+
+@pytest.mark.asyncio
+async def test_requests_wait_for_token_quota():
+    # 6000 TPM with a 1 second bucket: 100 tokens now, 100 more per second
+    limiter = QuotaLimiter(tokens_per_minute=6000, burst_seconds=1, max_wait=5)
+
+    await limiter.acquire(60, max_tokens=40)
+    started = time.monotonic()
+    await limiter.acquire(10, max_tokens=10)
+    waited = time.monotonic() - started
+
+    assert 0.1 <= waited < 0.5
+    assert limiter.stats()["delayed_requests"] == 1
+
+
+@pytest.mark.asyncio
+async def test_settling_returns_unused_tokens():
+    limiter = QuotaLimiter(tokens_per_minute=6000, burst_seconds=1, max_wait=0.05)
+
+    reservation = await limiter.acquire(20, max_tokens=80)
+    reservation.settle(25)
+
+    # The 75 unused tokens are available again without waiting
+    await limiter.acquire(50, max_tokens=20)
+    assert limiter.stats()["delayed_requests"] == 0
+    assert limiter.stats()["used_tokens"] == 25
+
+
+@pytest.mark.asyncio
+async def test_requests_per_minute_quota():
+    limiter = QuotaLimiter(requests_per_minute=60, burst_seconds=1, max_wait=0.01)
+
+    await limiter.acquire(1)
+    with pytest.raises(RateLimitExceeded) as exceeded:
+        await limiter.acquire(1)
+
+    assert exceeded.value.status_code == 429
+    assert exceeded.value.retry_after == 1
+    assert limiter.stats()["rejected_requests"] == 1
+
+
+@pytest.mark.asyncio
+async def test_retry_after_ms_pauses_requests():
+    limiter = QuotaLimiter(tokens_per_minute=600000, max_wait=5)
+    error = SimpleNamespace(response=SimpleNamespace(headers={"retry-after-ms": "150"}))
+    assert get_retry_after(error) == 0.15
+
+    reservation = await limiter.acquire(10, max_tokens=10)
+    reservation.cancel(error)
+    started = time.monotonic()
+    await limiter.acquire(10, max_tokens=10)
+
+    assert time.monotonic() - started >= 0.1
+    assert limiter.stats()["pauses"] == 1
+    assert limiter.stats()["used_tokens"] == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not FileQuotaState.supported(), reason="flock is only available on POSIX systems")
+async def test_workers_share_quota_through_state_file(tmp_path):
+    state_file = str(tmp_path / "quota")
+    worker_a = QuotaLimiter(tokens_per_minute=6000, burst_seconds=1, max_wait=0.01, state=FileQuotaState(state_file))
+    worker_b = QuotaLimiter(tokens_per_minute=6000, burst_seconds=1, max_wait=0.01, state=FileQuotaState(state_file))
+
+    await worker_a.acquire(90)
+    with pytest.raises(RateLimitExceeded):
+        await worker_b.acquire(90)
+
+
+@pytest.mark.asyncio
+async def test_streams_are_settled_from_usage_or_content():
+    limiter = QuotaLimiter(tokens_per_minute=600000)
+
+    def chunk(content, usage=None):
+        return SimpleNamespace(
+            choices=[SimpleNamespace(delta=SimpleNamespace(content=content))] if content else [],
+            usage=usage
+        )
+
+    async def stream(chunks):
+        for c in chunks:
+            yield c
+
+    reservation = await limiter.acquire(10, max_tokens=100)
+    async for _ in reservation.track_stream(
+        stream([chunk("Hello"), chunk(None, SimpleNamespace(total_tokens=42))]), len
+    ):
+        pass
+    assert limiter.stats()["used_tokens"] == 42
+
+    reservation = await limiter.acquire(10, max_tokens=100)
+    async for _ in reservation.track_stream(stream([chunk("Hello"), chunk(" world")]), len):
+        pass
+    assert limiter.stats()["used_tokens"] == 42 + 10 + len("Hello world")
+
+
+@pytest.mark.asyncio
+async def test_closing_an_unread_stream_settles_the_reservation():
+    limiter = QuotaLimiter(tokens_per_minute=600000)
+    closed = []
+
+    class Upstream:
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            raise StopAsyncIteration
+
+        async def close(self):
+            closed.append(self)
+
+    reservation = await limiter.acquire(10, max_tokens=100)
+    await reservation.track_stream(Upstream(), len).aclose()
+
+    assert reservation.settled
+    assert limiter.stats()["used_tokens"] == 10
+    assert len(closed) == 1
@@ -0,0 +1,101 @@
+import json
+import pytest
+from backend.history.replies import ReplySaver, tool_message_id
+
+
+class FakeConversationClient:
+    def __init__(self, fail=False):
+        self.messages = []
+        self.fail = fail
+
+    async def create_message(self, uuid, conversation_id, user_id, input_message):
+        if self.fail:
+            raise RuntimeError("Cosmos unavailable")
+        self.messages.append((user_id, conversation_id, uuid, input_message))
+        return {"id": uuid}
+
+
+def frame(*messages, id="chatcmpl-1"):
+    return {"id": id, "choices": [{"messages": list(messages)}], "history_metadata": {}}
+
+
+async def frames(*items, error=None):
+    for item in items:
+        yield item
+    if error:
+        raise error
+
+
+CITATIONS = json.dumps({"citations": [{"title": "doc"}]})
+STREAM = [
+    frame({"role": "tool", "content": CITATIONS}),
+    {},
+    frame({"role": "assistant", "content": "Hello"}),
+    frame({"role": "assistant", "content": " world"}),
+]
+
+
+@pytest.mark.asyncio
+async def test_streamed_reply_is_saved_after_tool_message():
+    client = FakeConversationClient()
+    saver = ReplySaver(client)
+
+    sent = [f async for f in saver.collect(frames(*STREAM), "user", "conv")]
+    assert sent == STREAM
+    await saver.close()
+
+    assert client.messages == [
+        ("user", "conv", tool_message_id("chatcmpl-1"), {"role": "tool", "content": CITATIONS}),
+        ("user", "conv", "chatcmpl-1", {"role": "assistant", "content": "Hello world"}),
+    ]
+    assert saver.stats() == {"in_progress": 0, "replies_saved": 1, "failures": 0}
+
+
+@pytest.mark.asyncio
+async def test_failed_stream_is_not_saved():
+    client = FakeConversationClient()
+    saver = ReplySaver(client)
+
+    with pytest.raises(RuntimeError):
+        async for _ in saver.collect(frames(*STREAM, error=RuntimeError("upstream")), "user", "conv"):
+            pass
+    async for _ in saver.collect(frames({"error": "content filtered"}), "user", "conv"):
+        pass
+    await saver.close()
+
+    assert client.messages == []
+
+
+@pytest.mark.asyncio
+async def test_stopped_stream_saves_what_was_sent():
+    client = FakeConversationClient()
+    saver = ReplySaver(client)
+
+    stream = saver.collect(frames(*STREAM), "user", "conv")
+    sent = [await stream.__anext__() for _ in range(3)]
+    await stream.aclose()
+    await saver.close()
+
+    assert sent == STREAM[:3]
+    assert [m[3] for m in client.messages] == [
+        {"role": "tool", "content": CITATIONS},
+        {"role": "assistant", "content": "Hello"},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_non_streaming_reply_and_write_failure():
+    client = FakeConversationClient()
+    saver = ReplySaver(client)
+    saver.save_response(
+        frame({"role": "tool", "content": CITATIONS}, {"role": "assistant", "content": "Hi"}, id="chatcmpl-2"),
+        "user",
+        "conv"
+    )
+    await saver.close()
+    assert [m[2] for m in client.messages] == [tool_message_id("chatcmpl-2"), "chatcmpl-2"]
+
+    failing = ReplySaver(FakeConversationClient(fail=True))
+    failing.save_response(frame({"role": "assistant", "content": "Hi"}), "user", "conv")
+    await failing.close()
+    assert failing.stats()["failures"] == 1
@@ -0,0 +1,141 @@
+import functools
+import pytest
+from types import SimpleNamespace
+from backend.cache.response_cache import (
+    InMemoryCacheBackend,
+    ResponseCache,
+    entry_from_completion,
+    make_cache_key,
+    record_stream,
+    replay_completion,
+    replay_stream,
+)
+from backend.utils import format_non_streaming_response, format_stream_response
+
+
+def chunk(content=None, context=None, chunk_id="chatcmpl-1"):
+    delta = SimpleNamespace(role="assistant", content=content)
+    if context is not None:
+        delta.context = context
+    return SimpleNamespace(
+        id=chunk_id,
+        model="gpt-4",
+        created=1700000000,
+        object="chat.completion.chunk",
+        choices=[SimpleNamespace(delta=delta)]
+    )
+
+
+def model_args(filter_string=None, user=None):
+    args = {
+        "messages": [{"role": "user", "content": "what is the PTO policy"}],
+        "temperature": 0,
+        "model": "gpt-4",
+        "stream": True,
+        "user": user,
+    }
+    if filter_string:
+        args["extra_body"] = {"data_sources": [{"parameters": {"filter": filter_string}}]}
+    return args
+
+
+def test_cache_key_ignores_user_and_stream():
+    streaming = model_args(user='{"SourceIp": "10.0.0.1"}')
+    non_streaming = dict(model_args(user='{"SourceIp": "10.0.0.2"}'), stream=False)
+    assert make_cache_key(streaming) == make_cache_key(non_streaming)
+
+
+def test_cache_key_includes_security_filter():
+    assert make_cache_key(model_args("groups/any(g:search.in(g, 'a'))")) != \
+        make_cache_key(model_args("groups/any(g:search.in(g, 'b'))"))
+
+
+@pytest.mark.asyncio
+async def test_in_memory_backend_lru_eviction():
+    backend = InMemoryCacheBackend(max_entries=2)
+    await backend.set("a", {"v": 1}, ttl=60)
+    await backend.set("b", {"v": 2}, ttl=60)
+    await backend.get("a")
+    await backend.set("c", {"v": 3}, ttl=60)
+
+    assert await backend.get("b") is None
+    assert await backend.get("a") == {"v": 1}
+    assert backend.stats()["evictions"] == 1
+
+
+@pytest.mark.asyncio
+async def test_in_memory_backend_ttl():
+    backend = InMemoryCacheBackend()
+    await backend.set("a", {"v": 1}, ttl=0)
+    assert await backend.get("a") is None
+
+
+@pytest.mark.asyncio
+async def test_streamed_answer_replays_same_frames():
+    cache = ResponseCache(InMemoryCacheBackend(), ttl=60)
+    context = {"citations": [{"content": "PTO is 20 days"}]}
+
+    async def upstream():
+        yield chunk(chunk_id="")
+        yield chunk(context=context)
+        yield chunk(content="PTO is ")
+        yield chunk(content="20 days.")
+
+    on_complete = functools.partial(cache.set, "key")
+    live = [c async for c in record_stream(upstream(), on_complete)]
+    assert len(live) == 4
+
+    entry = await cache.get("key")
+    assert entry["content"] == "PTO is 20 days."
+    assert entry["context"] == context
+
+    frames = [
+        format_stream_response(c, {"conversation_id": "1"}, None)
+        async for c in replay_stream(entry)
+    ]
+    assert frames[0]["choices"][0]["messages"][0]["role"] == "tool"
+    assert frames[1]["choices"][0]["messages"][0] == {
+        "role": "assistant",
+        "content": "PTO is 20 days."
+    }
+    assert frames[0]["id"] == frames[1]["id"] != "chatcmpl-1"
+    assert cache.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_non_streaming_replay():
+    cache = ResponseCache(InMemoryCacheBackend(), ttl=60)
+    message = SimpleNamespace(role="assistant", content="20 days.")
+    completion = SimpleNamespace(
+        id="chatcmpl-2",
+        model="gpt-4",
+        created=1700000000,
+        object="chat.completion",
+        choices=[SimpleNamespace(message=message)]
+    )
+    await cache.set("key", entry_from_completion(completion))
+
+    assert await cache.get("missing") is None
+    replayed = format_non_streaming_response(replay_completion(await cache.get("key")), {}, None)
+    original = format_non_streaming_response(completion, {}, None)
+    assert replayed.pop("id") != original.pop("id")
+    assert replayed == original
+    assert cache.stats()["misses"] == 1
+
+
+@pytest.mark.asyncio
+async def test_every_replay_has_a_new_id():
+    entry = {
+        "id": "chatcmpl-3",
+        "model": "gpt-4",
+        "created": 1700000000,
+        "object": "chat.completion",
+        "content": "20 days.",
+    }
+
+    first = [c.id async for c in replay_stream(entry)]
+    second = [c.id async for c in replay_stream(entry)]
+    ids = {first[0], second[0], replay_completion(entry).id, replay_completion(entry).id}
+
+    assert len(ids) == 4
+    assert "chatcmpl-3" not in ids
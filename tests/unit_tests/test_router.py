@@ -0,0 +1,225 @@
+import asyncio
+import json
+import openai
+import pytest
+import pytest_asyncio
+from aiohttp import web
+from backend.openai_client import AzureOpenAIClientManager
+from backend.router import BackendRouter, OpenAIBackend
+
+
+def completion(name):
+    return {
+        "id": f"chatcmpl-{name}",
+        "object": "chat.completion",
+        "created": 1717243200,
+        "model": "gpt-4o",
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": f"hello from {name}"},
+            "finish_reason": "stop"
+        }],
+        "usage": {"prompt_tokens": 5, "completion_tokens": 3, "total_tokens": 8},
+    }
+
+
+def chunk(name, content):
+    return {
+        "id": f"chatcmpl-{name}",
+        "object": "chat.completion.chunk",
+        "created": 1717243200,
+        "model": "gpt-4o",
+        "choices": [{"index": 0, "delta": {"role": "assistant", "content": content}}],
+    }
+
+
+async def start_stub(name):
+    # Stand-in for one Azure OpenAI deployment with adjustable behaviour
+    state = {"name": name, "status": 200, "latency": 0, "requests": 0, "headers": {}}
+
+    async def chat_completions(request):
+        state["requests"] += 1
+        await asyncio.sleep(state["latency"])
+        if state["status"] != 200:
+            return web.json_response(
+                {"error": {"code": str(state["status"]), "message": "stub error"}},
+                status=state["status"],
+                headers=state["headers"]
+            )
+
+        body = await request.json()
+        if not body.get("stream"):
+            return web.json_response(completion(name), headers=state["headers"])
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", **state["headers"]})
+        await response.prepare(request)
+        for content in ("hello ", "from ", name):
+            await response.write(f"data: {json.dumps(chunk(name, content))}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    app = web.Application()
+    app.router.add_post("/openai/deployments/{deployment}/chat/completions", chat_completions)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}", state
+
+
+@pytest_asyncio.fixture
+async def stubs():
+    runner_a, endpoint_a, state_a = await start_stub("a")
+    runner_b, endpoint_b, state_b = await start_stub("b")
+    router = BackendRouter(
+        [
+            OpenAIBackend(
+                AzureOpenAIClientManager(endpoint, "2024-05-01-preview", api_key="dummy", http2=False, max_retries=0),
+                deployment="gpt-4o"
+            )
+            for endpoint in (endpoint_a, endpoint_b)
+        ],
+        eject_seconds=30
+    )
+
+    yield router, state_a, state_b
+
+    await router.close()
+    await runner_a.cleanup()
+    await runner_b.cleanup()
+
+
+MODEL_ARGS = {"model": "ignored", "messages": [{"role": "user", "content": "hi"}], "stream": False}
+
+
+@pytest.mark.asyncio
+async def test_throttled_backend_is_ejected_and_request_retried(stubs):
+    router, state_a, state_b = stubs
+    state_a["status"] = 429
+    state_a["headers"] = {"retry-after-ms": "5000"}
+
+    response, _, backend = await router.create_chat_completion(MODEL_ARGS)
+
+    assert response.choices[0].message.content == "hello from b"
+    assert backend is router.backends[1]
+    stats = router.stats()
+    assert stats["retries"] == 1
+    assert stats["backends"][0]["throttled"] == 1
+    assert stats["backends"][0]["ejected"] is True
+
+    # The ejected backend is skipped while it recovers
+    await router.create_chat_completion(MODEL_ARGS)
+    assert state_a["requests"] == 1
+    assert state_b["requests"] == 2
+
+
+@pytest.mark.asyncio
+async def test_faster_backend_is_preferred(stubs):
+    router, state_a, state_b = stubs
+    state_a["latency"] = 0.1
+
+    for _ in range(6):
+        await router.create_chat_completion(MODEL_ARGS)
+
+    assert state_a["requests"] == 1
+    assert state_b["requests"] == 5
+    assert router.stats()["backends"][0]["ewma_ttft_ms"] >= 100
+
+
+@pytest.mark.asyncio
+async def test_backend_reporting_no_quota_is_avoided(stubs):
+    router, state_a, state_b = stubs
+    state_a["headers"] = {"x-ratelimit-remaining-tokens": "0"}
+
+    for _ in range(3):
+        await router.create_chat_completion(MODEL_ARGS, tokens=100)
+
+    assert state_a["requests"] == 1
+    assert router.stats()["backends"][0]["remaining_tokens"] == 0
+
+
+@pytest.mark.asyncio
+async def test_streams_fail_over_and_measure_time_to_first_token(stubs):
+    router, state_a, state_b = stubs
+    state_a["status"] = 500
+
+    response, _, backend = await router.create_chat_completion({**MODEL_ARGS, "stream": True})
+    content = "".join([c.choices[0].delta.content async for c in response if c.choices])
+
+    assert content == "hello from b"
+    assert backend.in_flight == 0
+    assert backend.ewma_ttft is not None
+    assert router.stats()["backends"][0]["errors"] == 1
+
+
+@pytest.mark.asyncio
+async def test_closing_an_unread_stream_releases_the_backend(stubs):
+    router, state_a, state_b = stubs
+
+    response, _, backend = await router.create_chat_completion({**MODEL_ARGS, "stream": True})
+    assert backend.in_flight == 1
+
+    await response.aclose()
+    await response.aclose()
+
+    assert backend.in_flight == 0
+    assert [c async for c in response] == []
+
+
+@pytest.mark.asyncio
+async def test_client_errors_are_not_retried(stubs):
+    router, state_a, state_b = stubs
+    state_a["status"] = state_b["status"] = 400
+
+    with pytest.raises(openai.BadRequestError):
+        await router.create_chat_completion(MODEL_ARGS)
+
+    assert state_a["requests"] + state_b["requests"] == 1
+    assert router.stats()["backends"][0]["ejected"] is False
+
+
+async def read_stream(response):
+    return "".join([c.choices[0].delta.content async for c in response if c.choices])
+
+
+async def warm_up_hedging(router, state_a, state_b, samples):
+    for _ in range(samples):
+        await read_stream((await router.create_chat_completion({**MODEL_ARGS, "stream": True}))[0])
+
+    # Make the first backend the primary choice, then slow it down
+    router.backends[1].ewma_ttft = 10
+    state_a["latency"] = 0.5
+
+
+@pytest.mark.asyncio
+async def test_slow_stream_is_hedged_on_another_backend(stubs):
+    router, state_a, state_b = stubs
+    router.hedge, router.hedge_budget, router.hedge_min_samples = True, 1.0, 3
+    await warm_up_hedging(router, state_a, state_b, samples=3)
+
+    started = asyncio.get_running_loop().time()
+    response, _, backend = await router.create_chat_completion({**MODEL_ARGS, "stream": True})
+    content = await read_stream(response)
+
+    assert content == "hello from b"
+    assert asyncio.get_running_loop().time() - started < 0.4
+    assert router.stats()["hedged"] == 1
+    assert router.stats()["hedge_wins"] == 1
+
+    # The losing request is abandoned rather than read to the end
+    await asyncio.sleep(0.05)
+    assert router.backends[0].in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_hedging_respects_budget(stubs):
+    router, state_a, state_b = stubs
+    router.hedge, router.hedge_budget, router.hedge_min_samples = True, 0.0, 3
+    await warm_up_hedging(router, state_a, state_b, samples=3)
+
+    response, _, backend = await router.create_chat_completion({**MODEL_ARGS, "stream": True})
+
+    assert await read_stream(response) == "hello from a"
+    assert router.stats()["hedged"] == 0
@@ -0,0 +1,102 @@
+import pytest
+from backend.cache.semantic_cache import (
+    SemanticCache,
+    get_standalone_question,
+    make_partition_key,
+)
+
+EMBEDDINGS = {
+    "how many vacation days do I get": [1.0, 0.1, 0.0],
+    "PTO allowance?": [0.98, 0.12, 0.01],
+    "where is the cafeteria": [0.0, 0.2, 1.0],
+}
+
+
+async def stub_embed(text):
+    return EMBEDDINGS[text]
+
+
+def answer(content):
+    return {
+        "id": "chatcmpl-1",
+        "model": "gpt-4",
+        "created": 1700000000,
+        "object": "chat.completion",
+        "content": content,
+        "context": {"citations": []},
+    }
+
+
+@pytest.mark.asyncio
+async def test_paraphrase_hits_cache():
+    cache = SemanticCache(stub_embed, similarity_threshold=0.95)
+    entry, vector = await cache.lookup("p1", "how many vacation days do I get")
+    assert entry is None
+    cache.add("p1", vector, answer("20 days"))
+
+    entry, _ = await cache.lookup("p1", "PTO allowance?")
+    assert entry["content"] == "20 days"
+
+    entry, _ = await cache.lookup("p1", "where is the cafeteria")
+    assert entry is None
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["entries"] == 1
+
+
+@pytest.mark.asyncio
+async def test_partitions_are_isolated():
+    cache = SemanticCache(stub_embed)
+    _, vector = await cache.lookup("p1", "how many vacation days do I get")
+    cache.add("p1", vector, answer("20 days"))
+
+    entry, _ = await cache.lookup("p2", "how many vacation days do I get")
+    assert entry is None
+
+
+@pytest.mark.asyncio
+async def test_eviction():
+    cache = SemanticCache(stub_embed, max_entries=1, max_partitions=1)
+    _, vacation = await cache.lookup("p1", "how many vacation days do I get")
+    _, cafeteria = await cache.lookup("p1", "where is the cafeteria")
+    cache.add("p1", vacation, answer("20 days"))
+    cache.add("p1", cafeteria, answer("Building 4"))
+    assert cache.search("p1", vacation) is None
+    assert cache.search("p1", cafeteria)["content"] == "Building 4"
+
+    cache.add("p2", vacation, answer("20 days"))
+    assert cache.search("p1", cafeteria) is None
+    assert cache.stats()["evictions"] == 2
+
+
+@pytest.mark.asyncio
+async def test_ttl_expiry():
+    cache = SemanticCache(stub_embed, ttl=0)
+    _, vector = await cache.lookup("p1", "PTO allowance?")
+    cache.add("p1", vector, answer("20 days"))
+    assert cache.search("p1", vector) is None
+
+
+def test_standalone_question():
+    assert get_standalone_question([
+        {"role": "system", "content": "You are helpful"},
+        {"role": "user", "content": "PTO allowance?"},
+    ]) == "PTO allowance?"
+    assert get_standalone_question([
+        {"role": "user", "content": "PTO allowance?"},
+        {"role": "assistant", "content": "20 days"},
+        {"role": "user", "content": "and for contractors?"},
+    ]) is None
+
+
+def test_partition_key_ignores_question():
+    args = {
+        "messages": [{"role": "user", "content": "PTO allowance?"}],
+        "extra_body": {"data_sources": [{"parameters": {"filter": "a"}}]},
+    }
+    other_question = dict(args, messages=[{"role": "user", "content": "where is the cafeteria"}])
+    other_filter = dict(args, extra_body={"data_sources": [{"parameters": {"filter": "b"}}]})
+    assert make_partition_key(args) == make_partition_key(other_question)
+    assert make_partition_key(args) != make_partition_key(other_filter)
@@ -70,3 +70,25 @@ def test_dotenv_with_elasticsearch_success(app_settings):
     
     
 
+def test_dotenv_with_azure_search_permitted_groups(app_settings):
+    datasource = app_settings.datasource
+    assert datasource.permitted_groups_column == "group_ids"
+
+    first = datasource.construct_payload_configuration(
+        request_parameters={"filter": "group_ids/any(g:search.in(g, 'group-a'))"}
+    )
+    second = datasource.construct_payload_configuration(
+        request_parameters={"filter": "group_ids/any(g:search.in(g, 'group-b'))"}
+    )
+
+    # Each request gets its own filter on top of the shared static payload
+    assert first["parameters"]["filter"] == "group_ids/any(g:search.in(g, 'group-a'))"
+    assert second["parameters"]["filter"] == "group_ids/any(g:search.in(g, 'group-b'))"
+    assert datasource.filter is None
+    assert "filter" not in datasource.construct_payload_configuration()["parameters"]
+    assert first["parameters"]["fields_mapping"] is second["parameters"]["fields_mapping"]
+    assert first["parameters"]["endpoint"] == "https://search_service.search.windows.net"
+    assert first["parameters"]["embedding_dependency"] == {
+        "type": "deployment_name",
+        "deployment_name": "embedding_model"
+    }
@@ -0,0 +1,127 @@
+import asyncio
+import pytest
+from types import SimpleNamespace
+from backend.singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_share_one_upstream_call():
+    single_flight = SingleFlight()
+    calls = 0
+
+    async def upstream():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return {"answer": 42}, "apim-1"
+
+    results = await asyncio.gather(
+        *[single_flight.do("key", upstream) for _ in range(5)]
+    )
+
+    assert calls == 1
+    assert all(result == ({"answer": 42}, "apim-1") for result in results)
+    assert single_flight.stats() == {"in_flight": 0, "leaders": 1, "followers": 4}
+
+
+@pytest.mark.asyncio
+async def test_streams_are_fanned_out_to_every_subscriber():
+    single_flight = SingleFlight()
+    calls = 0
+
+    async def upstream():
+        nonlocal calls
+        calls += 1
+
+        async def chunks():
+            for token in ["PTO ", "is ", "20 days"]:
+                await asyncio.sleep(0.005)
+                yield token
+
+        return chunks(), "apim-1"
+
+    async def consume():
+        stream, apim_request_id = await single_flight.do("key", upstream, stream=True)
+        return "".join([token async for token in stream]), apim_request_id
+
+    results = await asyncio.gather(*[consume() for _ in range(3)])
+
+    assert calls == 1
+    assert results == [("PTO is 20 days", "apim-1")] * 3
+    assert single_flight.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_different_keys_are_not_coalesced():
+    single_flight = SingleFlight()
+    calls = 0
+
+    async def upstream():
+        nonlocal calls
+        calls += 1
+        return calls, None
+
+    await asyncio.gather(single_flight.do("a", upstream), single_flight.do("b", upstream))
+    assert calls == 2
+
+
+@pytest.mark.asyncio
+async def test_errors_reach_every_caller_and_release_the_key():
+    single_flight = SingleFlight()
+
+    async def upstream():
+        await asyncio.sleep(0.01)
+        raise ValueError("429 Too Many Requests")
+
+    results = await asyncio.gather(
+        single_flight.do("key", upstream),
+        single_flight.do("key", upstream),
+        return_exceptions=True
+    )
+
+    assert all(isinstance(result, ValueError) for result in results)
+    assert single_flight.stats()["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_error_is_raised_after_buffered_chunks():
+    single_flight = SingleFlight()
+
+    async def upstream():
+        async def chunks():
+            yield "partial"
+            raise ValueError("upstream reset")
+
+        return chunks(), None
+
+    stream, _ = await single_flight.do("key", upstream, stream=True)
+    received = []
+    with pytest.raises(ValueError):
+        async for token in stream:
+            received.append(token)
+    assert received == ["partial"]
+
+
+@pytest.mark.asyncio
+async def test_followers_get_their_own_completion_id():
+    single_flight = SingleFlight()
+
+    async def upstream():
+        await asyncio.sleep(0.01)
+
+        async def chunks():
+            for content in ["PTO ", "is 20 days"]:
+                await asyncio.sleep(0.005)
+                yield SimpleNamespace(id="chatcmpl-1", content=content)
+
+        return chunks(), "apim-1"
+
+    async def consume():
+        stream, _ = await single_flight.do("key", upstream, stream=True)
+        return {chunk.id async for chunk in stream}
+
+    results = await asyncio.gather(*[consume() for _ in range(3)])
+
+    assert results[0] == {"chatcmpl-1"}
+    assert all(len(ids) == 1 for ids in results)
+    assert len(set.union(*results)) == 3
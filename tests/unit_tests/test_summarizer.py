@@ -0,0 +1,109 @@
+import pytest
+from types import SimpleNamespace
+from backend.rate_limit import QuotaLimiter
+from backend.history.summarizer import (
+    AzureOpenAISummarizer,
+    ConversationSummarizer,
+    RollingSummarizer,
+    apply_conversation_summary,
+)
+
+
+class StubSummarizer(ConversationSummarizer):
+    def __init__(self):
+        self.calls = []
+
+    async def summarize(self, previous_summary, messages):
+        self.calls.append((previous_summary, messages))
+        return f"{len(messages)} turns summarized"
+
+
+class FakeConversationClient:
+    def __init__(self):
+        self.summaries = {}
+
+    async def update_conversation_summary(self, user_id, conversation_id, summary):
+        self.summaries[(user_id, conversation_id)] = summary
+        return summary
+
+
+def conversation(turns):
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"question {i}"})
+        messages.append({"role": "tool", "content": "{}"})
+        messages.append({"role": "assistant", "content": f"answer {i}"})
+    messages.append({"role": "user", "content": "latest question"})
+    return messages
+
+
+def test_apply_conversation_summary():
+    messages = [{"role": "system", "content": "be brief"}] + conversation(3)
+    summary = {"content": "user asked three questions", "coveredTurns": 4}
+
+    compacted = apply_conversation_summary(messages, summary)
+
+    assert compacted[0] == {"role": "system", "content": "be brief"}
+    assert compacted[1]["role"] == "system"
+    assert compacted[1]["content"].endswith("user asked three questions")
+    assert [m["role"] for m in compacted[2:]] == ["user", "tool", "assistant", "user"]
+    assert [m["content"] for m in compacted[2:] if m["role"] != "tool"] == [
+        "question 2", "answer 2", "latest question"
+    ]
+
+
+def test_apply_conversation_summary_without_summary():
+    messages = conversation(2)
+    assert apply_conversation_summary(messages, None) == messages
+    assert apply_conversation_summary(messages, {"content": "x", "coveredTurns": 99}) == messages
+
+
+@pytest.mark.asyncio
+async def test_rolling_summarizer_compacts_long_conversations():
+    summarizer = StubSummarizer()
+    client = FakeConversationClient()
+    rolling = RollingSummarizer(summarizer, client, threshold_turns=6, keep_recent_turns=2)
+
+    assert rolling.schedule("user", "short", conversation(2), None) is None
+
+    task = rolling.schedule("user", "long", conversation(5), None)
+    assert rolling.schedule("user", "long", conversation(5), None) is None
+    await task
+
+    summary = client.summaries[("user", "long")]
+    assert summary == {"content": "9 turns summarized", "coveredTurns": 9}
+    assert all(m["role"] != "tool" for m in summarizer.calls[0][1])
+    assert rolling.stats()["summaries_written"] == 1
+
+    # The next compaction only summarizes turns added since the last summary
+    assert not rolling.needs_summary(conversation(7), summary)
+    task = rolling.schedule("user", "long", conversation(8), summary)
+    await task
+    previous, new_turns = summarizer.calls[1]
+    assert previous == "9 turns summarized"
+    assert len(new_turns) == 17 - 2 - 9
+
+
+@pytest.mark.asyncio
+async def test_summaries_reserve_quota():
+    limiter = QuotaLimiter(tokens_per_minute=600000)
+    reserved = []
+
+    async def reserve_quota(messages, max_tokens):
+        reserved.append(max_tokens)
+        return await limiter.acquire(limiter.estimate_tokens(messages), max_tokens)
+
+    async def create(**kwargs):
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content="summary"))],
+            usage=SimpleNamespace(total_tokens=42)
+        )
+
+    async def get_client():
+        return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+    summarizer = AzureOpenAISummarizer(get_client, "gpt-4o", max_tokens=100, reserve_quota=reserve_quota)
+
+    assert await summarizer.summarize(None, conversation(1)) == "summary"
+    assert reserved == [100]
+    assert limiter.stats()["used_tokens"] == 42
@@ -0,0 +1,33 @@
+import asyncio
+import pytest
+from backend.timing import PhaseTimer
+
+
+@pytest.mark.asyncio
+async def test_phase_timer_records_overlapping_phases():
+    timer = PhaseTimer()
+    await asyncio.gather(
+        timer.measure("history", asyncio.sleep(0.05)),
+        timer.measure("upstream", asyncio.sleep(0.05)),
+    )
+
+    assert set(timer.phases) == {"history", "upstream"}
+    assert timer.phases["history"] >= 0.04
+    # Both phases ran at the same time
+    assert timer.elapsed() < timer.phases["history"] + timer.phases["upstream"]
+
+    header = timer.header()
+    assert header.startswith("history;dur=")
+    assert ", upstream;dur=" in header
+    assert ", total;dur=" in header
+
+
+@pytest.mark.asyncio
+async def test_phase_timer_records_failed_phase():
+    async def fail():
+        raise RuntimeError("boom")
+
+    timer = PhaseTimer()
+    with pytest.raises(RuntimeError):
+        await timer.measure("history", fail())
+    assert "history" in timer.phases
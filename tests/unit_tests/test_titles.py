@@ -0,0 +1,85 @@
+import asyncio
+import pytest
+from backend.history.titles import ConversationTitler, provisional_title
+
+
+class FakeConversationClient:
+    def __init__(self):
+        self.titles = {}
+
+    async def update_conversation_title(self, user_id, conversation_id, title, expected_title=None):
+        current = self.titles.get((user_id, conversation_id), expected_title)
+        if current != expected_title:
+            return False
+        self.titles[(user_id, conversation_id)] = title
+        return {"title": title}
+
+
+def title_generator(title, delay=0):
+    async def generate_title(messages):
+        await asyncio.sleep(delay)
+        if isinstance(title, Exception):
+            raise title
+        return title
+    return generate_title
+
+
+async def answer_stream(history_metadata, chunks=3):
+    for i in range(chunks):
+        await asyncio.sleep(0)
+        yield {"id": "1", "choices": [{"messages": [{"role": "assistant", "content": str(i)}]}], "history_metadata": history_metadata}
+
+
+def test_provisional_title():
+    messages = [{"role": "user", "content": "How do I reset my password, and what are the rules?"}]
+    assert provisional_title(messages) == "How do I reset my password"
+    assert provisional_title([{"role": "user", "content": "?!"}]) == "New chat"
+    assert provisional_title([]) == "New chat"
+
+
+@pytest.mark.asyncio
+async def test_title_is_written_to_conversation_and_metadata():
+    client = FakeConversationClient()
+    titler = ConversationTitler(title_generator("Password Reset Rules"), client)
+    history_metadata = {"title": "How do I reset my password"}
+
+    task = titler.schedule("user", "conv", [{"role": "user", "content": "q"}], history_metadata)
+    frames = [frame async for frame in titler.hold_last_frame(answer_stream(history_metadata), task)]
+
+    assert len(frames) == 3
+    assert frames[-1]["history_metadata"]["title"] == "Password Reset Rules"
+    assert client.titles[("user", "conv")] == "Password Reset Rules"
+    assert titler.stats()["titles_written"] == 1
+
+
+@pytest.mark.asyncio
+async def test_late_title_does_not_hold_the_answer():
+    client = FakeConversationClient()
+    titler = ConversationTitler(title_generator("Password Reset Rules", delay=0.2), client, wait_timeout=0.01)
+    history_metadata = {"title": "provisional"}
+
+    task = titler.schedule("user", "conv", [], history_metadata)
+    frames = [frame async for frame in titler.hold_last_frame(answer_stream(history_metadata), task)]
+    assert len(frames) == 3
+    assert titler.stats()["late_titles"] == 1
+
+    await titler.close()
+    assert client.titles[("user", "conv")] == "Password Reset Rules"
+
+
+@pytest.mark.asyncio
+async def test_rename_and_failure_keep_existing_title():
+    client = FakeConversationClient()
+    client.titles[("user", "conv")] = "Renamed by user"
+    titler = ConversationTitler(title_generator("Generated"), client)
+    history_metadata = {"title": "provisional"}
+    await titler.schedule("user", "conv", [], history_metadata)
+    assert client.titles[("user", "conv")] == "Renamed by user"
+    assert history_metadata["title"] == "provisional"
+    assert titler.stats()["titles_written"] == 0
+
+    failing = ConversationTitler(title_generator(RuntimeError("quota")), client)
+    history_metadata = {"title": "provisional"}
+    await failing.schedule("user", "other", [], history_metadata)
+    assert history_metadata["title"] == "provisional"
+    assert failing.stats()["failures"] == 1
@@ -1,5 +1,13 @@
+import asyncio
+import json
 import pytest
-from backend.utils import format_as_ndjson, parse_multi_columns
+from backend.utils import (
+    ClosingStream,
+    coalesce_stream_responses,
+    format_as_compact_ndjson,
+    format_as_ndjson,
+    parse_multi_columns,
+)
 
 
 @pytest.mark.asyncio
@@ -27,3 +35,137 @@ def test_parse_multi_columns():
     assert parse_multi_columns(test_pipes) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_commas) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_single) == ["col1"]
+
+
+def stream_frame(content=None, role="assistant", frame_id="chatcmpl-1"):
+    message = {"role": role, "content": content}
+    return {
+        "id": frame_id,
+        "model": "gpt-4",
+        "created": 1700000000,
+        "object": "chat.completion.chunk",
+        "choices": [{"messages": [message]}],
+        "history_metadata": {},
+        "apim-request-id": None,
+    }
+
+
+async def frames_from(frames, delay=0):
+    for frame in frames:
+        if delay:
+            await asyncio.sleep(delay)
+        yield frame
+
+
+@pytest.mark.asyncio
+async def test_coalesce_stream_responses_merges_content():
+    frames = [{}, stream_frame('{"citations": []}', role="tool")]
+    frames += [stream_frame(token) for token in ["a", "b", "c", "d", "e"]]
+
+    merged = [f async for f in coalesce_stream_responses(frames_from(frames), 2, 0)]
+
+    assert merged[0] == {}
+    assert merged[1]["choices"][0]["messages"][0]["role"] == "tool"
+    contents = [f["choices"][0]["messages"][0]["content"] for f in merged[2:]]
+    assert contents == ["ab", "cd", "e"]
+    assert merged[2]["id"] == "chatcmpl-1"
+
+
+@pytest.mark.asyncio
+async def test_coalesce_stream_responses_flushes_on_interval():
+    frames = [stream_frame(token) for token in ["a", "b", "c"]]
+
+    merged = [
+        f async for f in coalesce_stream_responses(frames_from(frames, delay=0.05), 100, 10)
+    ]
+
+    assert len(merged) == 3
+
+
+@pytest.mark.asyncio
+async def test_coalesce_stream_responses_interval_without_token_limit():
+    frames = [stream_frame(token) for token in ["a", "b", "c"]]
+    merged = [f async for f in coalesce_stream_responses(frames_from(frames), 1, 1000)]
+    assert [f["choices"][0]["messages"][0]["content"] for f in merged] == ["abc"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_stream_responses_close_during_read():
+    finished = []
+
+    async def slow_source():
+        try:
+            yield stream_frame("a")
+            await asyncio.sleep(10)
+            yield stream_frame("b")
+        finally:
+            finished.append(True)
+
+    source = slow_source()
+    merged = coalesce_stream_responses(source, 1, 10)
+    assert (await merged.__anext__())["choices"][0]["messages"][0]["content"] == "a"
+
+    await merged.aclose()
+    await source.aclose()
+    assert finished == [True]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_stream_responses_disabled():
+    frames = [stream_frame(token) for token in ["a", "b"]]
+    merged = [f async for f in coalesce_stream_responses(frames_from(frames), 1, 0)]
+    assert merged == frames
+
+
+@pytest.mark.asyncio
+async def test_closing_stream_closes_sources_before_first_frame():
+    closed = []
+
+    class Source:
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            return stream_frame("a")
+
+        async def aclose(self):
+            closed.append(self)
+
+    source = Source()
+    stream = ClosingStream(coalesce_stream_responses(source, 2, 0), source)
+    await stream.aclose()
+
+    assert closed == [source]
+    assert [f async for f in stream] == []
+
+
+@pytest.mark.asyncio
+async def test_format_as_compact_ndjson():
+    tool_frame = stream_frame('{"citations": []}', role="tool")
+    frames = [{}, tool_frame, stream_frame("Hello "), stream_frame("world")]
+
+    lines = [line async for line in format_as_compact_ndjson(frames_from(frames))]
+    decoded = [json.loads(line) for line in lines]
+
+    assert all(line.endswith(b"\n") for line in lines)
+    assert decoded[0] == {"e": {
+        "id": "chatcmpl-1",
+        "model": "gpt-4",
+        "created": 1700000000,
+        "object": "chat.completion.chunk",
+        "history_metadata": {},
+        "apim-request-id": None,
+    }}
+    assert decoded[1] == {"m": [{"role": "tool", "content": '{"citations": []}'}]}
+    assert decoded[2:] == [{"c": "Hello "}, {"c": "world"}]
+
+
+@pytest.mark.asyncio
+async def test_format_as_compact_ndjson_exception():
+    async def dummy_generator():
+        raise Exception("test exception")
+        yield {}
+
+    async for line in format_as_compact_ndjson(dummy_generator()):
+        assert line.endswith(b"\n")
+        assert json.loads(line) == {"error": "test exception"}
@@ -0,0 +1,93 @@
+import asyncio
+import pytest
+from backend.history.write_behind import WriteBehindBuffer
+
+
+def message(id, user="user-1"):
+    return {"id": id, "type": "message", "userId": user, "content": id}
+
+
+@pytest.mark.asyncio
+async def test_writes_are_batched_per_user_on_interval(fake_batch_container):
+    container = fake_batch_container()
+    container.items["conv-1"] = {"id": "conv-1"}
+    buffer = WriteBehindBuffer(container, flush_interval=0.01)
+
+    await buffer.upsert("user-1", message("m1"))
+    await buffer.patch("user-1", "conv-1", [{"op": "set", "path": "/updatedAt", "value": "t1"}])
+    await buffer.upsert("user-2", message("m2", "user-2"))
+    await buffer.patch("user-1", "conv-1", [{"op": "set", "path": "/updatedAt", "value": "t2"}])
+    assert container.items.keys() == {"conv-1"}
+
+    await asyncio.sleep(0.05)
+    assert sorted(container.batches) == [
+        ("user-1", [("upsert", "m1"), ("patch", "conv-1")]),
+        ("user-2", [("upsert", "m2")]),
+    ]
+    assert container.items["conv-1"]["updatedAt"] == "t2"
+    assert buffer.stats()["queue_depth"] == 0
+    await buffer.close()
+
+
+@pytest.mark.asyncio
+async def test_size_trigger_and_read_your_writes(fake_batch_container):
+    container = fake_batch_container()
+    buffer = WriteBehindBuffer(container, max_batch_size=2, flush_interval=60)
+
+    await buffer.upsert("user-1", message("m1"))
+    await buffer.upsert("user-1", message("m2"))
+    await asyncio.sleep(0.01)
+    assert container.batches == [("user-1", [("upsert", "m1"), ("upsert", "m2")])]
+
+    await buffer.upsert("user-1", message("m3"))
+    await buffer.flush("user-1")
+    assert "m3" in container.items
+    await buffer.close()
+
+
+@pytest.mark.asyncio
+async def test_missing_conversation_only_drops_its_patch(fake_batch_container):
+    container = fake_batch_container()
+    buffer = WriteBehindBuffer(container, flush_interval=60)
+
+    await buffer.upsert("user-1", message("m1"))
+    await buffer.patch("user-1", "missing", [{"op": "set", "path": "/updatedAt", "value": "t"}])
+    await buffer.flush("user-1")
+
+    assert "m1" in container.items
+    assert buffer.stats()["dropped"] == 1
+    await buffer.close()
+
+
+@pytest.mark.asyncio
+async def test_failed_writes_are_retried_and_flushed_on_close(fake_container):
+    container = fake_container()
+    container.fail_next = 1
+    buffer = WriteBehindBuffer(container, flush_interval=60)
+
+    await buffer.upsert("user-1", message("m1"))
+    await buffer.flush()
+    assert "m1" not in container.items
+    assert buffer.stats()["queue_depth"] == 1
+
+    await buffer.close()
+    assert "m1" in container.items
+    assert buffer.stats()["failures"] == 1
+    assert buffer.stats()["queue_depth"] == 0
+
+
+@pytest.mark.asyncio
+async def test_full_queue_applies_backpressure(fake_container):
+    container = fake_container(delay=0.02)
+    buffer = WriteBehindBuffer(container, flush_interval=60, max_queue=2)
+
+    await buffer.upsert("user-1", message("m1"))
+    await buffer.upsert("user-1", message("m2"))
+    await buffer.upsert("user-1", message("m3"))
+
+    stats = buffer.stats()
+    assert stats["backpressure_waits"] == 1
+    assert {"m1", "m2"} <= container.items.keys()
+    assert stats["queue_depth"] <= 2
+    await buffer.close()
+    assert buffer.stats()["written"] == 3
@@ -0,0 +1,136 @@
+"""
+Compare request units, round trips and latency per chat message written by
+CosmosConversationClient.create_message with the previous implementation
+(upsert the message, query the conversation, upsert the conversation).
+
+Runs against the Cosmos DB account configured by the AZURE_COSMOSDB_*
+settings. All documents are written to a throwaway userId partition and
+deleted afterwards. Request charges are read from the x-ms-request-charge
+header of every response.
+
+Usage:
+    python tools/benchmark_create_message.py [--messages 20]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from azure.core.async_paging import AsyncItemPaged
+from azure.identity.aio import DefaultAzureCredential
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.settings import app_settings
+
+MEASURED_OPERATIONS = ("upsert_item", "patch_item", "read_item", "execute_item_batch", "query_items")
+
+
+class ChargeRecorder:
+    '''Container proxy that adds up the request charge of every call.'''
+
+    def __init__(self, container_client):
+        self.container_client = container_client
+        self.request_charge = 0.0
+        self.round_trips = 0
+
+    def _record(self, headers, result):
+        # query_items also calls the hook when the query is created, with
+        # the headers of the previous request
+        if isinstance(result, AsyncItemPaged):
+            return
+        self.round_trips += 1
+        self.request_charge += float(headers.get("x-ms-request-charge", 0))
+
+    def __getattr__(self, name):
+        attribute = getattr(self.container_client, name)
+        if name not in MEASURED_OPERATIONS:
+            return attribute
+        if name == "query_items":
+            return lambda *args, **kwargs: attribute(*args, response_hook=self._record, **kwargs)
+
+        async def call(*args, **kwargs):
+            return await attribute(*args, response_hook=self._record, **kwargs)
+        return call
+
+
+async def legacy_create_message(client, uuid, conversation_id, user_id, input_message):
+    message = {
+        'id': uuid,
+        'type': 'message',
+        'userId': user_id,
+        'createdAt': datetime.utcnow().isoformat(),
+        'updatedAt': datetime.utcnow().isoformat(),
+        'conversationId': conversation_id,
+        'role': input_message['role'],
+        'content': input_message['content']
+    }
+    resp = await client.container_client.upsert_item(message)
+    query = "SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
+    parameters = [{'name': '@conversationId', 'value': conversation_id}, {'name': '@userId', 'value': user_id}]
+    conversation = [
+        item async for item in client.container_client.query_items(query=query, parameters=parameters)
+    ][0]
+    conversation['updatedAt'] = message['createdAt']
+    await client.upsert_conversation(conversation)
+    return resp
+
+
+async def measure(client, recorder, create_message, user_id, conversation_id, messages):
+    latencies = []
+    recorder.request_charge, recorder.round_trips = 0.0, 0
+    for i in range(messages):
+        started = time.perf_counter()
+        await create_message(
+            client, str(uuid.uuid4()), conversation_id, user_id,
+            {"role": "user", "content": f"benchmark message {i}"}
+        )
+        latencies.append((time.perf_counter() - started) * 1000)
+
+    return (
+        recorder.request_charge / messages,
+        recorder.round_trips / messages,
+        statistics.median(latencies),
+        max(latencies),
+    )
+
+
+async def main(messages: int):
+    if not app_settings.chat_history:
+        sys.exit("Set the AZURE_COSMOSDB_* settings to run this benchmark")
+
+    client = CosmosConversationClient(
+        cosmosdb_endpoint=f"https://{app_settings.chat_history.account}.documents.azure.com:443/",
+        credential=app_settings.chat_history.account_key or DefaultAzureCredential(),
+        database_name=app_settings.chat_history.database,
+        container_name=app_settings.chat_history.conversations_container,
+    )
+    recorder = ChargeRecorder(client.container_client)
+    client.container_client = recorder
+    user_id = f"benchmark-{uuid.uuid4()}"
+    conversation = None
+    try:
+        conversation = await client.create_conversation(user_id, title="create_message benchmark")
+        print(f"{'implementation':<16}{'RU/msg':>10}{'trips/msg':>11}{'p50 ms':>9}{'max ms':>9}")
+        for name, create_message in (
+            ("legacy", legacy_create_message),
+            ("create_message", CosmosConversationClient.create_message),
+        ):
+            result = await measure(client, recorder, create_message, user_id, conversation["id"], messages)
+            print(f"{name:<16}{result[0]:>10.2f}{result[1]:>11.1f}{result[2]:>9.1f}{result[3]:>9.1f}")
+    finally:
+        if conversation:
+            await client.delete_messages(conversation["id"], user_id)
+            await client.delete_conversation(user_id, conversation["id"])
+        await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(main(args.messages))
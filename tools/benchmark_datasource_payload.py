@@ -0,0 +1,91 @@
+"""
+Measure the per-request cost of building the data_sources payload for each
+datasource type: dumping the pydantic settings on every request (the
+previous behaviour, still available as build_payload_template) versus
+copying the template compiled at startup.
+
+The datasource settings are filled with dummy values from the environment,
+so no service is contacted.
+
+Usage:
+    python tools/benchmark_datasource_payload.py [--iterations 20000]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+os.environ["DOTENV_PATH"] = os.devnull
+DUMMY_ENVIRONMENT = {
+    "AZURE_OPENAI_ENDPOINT": "https://dummy.openai.azure.com/",
+    "AZURE_OPENAI_MODEL": "gpt-4o",
+    "AZURE_OPENAI_KEY": "dummy",
+    "AZURE_OPENAI_EMBEDDING_NAME": "text-embedding-ada-002",
+    "AZURE_SEARCH_SERVICE": "search",
+    "AZURE_SEARCH_INDEX": "index",
+    "AZURE_SEARCH_KEY": "dummy",
+    "AZURE_SEARCH_CONTENT_COLUMNS": "content",
+    "AZURE_SEARCH_VECTOR_COLUMNS": "contentVector",
+    "AZURE_COSMOSDB_MONGO_VCORE_CONNECTION_STRING": "mongodb://dummy",
+    "AZURE_COSMOSDB_MONGO_VCORE_INDEX": "index",
+    "AZURE_COSMOSDB_MONGO_VCORE_DATABASE": "database",
+    "AZURE_COSMOSDB_MONGO_VCORE_CONTAINER": "container",
+    "ELASTICSEARCH_ENDPOINT": "https://dummy.es.io",
+    "ELASTICSEARCH_ENCODED_API_KEY": "dummy",
+    "ELASTICSEARCH_INDEX": "index",
+    "PINECONE_ENVIRONMENT": "environment",
+    "PINECONE_API_KEY": "dummy",
+    "PINECONE_INDEX_NAME": "index",
+    "AZURE_MLINDEX_NAME": "index",
+    "AZURE_MLINDEX_VERSION": "1",
+    "AZURE_ML_PROJECT_RESOURCE_ID": "/subscriptions/dummy",
+    "AZURE_SQL_SERVER_CONNECTION_STRING": "Driver=dummy",
+    "MONGODB_ENDPOINT": "mongodb://dummy",
+    "MONGODB_USERNAME": "user",
+    "MONGODB_PASSWORD": "dummy",
+    "MONGODB_DATABASE_NAME": "database",
+    "MONGODB_COLLECTION_NAME": "collection",
+    "MONGODB_APP_NAME": "app",
+    "MONGODB_INDEX_NAME": "index",
+}
+DATASOURCE_TYPES = [
+    "AzureCognitiveSearch",
+    "AzureCosmosDB",
+    "Elasticsearch",
+    "Pinecone",
+    "AzureMLIndex",
+    "AzureSqlServer",
+    "MongoDB",
+]
+for name, value in DUMMY_ENVIRONMENT.items():
+    os.environ.setdefault(name, value)
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backend.settings import _AppSettings, _BaseSettings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{args.iterations} payloads per datasource type\n")
+    print(f"{'datasource':<22}{'dump (us)':>12}{'template (us)':>15}{'speedup':>10}")
+    for datasource_type in DATASOURCE_TYPES:
+        base_settings = _BaseSettings(datasource_type=datasource_type)
+        datasource = _AppSettings(base_settings=base_settings).datasource
+
+        # Both paths must produce the same payload
+        assert datasource.build_payload_template() == datasource.construct_payload_configuration()
+
+        dump = timeit.timeit(datasource.build_payload_template, number=args.iterations)
+        template = timeit.timeit(datasource.construct_payload_configuration, number=args.iterations)
+        print(
+            f"{datasource_type:<22}{dump / args.iterations * 1e6:>12.2f}"
+            f"{template / args.iterations * 1e6:>15.2f}{dump / template:>9.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Compare request units and latency of /history/list pages read with
+OFFSET/LIMIT (CosmosConversationClient.get_conversations) and with
+continuation tokens (CosmosConversationClient.get_conversations_page),
+by page depth.
+
+Runs against the Cosmos DB account configured by the AZURE_COSMOSDB_*
+settings, or against the local Cosmos DB emulator with
+--endpoint https://localhost:8081/ --key <emulator key> (import the
+emulator's certificate first). The conversations are written to a
+throwaway userId partition and deleted afterwards. Request charges are
+read from the x-ms-request-charge header of every response.
+
+Usage:
+    python tools/benchmark_history_list.py [--conversations 500] [--page-size 25]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from azure.identity.aio import DefaultAzureCredential
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.settings import app_settings
+from benchmark_create_message import ChargeRecorder
+
+
+async def seed(client, user_id, conversations):
+    started = datetime.utcnow()
+    semaphore = asyncio.Semaphore(20)
+
+    async def create(i):
+        timestamp = (started - timedelta(seconds=i)).isoformat()
+        async with semaphore:
+            await client.container_client.upsert_item({
+                'id': str(uuid.uuid4()),
+                'type': 'conversation',
+                'createdAt': timestamp,
+                'updatedAt': timestamp,
+                'userId': user_id,
+                'title': f'benchmark conversation {i}'
+            })
+
+    await asyncio.gather(*(create(i) for i in range(conversations)))
+
+
+async def measure(recorder, read_page):
+    recorder.request_charge, recorder.round_trips = 0.0, 0
+    started = time.perf_counter()
+    result = await read_page()
+    return result, recorder.request_charge, (time.perf_counter() - started) * 1000
+
+
+async def main(conversations: int, page_size: int, endpoint: str, key: str):
+    if not app_settings.chat_history:
+        sys.exit("Set the AZURE_COSMOSDB_* settings to run this benchmark")
+
+    client = CosmosConversationClient(
+        cosmosdb_endpoint=endpoint or f"https://{app_settings.chat_history.account}.documents.azure.com:443/",
+        credential=key or app_settings.chat_history.account_key or DefaultAzureCredential(),
+        database_name=app_settings.chat_history.database,
+        container_name=app_settings.chat_history.conversations_container,
+    )
+    user_id = f"benchmark-{uuid.uuid4()}"
+    try:
+        await seed(client, user_id, conversations)
+        recorder = ChargeRecorder(client.container_client)
+        client.container_client = recorder
+
+        print(f"{'page':>5}{'offset RU':>11}{'offset ms':>11}{'token RU':>10}{'token ms':>10}")
+        continuation_token = None
+        for page in range((conversations + page_size - 1) // page_size):
+            _, offset_charge, offset_ms = await measure(
+                recorder,
+                lambda: client.get_conversations(user_id, limit=page_size, offset=page * page_size)
+            )
+            (_, continuation_token), token_charge, token_ms = await measure(
+                recorder,
+                lambda: client.get_conversations_page(user_id, page_size, continuation_token=continuation_token)
+            )
+            print(f"{page + 1:>5}{offset_charge:>11.2f}{offset_ms:>11.1f}{token_charge:>10.2f}{token_ms:>10.1f}")
+            if not continuation_token:
+                break
+    finally:
+        client.container_client = getattr(client.container_client, "container_client", client.container_client)
+        item_ids = await client.get_history_item_ids(user_id)
+        await client.delete_items(user_id, item_ids)
+        await client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=500)
+    parser.add_argument("--page-size", type=int, default=25)
+    parser.add_argument("--endpoint", help="Cosmos DB endpoint, for example the emulator's")
+    parser.add_argument("--key", help="Account key for --endpoint")
+    args = parser.parse_args()
+    asyncio.run(main(args.conversations, args.page_size, args.endpoint, args.key))
@@ -0,0 +1,118 @@
+"""
+Measure bytes on the wire and write syscalls per streamed answer with and
+without NDJSON frame coalescing (STREAM_FLUSH_MAX_TOKENS /
+STREAM_FLUSH_INTERVAL_MS) and with the compact stream format
+(X-Stream-Format: compact).
+
+Every NDJSON line is one ASGI body message, which the server turns into one
+send() on the client socket. This script replays a synthetic answer through
+format_stream_response -> coalesce_stream_responses -> format_as_ndjson and
+writes each line to a real socket so the counts match what a worker does.
+
+Usage:
+    python tools/benchmark_stream_coalescing.py [--tokens 800] [--token-delay-ms 2]
+"""
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from backend.utils import (
+    coalesce_stream_responses,
+    format_as_compact_ndjson,
+    format_as_ndjson,
+    format_stream_response,
+)
+
+HISTORY_METADATA = {
+    "conversation_id": "3f1c2a9e-6a55-4c43-9d1e-2f5d1c8b7a10",
+    "title": "PTO policy question",
+    "date": "2024-06-01T12:00:00.000000",
+}
+APIM_REQUEST_ID = "7c1f0e5a-3b7d-4a54-8f0f-6a4d5f3e2b1c"
+
+
+async def synthetic_chunks(tokens: int, token_delay: float):
+    for i in range(tokens):
+        if token_delay:
+            await asyncio.sleep(token_delay)
+        delta = SimpleNamespace(role="assistant", content=f"tok{i % 10} ")
+        yield SimpleNamespace(
+            id="chatcmpl-9bench",
+            model="gpt-4o",
+            created=1717243200,
+            object="chat.completion.chunk",
+            choices=[SimpleNamespace(delta=delta)]
+        )
+
+
+async def run(tokens: int, token_delay: float, max_tokens: int, max_interval_ms: float, compact: bool):
+    writer, reader = socket.socketpair()
+    reader.setblocking(False)
+    sends = 0
+    sent_bytes = 0
+
+    async def frames():
+        async for chunk in synthetic_chunks(tokens, token_delay):
+            yield format_stream_response(chunk, HISTORY_METADATA, APIM_REQUEST_ID)
+
+    started = time.perf_counter()
+    try:
+        stream = coalesce_stream_responses(frames(), max_tokens, max_interval_ms)
+        formatter = format_as_compact_ndjson if compact else format_as_ndjson
+        async for line in formatter(stream):
+            data = line if isinstance(line, bytes) else line.encode("utf-8")
+            writer.sendall(data)
+            sends += 1
+            sent_bytes += len(data)
+            # Drain the other end so the socket buffer never fills up
+            try:
+                while reader.recv(65536):
+                    pass
+            except BlockingIOError:
+                pass
+    finally:
+        writer.close()
+        reader.close()
+
+    return sends, sent_bytes, time.perf_counter() - started
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokens", type=int, default=800)
+    parser.add_argument("--token-delay-ms", type=float, default=2)
+    args = parser.parse_args()
+    token_delay = args.token_delay_ms / 1000
+
+    policies = [
+        ("baseline (1 token)", 1, 0, False),
+        ("8 tokens", 8, 0, False),
+        ("16 tokens / 50 ms", 16, 50, False),
+        ("32 tokens / 100 ms", 32, 100, False),
+        ("compact (1 token)", 1, 0, True),
+        ("compact 16 / 50 ms", 16, 50, True),
+    ]
+
+    print(f"{args.tokens} tokens, {args.token_delay_ms} ms between tokens\n")
+    print(f"{'policy':<22}{'frames/send()':>15}{'bytes':>12}{'bytes/token':>13}{'seconds':>10}")
+    baseline_bytes = None
+    for name, max_tokens, max_interval_ms, compact in policies:
+        sends, sent_bytes, elapsed = await run(
+            args.tokens, token_delay, max_tokens, max_interval_ms, compact
+        )
+        baseline_bytes = baseline_bytes or sent_bytes
+        print(
+            f"{name:<22}{sends:>15}{sent_bytes:>12}"
+            f"{sent_bytes / args.tokens:>13.1f}{elapsed:>10.2f}"
+            f"   ({sent_bytes / baseline_bytes:.0%} of baseline bytes)"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())